@@ -14,7 +14,15 @@ import torch.nn.functional as F
 from torch import Tensor
 
 
+def _att_chunk_rows(nb_nodes, chunk_pairs):
+    # rows per block so that a block holds about `chunk_pairs` node pairs
+    return max(1, chunk_pairs // max(nb_nodes, 1))
+
+
 class GraphAttentionLayer(nn.Module):
+    # node pairs materialised at once by the inference attention path
+    att_chunk_pairs = 4096
+
     def __init__(self, in_dim, out_dim, **kwargs):
         super().__init__()
 
@@ -77,6 +85,9 @@ class GraphAttentionLayer(nn.Module):
         x           :(#bs, #node, #dim)
         out_shape   :(#bs, #node, #node, 1)
         '''
+        if not self.training:
+            return self._derive_att_map_chunked(x)
+
         att_map = self._pairwise_mul_nodes(x)
         # size: (#bs, #node, #node, #dim_out)
         att_map = torch.tanh(self.att_proj(att_map))
@@ -90,6 +101,31 @@ class GraphAttentionLayer(nn.Module):
 
         return att_map
 
+    def _derive_att_map_chunked(self, x):
+        '''
+        Inference path of _derive_att_map with the same result.
+        Pairwise products are built for a block of rows at a time, so the
+        intermediate is (#bs, #rows, #node, #dim) with #rows * #node kept
+        around `att_chunk_pairs` instead of (#bs, #node, #node, #dim).
+        x           :(#bs, #node, #dim)
+        out_shape   :(#bs, #node, #node, 1)
+        '''
+        nb_nodes = x.size(1)
+        rows = _att_chunk_rows(nb_nodes, self.att_chunk_pairs)
+        blocks = []
+        for s in range(0, nb_nodes, rows):
+            pair = x[:, s:s + rows].unsqueeze(2) * x.unsqueeze(1)
+            blocks.append(torch.matmul(
+                torch.tanh(self.att_proj(pair)), self.att_weight).squeeze(-1))
+        att_map = torch.cat(blocks, dim=1)
+
+        # apply temperature
+        att_map = att_map / self.temp
+
+        att_map = F.softmax(att_map, dim=-1)
+
+        return att_map.unsqueeze(-1)
+
     def _project(self, x, att_map):
         x1 = self.proj_with_att(torch.matmul(att_map.squeeze(-1), x))
         x2 = self.proj_without_att(x)
@@ -111,6 +147,9 @@ class GraphAttentionLayer(nn.Module):
 
 
 class HtrgGraphAttentionLayer(nn.Module):
+    # node pairs materialised at once by the inference attention path
+    att_chunk_pairs = 4096
+
     def __init__(self, in_dim, out_dim, **kwargs):
         super().__init__()
 
@@ -227,6 +266,9 @@ class HtrgGraphAttentionLayer(nn.Module):
         x           :(#bs, #node, #dim)
         out_shape   :(#bs, #node, #node, 1)
         '''
+        if not self.training:
+            return self._derive_att_map_chunked(x, num_type1, num_type2)
+
         att_map = self._pairwise_mul_nodes(x)
         # size: (#bs, #node, #node, #dim_out)
         att_map = torch.tanh(self.att_proj(att_map))
@@ -254,6 +296,37 @@ class HtrgGraphAttentionLayer(nn.Module):
 
         return att_map
 
+    def _derive_att_map_chunked(self, x, num_type1, num_type2):
+        '''
+        Inference path of _derive_att_map with the same result, built a block
+        of rows at a time like GraphAttentionLayer._derive_att_map_chunked.
+        Type-1 rows score type-1 columns with att_weight11 and type-2 columns
+        with att_weight12; type-2 rows use att_weight12 and att_weight22.
+        x           :(#bs, #node, #dim)
+        out_shape   :(#bs, #node, #node, 1)
+        '''
+        nb_nodes = x.size(1)
+        rows = _att_chunk_rows(nb_nodes, self.att_chunk_pairs)
+        blocks = []
+        for start, end, w_1, w_2 in (
+                (0, num_type1, self.att_weight11, self.att_weight12),
+                (num_type1, nb_nodes, self.att_weight12, self.att_weight22)):
+            for s in range(start, end, rows):
+                e = min(s + rows, end)
+                pair = torch.tanh(self.att_proj(
+                    x[:, s:e].unsqueeze(2) * x.unsqueeze(1)))
+                blocks.append(torch.cat([
+                    torch.matmul(pair[:, :, :num_type1], w_1),
+                    torch.matmul(pair[:, :, num_type1:], w_2)], dim=2).squeeze(-1))
+        att_map = torch.cat(blocks, dim=1)
+
+        # apply temperature
+        att_map = att_map / self.temp
+
+        att_map = F.softmax(att_map, dim=-1)
+
+        return att_map.unsqueeze(-1)
+
     def _project(self, x, att_map):
         x1 = self.proj_with_att(torch.matmul(att_map.squeeze(-1), x))
         x2 = self.proj_without_att(x)
@@ -375,7 +448,7 @@ class CONV(nn.Module):
         self.mel = filbandwidthsf
         self.hsupp = torch.arange(-(self.kernel_size - 1) / 2,
                                   (self.kernel_size - 1) / 2 + 1)
-        self.band_pass = torch.zeros(self.out_channels, self.kernel_size)
+        band_pass = torch.zeros(self.out_channels, self.kernel_size)
         for i in range(len(self.mel) - 1):
             fmin = self.mel[i]
             fmax = self.mel[i + 1]
@@ -385,24 +458,28 @@ class CONV(nn.Module):
                 np.sinc(2*fmin*self.hsupp/self.sample_rate)
             hideal = hHigh - hLow
 
-            self.band_pass[i, :] = Tensor(np.hamming(
+            band_pass[i, :] = Tensor(np.hamming(
                 self.kernel_size)) * Tensor(hideal)
 
+        # fixed filterbank: built once, follows the module's device, not saved
+        self.register_buffer("band_pass", band_pass, persistent=False)
+
     def forward(self, x, mask=False):
-        band_pass_filter = self.band_pass.clone().to(x.device)
         if mask:
+            # frequency masking for training works on a copy
+            band_pass_filter = self.band_pass.clone()
             A = np.random.uniform(0, 20)
             A = int(A)
             A0 = random.randint(0, band_pass_filter.shape[0] - A)
             band_pass_filter[A0:A0 + A, :] = 0
         else:
-            band_pass_filter = band_pass_filter
+            band_pass_filter = self.band_pass
 
-        self.filters = (band_pass_filter).view(self.out_channels, 1,
-                                               self.kernel_size)
+        filters = band_pass_filter.view(self.out_channels, 1,
+                                        self.kernel_size)
 
         return F.conv1d(x,
-                        self.filters,
+                        filters,
                         stride=self.stride,
                         padding=self.padding,
                         dilation=self.dilation,
@@ -558,7 +635,7 @@ class Model(nn.Module):
 
         # inference 1
         out_T1, out_S1, master1 = self.HtrgGAT_layer_ST11(
-            out_T, out_S, master=self.master1)
+            out_T, out_S, master=master1)
 
         out_S1 = self.pool_hS1(out_S1)
         out_T1 = self.pool_hT1(out_T1)
@@ -571,7 +648,7 @@ class Model(nn.Module):
 
         # inference 2
         out_T2, out_S2, master2 = self.HtrgGAT_layer_ST21(
-            out_T, out_S, master=self.master2)
+            out_T, out_S, master=master2)
         out_S2 = self.pool_hS2(out_S2)
         out_T2 = self.pool_hT2(out_T2)
 
@@ -72,9 +72,7 @@ class SincConv(nn.Module):
         self.mel = filbandwidthsf
         self.hsupp = torch.arange(-(self.kernel_size - 1) / 2,
                                   (self.kernel_size - 1) / 2 + 1)
-        self.band_pass = torch.zeros(self.out_channels, self.kernel_size)
-
-    def forward(self, x):
+        band_pass = torch.zeros(self.out_channels, self.kernel_size)
         for i in range(len(self.mel) - 1):
             fmin = self.mel[i]
             fmax = self.mel[i + 1]
@@ -84,14 +82,16 @@ class SincConv(nn.Module):
                 2 * fmin * self.hsupp / self.sample_rate)
             hideal = hHigh - hLow
 
-            self.band_pass[i, :] = Tensor(np.hamming(
+            band_pass[i, :] = Tensor(np.hamming(
                 self.kernel_size)) * Tensor(hideal)
 
-        band_pass_filter = self.band_pass.to(x.device)
-
-        self.filters = (band_pass_filter).view(self.out_channels, 1,
-                                               self.kernel_size)
+        # fixed filterbank: built once, follows the module's device, not saved
+        self.register_buffer(
+            "filters",
+            band_pass.view(self.out_channels, 1, self.kernel_size),
+            persistent=False)
 
+    def forward(self, x):
         return F.conv1d(
             x,
             self.filters,
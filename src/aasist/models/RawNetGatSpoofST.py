@@ -187,7 +187,7 @@ class CONV(nn.Module):
         self.mel = filbandwidthsf
         self.hsupp = torch.arange(-(self.kernel_size - 1) / 2,
                                   (self.kernel_size - 1) / 2 + 1)
-        self.band_pass = torch.zeros(self.out_channels, self.kernel_size)
+        band_pass = torch.zeros(self.out_channels, self.kernel_size)
         for i in range(len(self.mel) - 1):
             fmin = self.mel[i]
             fmax = self.mel[i + 1]
@@ -197,24 +197,28 @@ class CONV(nn.Module):
                 np.sinc(2*fmin*self.hsupp/self.sample_rate)
             hideal = hHigh - hLow
 
-            self.band_pass[i, :] = Tensor(np.hamming(
+            band_pass[i, :] = Tensor(np.hamming(
                 self.kernel_size)) * Tensor(hideal)
 
+        # fixed filterbank: built once, follows the module's device, not saved
+        self.register_buffer("band_pass", band_pass, persistent=False)
+
     def forward(self, x, mask=False):
-        band_pass_filter = self.band_pass.clone().to(x.device)
         if mask:
+            # frequency masking for training works on a copy
+            band_pass_filter = self.band_pass.clone()
             A = np.random.uniform(0, 20)
             A = int(A)
             A0 = random.randint(0, band_pass_filter.shape[0] - A)
             band_pass_filter[A0:A0 + A, :] = 0
         else:
-            band_pass_filter = band_pass_filter
+            band_pass_filter = self.band_pass
 
-        self.filters = (band_pass_filter).view(self.out_channels, 1,
-                                               self.kernel_size)
+        filters = band_pass_filter.view(self.out_channels, 1,
+                                        self.kernel_size)
 
         return F.conv1d(x,
-                        self.filters,
+                        filters,
                         stride=self.stride,
                         padding=self.padding,
                         dilation=self.dilation,
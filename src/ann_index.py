@@ -0,0 +1,381 @@
+"""
+Approximate nearest-neighbour search over normalised ECAPA embeddings.
+
+IVFIndex partitions the embeddings into `nlist` inverted lists around
+spherical k-means centroids. A query scores the centroids, then only the
+vectors in its `nprobe` closest lists. Inserts and deletes touch a single
+list. The centroids are retrained from scratch once the index has grown
+`retrain_growth` times past the size it was trained at, on a background
+thread while searches keep using the old lists.
+
+Recall/latency against exact search on synthetic speakers:
+
+    python -m src.ann_index --users 100000 --nprobe 8
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+EMBEDDING_DIM = 192
+
+
+def _normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    return x / np.maximum(norms, 1e-8)
+
+
+def spherical_kmeans(x: np.ndarray, k: int, iters: int = 10, seed: int = 0) -> np.ndarray:
+    """(k, dim) unit centroids for unit rows `x`, by Lloyd iterations on cosine similarity."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(x.shape[0], size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = ~np.any(sums, axis=1)
+        if empty.any():
+            # restart empty clusters on random points
+            sums[empty] = x[rng.choice(x.shape[0], size=int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class _InvertedList:
+    __slots__ = ("vecs", "names", "size")
+
+    def __init__(self, dim: int, capacity: int = 16):
+        self.vecs = np.zeros((capacity, dim), dtype=np.float32)
+        self.names: List[str] = []
+        self.size = 0
+
+    def append(self, name: str, vec: np.ndarray) -> int:
+        if self.size == self.vecs.shape[0]:
+            grown = np.zeros((self.size * 2, self.vecs.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.vecs[:self.size]
+            self.vecs = grown
+        self.vecs[self.size] = vec
+        self.names.append(name)
+        self.size += 1
+        return self.size - 1
+
+    def pop(self, pos: int) -> Optional[str]:
+        """Swap-remove the entry at `pos`; returns the name moved into `pos`, if any."""
+        last = self.size - 1
+        moved = None
+        if pos != last:
+            self.vecs[pos] = self.vecs[last]
+            self.names[pos] = self.names[last]
+            moved = self.names[pos]
+        self.names.pop()
+        self.size -= 1
+        return moved
+
+
+class IVFIndex:
+    """
+    Inverted-file index for cosine top-k. Vectors are normalised on insert,
+    so scores are cosine similarities. Below `min_train` vectors there are
+    no centroids and search is an exact scan.
+    """
+    def __init__(self, dim: int = EMBEDDING_DIM, nlist: Optional[int] = None, nprobe: int = 8,
+                 min_train: int = 1024, retrain_growth: float = 4.0):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.retrain_growth = retrain_growth
+        self._lock = threading.RLock()
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: List[_InvertedList] = [_InvertedList(dim)]
+        self._where: Dict[str, Tuple[int, int]] = {}
+        self._trained_size = 0
+        self._retraining = False
+        self._changes: Dict[str, Optional[np.ndarray]] = {}  # adds (vector) and removes (None) during a retrain
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._where
+
+    @property
+    def trained(self) -> bool:
+        return self._centroids is not None
+
+    def _assign(self, vecs: np.ndarray) -> np.ndarray:
+        if self._centroids is None:
+            return np.zeros(vecs.shape[0], dtype=np.int64)
+        return np.argmax(vecs @ self._centroids.T, axis=1)
+
+    def _insert(self, name: str, vec: np.ndarray, list_id: int):
+        pos = self._lists[list_id].append(name, vec)
+        self._where[name] = (list_id, pos)
+
+    def _remove(self, name: str):
+        list_id, pos = self._where.pop(name)
+        moved = self._lists[list_id].pop(pos)
+        if moved is not None:
+            self._where[moved] = (list_id, pos)
+
+    def _record(self, name: str, vec: Optional[np.ndarray]):
+        # the caller holds self._lock; replayed onto the retrained index before it is swapped in
+        if self._retraining:
+            self._changes[name] = vec
+
+    @classmethod
+    def build(cls, names: List[str], matrix: np.ndarray, **kwargs) -> "IVFIndex":
+        """Bulk-load `names` / `matrix` rows and train once."""
+        index = cls(**kwargs)
+        with index._lock:
+            for name, vec in zip(names, _normalize(matrix)):
+                index._insert(name, vec, 0)
+            index.train()
+        return index
+
+    ### mutation ###
+    def add(self, name: str, emb):
+        """Insert `name`, or move it if it is already indexed."""
+        vec = _normalize(np.asarray(emb, dtype=np.float32).reshape(1, -1))
+        with self._lock:
+            if name in self._where:
+                self._remove(name)
+            self._insert(name, vec[0], int(self._assign(vec)[0]))
+            self._record(name, vec[0])
+            n = len(self._where)
+            due = (not self.trained and n >= self.min_train) or \
+                (self.trained and n >= self.retrain_growth * self._trained_size)
+            if not due or self._retraining:
+                return
+            self._retraining = True
+            self._changes = {}
+        threading.Thread(target=self._retrain, name="ivf-retrain", daemon=True).start()
+
+    def remove(self, name: str):
+        with self._lock:
+            if name in self._where:
+                self._remove(name)
+                self._record(name, None)
+
+    def items(self) -> Tuple[List[str], np.ndarray]:
+        """(names, (n, dim) unit vectors) of everything indexed."""
+        with self._lock:
+            names = [name for lst in self._lists for name in lst.names]
+            vecs = [lst.vecs[:lst.size] for lst in self._lists]
+            vecs = np.concatenate(vecs) if vecs else np.zeros((0, self.dim), dtype=np.float32)
+            return names, vecs
+
+    def _fit(self, names: List[str], vecs: np.ndarray) -> Optional["IVFIndex"]:
+        """A new index trained on `names` / unit `vecs`, or None below min_train. Takes no lock."""
+        n = len(names)
+        if n < self.min_train:
+            return None
+        nlist = self.nlist or int(np.clip(4 * np.sqrt(n), 16, 65536))
+        nlist = min(nlist, n)
+        # k-means on a sample: 64 points per centroid is plenty for coarse quantisation
+        sample = vecs
+        if n > 64 * nlist:
+            sample = vecs[np.random.default_rng(0).choice(n, size=64 * nlist, replace=False)]
+        start = time.perf_counter()
+        index = IVFIndex(self.dim, self.nlist, self.nprobe, self.min_train, self.retrain_growth)
+        index._centroids = spherical_kmeans(sample, nlist)
+        index._lists = [_InvertedList(self.dim) for _ in range(nlist)]
+        for name, vec, list_id in zip(names, vecs, index._assign(vecs)):
+            index._insert(name, vec, int(list_id))
+        index._trained_size = n
+        logger.info(f"IVF index trained: {n} vectors, {nlist} lists in {time.perf_counter() - start:.2f}s")
+        return index
+
+    def _swap(self, fresh: "IVFIndex"):
+        # the caller holds self._lock
+        self._centroids, self._lists, self._where = fresh._centroids, fresh._lists, fresh._where
+        self._trained_size = fresh._trained_size
+
+    def train(self):
+        """(Re)compute the centroids from the indexed vectors and rebuild the lists, blocking meanwhile."""
+        with self._lock:
+            fresh = self._fit(*self.items())
+            if fresh is not None:
+                self._swap(fresh)
+
+    def _retrain(self):
+        """train() on a snapshot, off the lock; changes made meanwhile are replayed before the swap."""
+        try:
+            names, vecs = self.items()
+            fresh = self._fit(names, vecs)
+            with self._lock:
+                if fresh is not None:
+                    for name, vec in self._changes.items():
+                        if name in fresh._where:
+                            fresh._remove(name)
+                        if vec is not None:
+                            fresh._insert(name, vec, int(fresh._assign(vec[None])[0]))
+                    self._swap(fresh)
+        except Exception as e:
+            logger.error(f"IVF index retraining failed: {e!r}")
+        finally:
+            with self._lock:
+                self._retraining = False
+                self._changes = {}
+
+    ### search ###
+    def search(self, query, k: int = 5, nprobe: Optional[int] = None) -> List[Tuple[str, float]]:
+        """Approximate top-k (name, cosine), best first."""
+        q = _normalize(np.asarray(query, dtype=np.float32).reshape(-1))
+        nprobe = nprobe or self.nprobe
+        with self._lock:
+            if not self._where or k <= 0:
+                return []
+            if self._centroids is None:
+                probe = [0]
+            else:
+                coarse = self._centroids @ q
+                nprobe = min(nprobe, coarse.shape[0])
+                probe = np.argpartition(-coarse, nprobe - 1)[:nprobe]
+            names: List[str] = []
+            scores = []
+            for list_id in probe:
+                lst = self._lists[list_id]
+                if lst.size:
+                    scores.append(lst.vecs[:lst.size] @ q)
+                    names.extend(lst.names)
+
+        if not names:
+            return []
+        scores = np.concatenate(scores)
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(names[i], float(scores[i])) for i in top]
+
+    ### persistence ###
+    def save(self, path: Union[str, Path]):
+        """Write the index to `path` (.npz) through a temp file and an atomic rename."""
+        path = Path(path)
+        with self._lock:
+            names, vecs = self.items()
+            centroids = self._centroids if self._centroids is not None else np.zeros((0, self.dim), np.float32)
+            trained_size = self._trained_size
+        # a temp name of our own: several workers may save the same index at once
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + ".", suffix=".tmp",
+                                         delete=False) as f:
+            try:
+                np.savez(f, centroids=centroids, vecs=vecs, names=np.array(names, dtype=str),
+                         trained_size=np.array(trained_size))
+            except BaseException:
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, path)
+        logger.info(f"IVF index saved to {path} ({len(names)} vectors)")
+
+    @classmethod
+    def load(cls, path: Union[str, Path], **kwargs) -> "IVFIndex":
+        with np.load(path, allow_pickle=False) as f:
+            centroids, vecs, names = f["centroids"], f["vecs"], f["names"].tolist()
+            trained_size = int(f["trained_size"])
+        index = cls(dim=vecs.shape[1] if vecs.ndim == 2 and vecs.shape[1] else EMBEDDING_DIM, **kwargs)
+        if centroids.shape[0]:
+            index._centroids = centroids.astype(np.float32)
+            index._lists = [_InvertedList(index.dim) for _ in range(centroids.shape[0])]
+            index._trained_size = trained_size
+        for name, vec, list_id in zip(names, vecs, index._assign(vecs)):
+            index._insert(name, vec, int(list_id))
+        logger.info(f"IVF index loaded from {path} ({len(names)} vectors, {centroids.shape[0]} lists)")
+        return index
+
+    def sync(self, names: List[str], matrix: np.ndarray, atol: float = 1e-5) -> int:
+        """
+        Make the index match `names` / `matrix` rows (e.g. after loading a
+        saved index): adds missing or changed vectors, drops stale names.
+        Returns the number of changes.
+        """
+        wanted = dict(zip(names, range(len(names))))
+        changes = 0
+        with self._lock:
+            for name in [n for n in self._where if n not in wanted]:
+                self._remove(name)
+                changes += 1
+            unit = _normalize(matrix) if len(names) else matrix
+            for name, row in wanted.items():
+                where = self._where.get(name)
+                if where is not None:
+                    list_id, pos = where
+                    if np.allclose(self._lists[list_id].vecs[pos], unit[row], atol=atol):
+                        continue
+                self.add(name, unit[row])
+                changes += 1
+        return changes
+
+
+### benchmark ###
+def _synthetic_speakers(n: int, dim: int, spread: float, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    # clustered like real embeddings: speakers scattered by `spread` around
+    # n / 50 "voice types"; the larger the spread, the harder for IVF
+    rng = np.random.default_rng(seed)
+    centers = _normalize(rng.standard_normal((max(n // 50, 16), dim)))
+    base = centers[rng.integers(0, centers.shape[0], size=n)]
+    users = _normalize(base + spread * rng.standard_normal((n, dim)).astype(np.float32) / np.sqrt(dim))
+    queries = _normalize(users[:1000] + 0.3 * rng.standard_normal((min(n, 1000), dim)).astype(np.float32) / np.sqrt(dim))
+    return users, queries
+
+
+def benchmark(n_users: int, nprobe: int, k: int = 5, nlist: Optional[int] = None, spread: float = 1.0) -> dict:
+    users, queries = _synthetic_speakers(n_users, EMBEDDING_DIM, spread)
+    names = [f"user{i}" for i in range(n_users)]
+
+    start = time.perf_counter()
+    index = IVFIndex.build(names, users, nlist=nlist, nprobe=nprobe, min_train=1)
+    build_s = time.perf_counter() - start
+
+    exact_ms, ivf_ms, hits = [], [], 0
+    for q in queries:
+        t = time.perf_counter()
+        scores = users @ q
+        top = np.argpartition(-scores, k - 1)[:k]
+        exact_ms.append((time.perf_counter() - t) * 1000)
+        truth = {names[i] for i in top}
+
+        t = time.perf_counter()
+        found = index.search(q, k)
+        ivf_ms.append((time.perf_counter() - t) * 1000)
+        hits += len(truth & {name for name, _ in found})
+
+    return {
+        "users": n_users,
+        "nlist": len(index._lists),
+        "nprobe": nprobe,
+        f"recall@{k}": hits / (k * len(queries)),
+        "exact_ms_p50": float(np.percentile(exact_ms, 50)),
+        "ivf_ms_p50": float(np.percentile(ivf_ms, 50)),
+        "ivf_ms_p99": float(np.percentile(ivf_ms, 99)),
+        "build_s": build_s,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IVF index recall/latency against exact search")
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--spread", type=float, default=1.0, help="within-cluster spread of the synthetic users")
+    args = parser.parse_args()
+
+    result = benchmark(args.users, args.nprobe, args.k, args.nlist, args.spread)
+    width = max(len(key) for key in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value:.4f}" if isinstance(value, float) else f"{key:<{width}}  {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Sequence
+
+from src.ultils_logger import get_logger
+from src.inference_pool import PoolBusyError
+
+logger = get_logger(__name__)
+
+
+class MicroBatcher:
+    """
+    Collects concurrently submitted items into batches.
+
+    A worker thread takes the first waiting item, then keeps collecting for up
+    to `max_wait_ms` or until `max_batch` items are in hand, and calls
+    `run_batch(items)` once. `run_batch` returns one result per item, in order;
+    each caller gets its own result through the Future returned by `submit`.
+    """
+    def __init__(self, run_batch: Callable[[List[Any]], Sequence[Any]], max_batch: int = 16,
+                 max_wait_ms: float = 10.0, max_queue: int = 64, name: str = "batcher"):
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self._worker = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._worker.start()
+        logger.info(f"{name} started: max_batch={max_batch}, max_wait={max_wait_ms}ms, max_queue={max_queue}")
+
+    def submit(self, item: Any) -> Future:
+        if self._closed:
+            raise RuntimeError(f"{self.name} is closed")
+        fut: Future = Future()
+        try:
+            self._queue.put_nowait((item, fut))
+        except queue.Full:
+            raise PoolBusyError(f"{self.name} queue is full")
+        return fut
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                nxt = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if nxt is None:
+                self._queue.put(None)
+                break
+            batch.append(nxt)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # callers that timed out or were cancelled before we started are dropped
+            batch = [(item, fut) for item, fut in batch if fut.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                logger.error(f"{self.name} batch of {len(batch)} failed: {e}")
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(batch, results):
+                fut.set_result(res)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+        logger.info(f"{self.name} stopped")
@@ -0,0 +1,190 @@
+import json
+import uuid
+from typing import AsyncIterator, Dict, Optional, Protocol
+
+import httpx
+
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class N8nStreamError(RuntimeError):
+    pass
+
+
+class AsyncReadable(Protocol):
+    async def read(self, size: int = -1) -> bytes: ...
+
+
+def _quote(value: str) -> str:
+    # as browsers encode form-data names and filenames
+    return value.replace("\r", "%0D").replace("\n", "%0A").replace('"', "%22")
+
+
+class _MultipartStream:
+    """
+    multipart/form-data body of text `fields` and one file part, streamed:
+    the file is read CHUNK_SIZE bytes at a time, only as fast as the
+    connection sends them. With the file's `size` the total length is
+    known up front and sent as Content-Length instead of chunked encoding.
+    """
+    def __init__(self, fields: Dict[str, str], name: str, file: AsyncReadable, filename: Optional[str],
+                 content_type: Optional[str], size: Optional[int], max_bytes: Optional[int]):
+        self.boundary = uuid.uuid4().hex
+        head = b"".join(
+            f'--{self.boundary}\r\nContent-Disposition: form-data; name="{_quote(key)}"\r\n\r\n{value}\r\n'.encode()
+            for key, value in fields.items()
+        )
+        disposition = f'form-data; name="{_quote(name)}"'
+        if filename is not None:
+            disposition += f'; filename="{_quote(filename)}"'
+        self.head = head + (f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+                            f"Content-Type: {content_type or 'application/octet-stream'}\r\n\r\n").encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.file = file
+        self.size = size
+        self.max_bytes = max_bytes
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        headers = {"Content-Type": f"multipart/form-data; boundary={self.boundary}"}
+        if self.size is not None:
+            headers["Content-Length"] = str(len(self.head) + self.size + len(self.tail))
+        return headers
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield self.head
+        sent = 0
+        while chunk := await self.file.read(CHUNK_SIZE):
+            sent += len(chunk)
+            if self.max_bytes is not None and sent > self.max_bytes:
+                raise UploadTooLarge(f"Upload is over {self.max_bytes} bytes")
+            yield chunk
+        if self.size is not None and sent != self.size:
+            raise ValueError(f"Upload was {sent} bytes, expected {self.size}")
+        yield self.tail
+
+
+class ReplyStream:
+    """
+    Text chunks of a streamed n8n reply, as they arrive.
+
+    n8n's streaming webhooks send one JSON record per line: {"type": "begin"},
+    {"type": "item", "content": ...} per chunk, then {"type": "end"}. A
+    webhook that answers in one piece ({"reply": ...}) comes through as a
+    single chunk, so the streaming route also works against it.
+    """
+    def __init__(self, resp: httpx.Response):
+        self._resp = resp
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        other = []
+        streamed = False
+        try:
+            async for line in self._resp.aiter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                if not isinstance(record, dict) or "type" not in record:
+                    other.append(line)
+                    continue
+                streamed = True
+                if record["type"] == "item" and record.get("content"):
+                    yield str(record["content"])
+                elif record["type"] == "error":
+                    raise N8nStreamError(str(record.get("content") or "n8n reported an error"))
+        finally:
+            await self._resp.aclose()
+        if other and not streamed:
+            text = "\n".join(other)
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = None
+            yield str(data.get("reply", "")) if isinstance(data, dict) else text
+
+    async def aclose(self):
+        await self._resp.aclose()
+
+
+class N8nClient:
+    """
+    Async client for the n8n chat webhook, shared by every request.
+
+    One httpx.AsyncClient keeps up to `max_connections` connections open and
+    reuses them across calls, so a reply costs one round trip rather than a
+    new TCP/TLS handshake. A call that finds every connection busy waits up
+    to `pool_timeout` seconds for one, then raises httpx.PoolTimeout.
+    Voice uploads over `max_upload_bytes` raise UploadTooLarge. `transport`
+    replaces the network, e.g. httpx.ASGITransport(app=n8n_stub.app) in tests.
+    """
+    def __init__(self, url: str, max_connections: int = 32, max_keepalive: int = 16,
+                 timeout: float = 30.0, voice_timeout: float = 60.0,
+                 connect_timeout: float = 5.0, pool_timeout: float = 10.0,
+                 max_upload_bytes: int = 25 * 2**20, stream_url: Optional[str] = None,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.url = url
+        self.stream_url = stream_url or url
+        self.max_upload_bytes = max_upload_bytes
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout, pool=pool_timeout)
+        self.voice_timeout = httpx.Timeout(voice_timeout, connect=connect_timeout, pool=pool_timeout)
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+            transport=transport,
+        )
+        logger.info(f"n8n client ready: url={url}, max_connections={max_connections}, timeout={timeout}s")
+
+    @staticmethod
+    def _json(resp: httpx.Response) -> dict:
+        resp.raise_for_status()
+        try:
+            data = resp.json()
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    async def send_message(self, username: str, session_id: str, message: str) -> dict:
+        resp = await self._client.post(
+            self.url, json={"username": username, "message": message, "session_id": session_id})
+        return self._json(resp)
+
+    async def stream_message(self, username: str, session_id: str, message: str) -> ReplyStream:
+        """
+        Start a request and return once n8n's response headers are in; the
+        body is read through the ReplyStream. The read timeout applies to
+        each chunk rather than the whole reply.
+        """
+        request = self._client.build_request(
+            "POST", self.stream_url, json={"username": username, "message": message, "session_id": session_id})
+        resp = await self._client.send(request, stream=True)
+        try:
+            resp.raise_for_status()
+        except httpx.HTTPError:
+            await resp.aclose()
+            raise
+        return ReplyStream(resp)
+
+    async def send_voice(self, username: str, session_id: str, file: AsyncReadable, filename: Optional[str],
+                         content_type: Optional[str], size: Optional[int] = None) -> dict:
+        """Relay an upload chunk by chunk as the `file` part, without reading it into memory."""
+        if size is not None and size > self.max_upload_bytes:
+            raise UploadTooLarge(f"Upload is over {self.max_upload_bytes} bytes")
+        body = _MultipartStream({"username": username, "session_id": session_id}, "file", file,
+                                filename, content_type, size, self.max_upload_bytes)
+        resp = await self._client.post(self.url, content=body, headers=body.headers, timeout=self.voice_timeout)
+        return self._json(resp)
+
+    async def aclose(self):
+        await self._client.aclose()
+        logger.info("n8n client closed")
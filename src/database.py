@@ -1,12 +1,23 @@
+import copy
 import json
 import os
+import threading
 import uuid
-from typing import Literal, List, Dict, Optional, TypedDict
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Literal, List, Dict, Optional, Tuple, TypedDict
 import torch
 
 from src.ultils_logger import get_logger
+from src.embedding_store import EmbeddingStore
+from src.ann_index import IVFIndex
+from src.mutation_log import MutationLog
 logger = get_logger(__name__)
 
+try:
+    import fcntl
+except ImportError:  # Windows: no shared mode
+    fcntl = None
+
 class ChatMessage(TypedDict):
     time: str
     role: Literal["bot", "human"]
@@ -25,30 +36,403 @@ class UserData(TypedDict):
     sessions: Dict[str, SessionData]
 
 
+class MessagePage(TypedDict):
+    start: int  # index of messages[0] within the session
+    total: int
+    messages: List[ChatMessage]
+
+
+def page_bounds(total: int, limit: int, before: Optional[int] = None, after: Optional[int] = None) -> Tuple[int, int]:
+    """
+    [start, stop) message indices of a page: the `limit` messages just after
+    `after`, or just before `before`, or the latest `limit` with neither.
+    """
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    if before is not None and after is not None:
+        raise ValueError("Pass either before or after, not both")
+    if after is not None:
+        start = min(max(after + 1, 0), total)
+        return start, min(start + limit, total)
+    stop = total if before is None else min(max(before, 0), total)
+    return max(stop - limit, 0), stop
+
+
+class UserLocks:
+    """
+    A fixed set of RLocks picked by username hash: one lock per user without
+    a lock table that grows with every name a request path carries.
+    """
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, username: str) -> threading.RLock:
+        return self._locks[hash(username) % len(self._locks)]
+
+
+### embedding search ###
+class VoiceIndex:
+    """
+    In-process embedding store and optional IVF index, shared by the
+    storage backends. The backend stays the source of truth; these are
+    rebuilt from it at startup and updated on its writes.
+    """
+    embeddings: EmbeddingStore
+    ann: Optional[IVFIndex]
+    index_path: str
+
+    def _init_voice_index(self, users: Iterable[Tuple[str, object]], index_path: str, count: int = 0,
+                          emb_mmap_path: Optional[str] = None, ann_index: bool = False,
+                          store: Optional[EmbeddingStore] = None):
+        """`store` is an already filled EmbeddingStore to use instead of building one from `users`."""
+        if store is None:
+            store = EmbeddingStore(capacity=max(count, 64), mmap_path=emb_mmap_path)
+            for username, emb in users:
+                store.set(username, emb)
+        self.embeddings = store
+        self.index_path = index_path
+        self.ann = self._load_index() if ann_index else None
+
+    def _load_index(self) -> IVFIndex:
+        names, matrix = self.embeddings.usernames, self.embeddings.matrix()
+        if os.path.exists(self.index_path):
+            try:
+                index = IVFIndex.load(self.index_path)
+                changes = index.sync(names, matrix)
+                if changes:
+                    logger.info(f"IVF index resynced with {changes} change(s)")
+                    index.save(self.index_path)
+                return index
+            except Exception as e:
+                logger.error(f"Failed to load IVF index from {self.index_path}, rebuilding: {e}")
+        index = IVFIndex.build(names, matrix)
+        index.save(self.index_path)
+        return index
+
+    def _index_embedding(self, username: str, emb):
+        self.embeddings.set(username, emb)
+        if self.ann is not None:
+            self.ann.add(username, emb)
+
+    def save_index(self):
+        if self.ann is not None:
+            self.ann.save(self.index_path)
+
+    def _refresh(self):
+        """Pick up writes made by other processes; backends shared between workers override this."""
+
+    def search_embedding(self, emb: torch.Tensor, k: int = 5, device="cpu") -> List[Tuple[str, float]]:
+        """
+        Top-k enrolled users by cosine similarity to `emb`, best first.
+        Approximate through the IVF index once it is trained, exact otherwise.
+        """
+        self._refresh()
+        if self.ann is not None and self.ann.trained:
+            return self.ann.search(emb.detach().squeeze().cpu().numpy(), k)
+        return self.embeddings.search(emb, k, device)
+
+
 ### db ###
-class Database:
-    def __init__(self, path: str = "database.json"):
+class _FileLock:
+    """flock on a side file, shared between processes. Not reentrant, not a thread lock."""
+    def __init__(self, path: str):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+    @contextmanager
+    def hold(self, exclusive: bool = True) -> Iterator[None]:
+        fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)  # type: ignore
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)  # type: ignore
+
+    @contextmanager
+    def try_hold(self) -> Iterator[bool]:
+        """Hold the lock exclusively if no other process does; yields whether it got it."""
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)  # type: ignore
+            held = True
+        except BlockingIOError:
+            held = False
+        try:
+            yield held
+        finally:
+            if held:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)  # type: ignore
+
+    def close(self):
+        os.close(self._fd)
+
+
+class Database(VoiceIndex):
+    """
+    Users and chat sessions, held in memory.
+
+    `path` is a JSON snapshot and `path + ".log"` an append-only log with one
+    record per mutation, so a write costs the size of the change. Startup
+    replays the log over the snapshot. Once the log passes `compact_bytes`
+    a background thread folds it into a fresh snapshot (temp file + atomic
+    rename). Log records are idempotent, so replaying one that the snapshot
+    already contains is harmless.
+
+    Writes apply in memory and queue their record; the log writes queued
+    records in batches every `fsync_interval` seconds (see MutationLog).
+    With `durable` each write returns only once its batch is fsynced.
+
+    Writes take their user's lock (see UserLocks), so writes for different
+    users don't wait on each other. With `shared` several processes (uvicorn --workers N) can
+    use the same files: a write holds an exclusive flock on `path + ".lock"`
+    while it first applies what other processes logged since it last
+    looked, then checks, applies and writes its own record. Reads take the
+    lock shared and catch up only when the log has changed. POSIX only.
+    """
+    def __init__(self, path: str = "database.json", emb_mmap_path: Optional[str] = None, ann_index: bool = False,
+                 compact_bytes: int = 8 * 2**20, fsync_interval: float = 0.05, durable: bool = False,
+                 shared: bool = False):
+        if shared and fcntl is None:
+            raise RuntimeError("Database(shared=True) needs fcntl (POSIX)")
         self.path = path
-        self.data: Dict[str, UserData] = self._load()
+        self.log_path = path + ".log"
+        self.compact_bytes = compact_bytes
+        self.durable = durable
+        self.shared = shared
+        self._user_locks = UserLocks()
+        self._process_lock = threading.RLock()  # this process's turn at the file lock
+        self._compacting = threading.Lock()
+        self._file_lock = _FileLock(path + ".lock") if shared else None
+        self._compact_lock = _FileLock(path + ".compact.lock") if shared else None
+        with self._locked_file(exclusive=False):
+            self._log = MutationLog(self.log_path, fsync_interval)
+            self.data: Dict[str, UserData] = self._load()
+            self._log_inode, self._log_offset = self._log.inode(), os.path.getsize(self.log_path)
+        # voice_emb lists stay the persisted form; the store is what inference reads
+        self._init_voice_index(((u, user["voice_emb"]) for u, user in self.data.items()),
+                               os.path.splitext(self.path)[0] + ".ivf.npz", len(self.data),
+                               emb_mmap_path, ann_index)
         logger.info(f"Database initialized at {self.path} with {len(self.data)} users")
 
     ### load/save ###
     def _load(self) -> Dict[str, UserData]:
-        if os.path.exists(self.path):
-            with open(self.path, "r") as f:
-                raw = json.load(f)
-                logger.info(f"Loaded {len(raw)} users from {self.path}")
-                return raw
-        logger.info("No existing database found, starting with empty data")
-        return {}
-
-    def _save(self):
-        with open(self.path, "w") as f:
-            json.dump(self.data, f, indent=4)
-        logger.debug(f"Database saved to {self.path}")
+        return self.read_data(self.path)
+
+    @classmethod
+    def read_data(cls, path: str) -> Dict[str, UserData]:
+        """
+        The users a Database at `path` would load (snapshot plus logs),
+        read without creating, writing or compacting any file there.
+        """
+        data: Dict[str, UserData] = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+                logger.info(f"Loaded {len(data)} users from {path}")
+        else:
+            logger.info("No existing database found, starting with empty data")
+
+        # a log left over from an interrupted compaction comes before the live one
+        replayed = 0
+        for log_path in (path + ".log.old", path + ".log"):
+            for record in MutationLog.replay(log_path):
+                cls._apply(data, record)
+                replayed += 1
+        if replayed:
+            logger.info(f"Replayed {replayed} logged mutations")
+        return data
+
+    @staticmethod
+    def _apply(data: Dict[str, UserData], record: dict):
+        op, uname = record["op"], record["user"]
+        if op == "add_user":
+            data[uname] = record["data"]
+            return
+        user = data.get(uname)
+        if user is None:
+            return
+        sessions = user["sessions"]
+        if op == "update_embedding":
+            user["voice_emb"] = record["emb"]
+        elif op == "create_session":
+            sessions.setdefault(record["session"], {"name": record["name"], "messages": []})
+        elif op == "add_message":
+            session = sessions.get(record["session"])
+            # `index` makes the append idempotent
+            if session is not None and len(session["messages"]) == record["index"]:
+                session["messages"].append(record["msg"])
+        elif op == "delete_session":
+            sessions.pop(record["session"], None)
+        else:
+            raise ValueError(f"Unknown log record: {op}")
+
+    def _commit(self, record: dict) -> int:
+        """
+        Apply a mutation in memory and queue it on the log; the caller is inside
+        _writing, then passes the returned number to _settle after leaving it.
+        """
+        self._apply(self.data, record)
+        seq = self._log.append(record)
+        if self._log.size >= self.compact_bytes and not self._compacting.locked():
+            threading.Thread(target=self.compact, name="db-compact", daemon=True).start()
+        return seq
+
+    def _settle(self, seq: int):
+        if self.durable:
+            self._log.wait(seq)
+
+    ### locking ###
+    @contextmanager
+    def _locked_file(self, exclusive: bool = True) -> Iterator[None]:
+        """In shared mode, this process's turn at the cross-process lock; a no-op otherwise."""
+        if self._file_lock is None:
+            yield
+            return
+        with self._process_lock, self._file_lock.hold(exclusive):
+            yield
+
+    @contextmanager
+    def _writing(self, username: str) -> Iterator[None]:
+        """
+        Hold `username`'s lock for a check-then-commit. In shared mode, first
+        take the file lock and catch up, and write the record out before
+        releasing it. Locks are always taken file first, then user.
+        """
+        with self._locked_file():
+            if self.shared:
+                self._catch_up()
+            try:
+                with self._user_locks(username):
+                    yield
+            finally:
+                if self.shared:
+                    self._log.flush()
+                    self._log_offset = os.path.getsize(self.log_path)
+
+    def _refresh(self):
+        if not self.shared:
+            return
+        try:
+            st = os.stat(self.log_path)
+            if st.st_ino == self._log_inode and st.st_size == self._log_offset:
+                return
+        except FileNotFoundError:  # mid-rotation in another process
+            pass
+        with self._locked_file(exclusive=False):
+            self._catch_up()
+
+    def _catch_up(self):
+        """Apply what other processes logged since we last looked; the caller holds the file lock."""
+        st = os.stat(self.log_path)
+        if st.st_ino != self._log_inode:
+            # another process compacted: the snapshot now holds what we had read
+            self._log.reopen()
+            self.data = self._load()
+            for username, user in self.data.items():
+                self.embeddings.set(username, user["voice_emb"])
+            if self.ann is not None:
+                self.ann.sync(self.embeddings.usernames, self.embeddings.matrix())
+            self._log_inode, self._log_offset = st.st_ino, st.st_size
+            return
+        if st.st_size == self._log_offset:
+            return
+        records, self._log_offset = MutationLog.read_from(self.log_path, self._log_offset)
+        for record in records:
+            with self._user_locks(record["user"]):
+                self._apply(self.data, record)
+            if record["op"] == "add_user":
+                self._index_embedding(record["user"], record["data"]["voice_emb"])
+            elif record["op"] == "update_embedding":
+                self._index_embedding(record["user"], record["emb"])
+
+    def compact(self):
+        """
+        Write a snapshot of the current state and drop the log it covers.
+        The lock is held to rotate the log and copy the data, and again to
+        swap the files in, but not while the snapshot is serialised.
+        """
+        if not self._compacting.acquire(blocking=False):
+            return
+        try:
+            with self._compaction_turn() as ours:
+                if ours:
+                    self._compact()
+        finally:
+            self._compacting.release()
+
+    @contextmanager
+    def _compaction_turn(self) -> Iterator[bool]:
+        """Whether this process may compact now; in shared mode one process at a time."""
+        if self._compact_lock is None:
+            yield True
+            return
+        with self._compact_lock.try_hold() as ours:
+            yield ours
+
+    def _compact(self):
+        old_log = self.log_path + ".old"
+        with self._locked_file():
+            if self.shared:
+                self._catch_up()
+            # an .old log here was left by a crashed compaction, and rotating
+            # would overwrite it; snapshot first, all of it under the lock
+            stale = os.path.exists(old_log)
+            if not stale:
+                self._log.rotate(old_log)
+                self._log_inode, self._log_offset = self._log.inode(), os.path.getsize(self.log_path)
+            # everything in old_log is already applied in memory; a write that
+            # lands between users here is in the new log too, and replays harmlessly
+            snapshot = {}
+            for username, user in list(self.data.items()):
+                with self._user_locks(username):
+                    snapshot[username] = copy.deepcopy(user)
+            if stale:
+                self._write_snapshot(snapshot)
+                os.remove(old_log)
+                logger.warning(f"Folded {old_log} left by an interrupted compaction into {self.path}")
+                return
+        tmp = self._write_snapshot(snapshot, replace=False)
+        # other processes load snapshot + old log + log, so swap and drop together
+        with self._locked_file():
+            os.replace(tmp, self.path)
+            os.remove(old_log)
+        logger.debug(f"Database compacted to {self.path}")
+
+    def _write_snapshot(self, snapshot: Dict[str, UserData], replace: bool = True) -> str:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps(snapshot, indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        if replace:
+            os.replace(tmp, self.path)
+        return tmp
+
+    def close(self):
+        """Compact and close the log; call once on shutdown."""
+        self.compact()
+        self._log.close()
+        if self._file_lock is not None:
+            self._file_lock.close()
+            self._compact_lock.close()  # type: ignore
+        self.embeddings.close()
+        logger.info(f"Database closed at {self.path}")
 
     ### helpers ###
+    def _find_user(self, username: str) -> UserData:
+        """The user's record without refreshing; for use inside _writing."""
+        user = self.data.get(username)
+        if user is None:
+            logger.error(f"User not found: {username}")
+            raise ValueError("User not found")
+        return user
+
+    def _find_session(self, username: str, session_id: str) -> SessionData:
+        sessions = self._find_user(username)["sessions"]
+        if session_id not in sessions:
+            logger.error(f"Session not found for user={username}, session_id={session_id}")
+            raise ValueError("Session not found")
+        return sessions[session_id]
+
     def get_username(self, username: str, strict: bool = True) -> Optional[str]:
+        self._refresh()
         if username in self.data:
             return username
         logger.error(f"User not found: {username}")
@@ -57,6 +441,7 @@ class Database:
         return None
 
     def get_user(self, username: str, strict: bool = True) -> UserData:
+        self._refresh()
         user = self.data.get(username)
         if user is None:
             logger.error(f"User not found: {username}")
@@ -67,9 +452,6 @@ class Database:
 
     ### users ###
     def add_user(self, username: str, password: str, voice_emb: torch.Tensor):
-        if username in self.data:
-            raise ValueError("Username already exists")
-
         emb_list = voice_emb.squeeze().cpu().numpy().tolist()
         user: UserData = {
             "username": username,
@@ -77,51 +459,64 @@ class Database:
             "voice_emb": emb_list,
             "sessions": {}
         }
-        self.data[username] = user
-        self._save()
+        with self._writing(username):
+            if username in self.data:
+                raise ValueError("Username already exists")
+            seq = self._commit({"op": "add_user", "user": username, "data": user})
+            # in commit order, so the store and index never end up behind `data`
+            self._index_embedding(username, emb_list)
+        self._settle(seq)
         logger.info(f"User added: {username}")
 
+    def list_users(self) -> List[str]:
+        self._refresh()
+        return list(self.data.keys())
+
     def verify_password(self, username: str, password: str) -> bool:
         user = self.get_user(username)
         return user["password"] == password
 
     ### embedding ###
     def get_embedding(self, username: str, device="cpu"):
-        user = self.get_user(username)
-        return torch.tensor(user["voice_emb"], dtype=torch.float32, device=device)
+        """(192,) view into the embedding store, no per-call copy on CPU."""
+        uname = self.get_username(username)
+        return self.embeddings.tensor(uname, device) # type: ignore
 
     def update_embedding(self, username: str, new_emb: torch.Tensor):
-        uname = self.get_username(username)
-        self.data[uname]["voice_emb"] = new_emb.squeeze().cpu().numpy().tolist() # type: ignore
-        self._save()
+        emb_list = new_emb.squeeze().cpu().numpy().tolist()
+        with self._writing(username):
+            self._find_user(username)
+            seq = self._commit({"op": "update_embedding", "user": username, "emb": emb_list})
+            self._index_embedding(username, emb_list)
+        self._settle(seq)
 
     ### sessions ###
     def create_session(self, username: str, session_name: str) -> str:
-        uname = self.get_username(username)
         session_id = str(uuid.uuid4())
-        session: SessionData = {
-            "name": session_name,
-            "messages": list()
-        }
-        self.data[uname]["sessions"][session_id] = session # type: ignore
-        self._save()
+        with self._writing(username):
+            self._find_user(username)
+            seq = self._commit({"op": "create_session", "user": username, "session": session_id, "name": session_name})
+        self._settle(seq)
         return session_id
 
     def add_message(self, username: str, session_id: str, msg: ChatMessage):
-        user = self.get_user(username)
-        sessions = user["sessions"]
-        if session_id not in sessions:
-            raise ValueError("Session not found")
-        sessions[session_id]["messages"].append(msg)
-        self._save()
+        with self._writing(username):
+            index = len(self._find_session(username, session_id)["messages"])
+            seq = self._commit({"op": "add_message", "user": username, "session": session_id, "index": index, "msg": msg})
+        self._settle(seq)
 
     def get_session_messages(self, username: str, session_id: str) -> List[ChatMessage]:
-        user = self.get_user(username)
-        sessions = user["sessions"]
-        if session_id not in sessions:
-            raise ValueError("Session not found")
-        
-        return sessions[session_id]["messages"]
+        self._refresh()
+        return self._find_session(username, session_id)["messages"]
+
+    def get_messages_page(self, username: str, session_id: str, limit: int,
+                          before: Optional[int] = None, after: Optional[int] = None) -> MessagePage:
+        """One page of a session's messages, see page_bounds; cursors are message indices."""
+        self._refresh()
+        with self._user_locks(username):
+            messages = self._find_session(username, session_id)["messages"]
+            start, stop = page_bounds(len(messages), limit, before, after)
+            return {"start": start, "total": len(messages), "messages": messages[start:stop]}
 
     def list_sessions(self, username: str) -> List[str]:
         user = self.get_user(username)
@@ -132,25 +527,19 @@ class Database:
         Return a specific chat session by ID.
         Raises ValueError if not found.
         """
-        user = self.get_user(username)
-        sessions = user["sessions"]
-        if session_id not in sessions:
-            logger.error(f"Session not found for user={username}, session_id={session_id}")
-            raise ValueError("Session not found")
-        return sessions[session_id]
+        self._refresh()
+        return self._find_session(username, session_id)
 
     def delete_session(self, username: str, session_id: str):
         """
         Delete a specific chat session by ID.
         Raises ValueError if not found.
         """
-        uname = self.get_username(username)
-        user = self.get_user(uname) # type: ignore
-        sessions = user["sessions"]
-        if session_id not in sessions:
-            logger.error(f"Tried to delete non-existent session: user={username}, session_id={session_id}")
-            raise ValueError("Session not found")
-
-        del sessions[session_id]
-        self._save()
+        with self._writing(username):
+            sessions = self._find_user(username)["sessions"]
+            if session_id not in sessions:
+                logger.error(f"Tried to delete non-existent session: user={username}, session_id={session_id}")
+                raise ValueError("Session not found")
+            seq = self._commit({"op": "delete_session", "user": username, "session": session_id})
+        self._settle(seq)
         logger.info(f"Deleted session {session_id} for user {username}")
@@ -0,0 +1,217 @@
+import os
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+EMBEDDING_DIM = 192
+
+
+class EmbeddingStore:
+    """
+    Every user's voice embedding as one row of a contiguous float32 matrix,
+    with a username -> row index.
+
+    `tensor()` and `matrix()` return zero-copy views on CPU. For other
+    devices the whole matrix is copied once and reused until the next write.
+    Views read the live rows: a later `set` for a user is visible through a
+    view taken before it, so take a copy if you need a snapshot.
+
+    With `mmap_path` the matrix lives in a memory-mapped .npy file instead
+    of the heap. The file is a cache rebuilt from the database on startup,
+    not a source of truth. It belongs to one process: the store holds a
+    flock on `mmap_path + ".lock"` until `close`, and a second process
+    opening the same file raises RuntimeError instead of overwriting it.
+    """
+    def __init__(self, dim: int = EMBEDDING_DIM, capacity: int = 64,
+                 mmap_path: Optional[Union[str, Path]] = None):
+        self.dim = dim
+        self.mmap_path = Path(mmap_path) if mmap_path is not None else None
+        self._rows: Dict[str, int] = {}
+        self._names: List[str] = []
+        self._lock = threading.RLock()
+        self._device_cache: Dict[str, torch.Tensor] = {}
+        self._lock_fd: Optional[int] = None
+        if self.mmap_path is not None:
+            self._claim()
+        self._data = self._allocate(max(capacity, 1))
+        self._norms = np.zeros(self._data.shape[0], dtype=np.float32)
+
+    @classmethod
+    def open(cls, mmap_path: Union[str, Path], usernames: List[str]) -> "EmbeddingStore":
+        """
+        Reopen a memory-mapped store written earlier, `usernames` giving the
+        owner of each row in order. Rows are paged in on use, not read here.
+        """
+        store = cls(capacity=1)
+        store.mmap_path = Path(mmap_path)
+        store._claim()
+        try:
+            data = np.lib.format.open_memmap(mmap_path, mode="r+")
+            if data.shape[0] < len(usernames):
+                raise ValueError(f"{mmap_path} has {data.shape[0]} rows for {len(usernames)} users")
+        except BaseException:
+            store.close()
+            raise
+        store.dim = data.shape[1]
+        store._data = data
+        store._names = list(usernames)
+        store._rows = {name: i for i, name in enumerate(store._names)}
+        store._norms = None
+        return store
+
+    def _row_norms(self) -> np.ndarray:
+        # computed on first use after `open`, then kept up to date by `set`
+        if self._norms is None:
+            norms = np.zeros(self._data.shape[0], dtype=np.float32)
+            norms[:len(self._names)] = np.linalg.norm(self.matrix(), axis=1)
+            self._norms = norms
+        return self._norms
+
+    def _claim(self):
+        if fcntl is None:
+            return
+        self.mmap_path.parent.mkdir(parents=True, exist_ok=True)  # type: ignore
+        fd = os.open(f"{self.mmap_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(f"{self.mmap_path} is in use by another process; "
+                               f"each process needs its own embeddings file")
+        self._lock_fd = fd
+
+    def flush(self):
+        if isinstance(self._data, np.memmap):
+            self._data.flush()
+
+    def close(self):
+        """Flush and give up the mmap file; in-memory stores need no close."""
+        self.flush()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _allocate(self, capacity: int, path: Optional[Path] = None) -> np.ndarray:
+        if self.mmap_path is None:
+            return np.zeros((capacity, self.dim), dtype=np.float32)
+        path = path or self.mmap_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(capacity, self.dim))
+
+    def _grow(self):
+        capacity = self._data.shape[0] * 2
+        if self.mmap_path is None:
+            new = self._allocate(capacity)
+            new[:len(self._names)] = self.matrix()
+        else:
+            # build the bigger file next to the old one and swap it in, so views
+            # still mapping the old file stay valid
+            tmp = self.mmap_path.with_name(self.mmap_path.name + ".tmp")
+            new = self._allocate(capacity, tmp)
+            new[:len(self._names)] = self.matrix()
+            new.flush()
+            os.replace(tmp, self.mmap_path)
+        self._data = new
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:len(self._names)] = self._row_norms()[:len(self._names)]
+        self._norms = norms
+        logger.debug(f"Embedding store grown to {capacity} rows")
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, username: str) -> bool:
+        return username in self._rows
+
+    @property
+    def usernames(self) -> List[str]:
+        """Usernames in row order, so usernames[i] owns matrix()[i]."""
+        return list(self._names)
+
+    def _as_row(self, emb) -> np.ndarray:
+        if isinstance(emb, torch.Tensor):
+            emb = emb.detach().squeeze().cpu().numpy()
+        row = np.asarray(emb, dtype=np.float32).reshape(-1)
+        if row.shape[0] != self.dim:
+            raise ValueError(f"Expected a {self.dim}-dim embedding, got {row.shape[0]}")
+        return row
+
+    def set(self, username: str, emb):
+        """Insert or overwrite a user's embedding (tensor, array or list of floats)."""
+        row = self._as_row(emb)
+        with self._lock:
+            idx = self._rows.get(username)
+            if idx is None:
+                if len(self._names) == self._data.shape[0]:
+                    self._grow()
+                idx = len(self._names)
+                self._rows[username] = idx
+                self._names.append(username)
+            self._data[idx] = row
+            self._row_norms()[idx] = np.linalg.norm(row)
+            self._device_cache.clear()
+
+    def row(self, username: str) -> np.ndarray:
+        idx = self._rows.get(username)
+        if idx is None:
+            raise ValueError("User not found")
+        return self._data[idx]
+
+    def matrix(self) -> np.ndarray:
+        """(#users, dim) view over the filled rows."""
+        return self._data[:len(self._names)]
+
+    def _device_matrix(self, device) -> torch.Tensor:
+        key = str(device)
+        with self._lock:
+            cached = self._device_cache.get(key)
+            if cached is None or cached.shape[0] != len(self._names):
+                cached = torch.from_numpy(self.matrix()).to(device)
+                self._device_cache[key] = cached
+            return cached
+
+    def tensor(self, username: str, device="cpu") -> torch.Tensor:
+        """(dim,) embedding; a view of the store on CPU, of the cached device copy otherwise."""
+        if torch.device(device).type == "cpu":
+            return torch.from_numpy(self.row(username))
+        idx = self._rows.get(username)
+        if idx is None:
+            raise ValueError("User not found")
+        return self._device_matrix(device)[idx]
+
+    def matrix_tensor(self, device="cpu") -> torch.Tensor:
+        """(#users, dim) tensor of every embedding, rows ordered as `usernames`."""
+        if torch.device(device).type == "cpu":
+            return torch.from_numpy(self.matrix())
+        return self._device_matrix(device)
+
+    def search(self, query, k: int = 5, device="cpu") -> List[Tuple[str, float]]:
+        """
+        Exact top-k users by cosine similarity to `query`, best first, from
+        one matrix-vector product over every row.
+        """
+        with self._lock:
+            n = len(self._names)
+            if n == 0 or k <= 0:
+                return []
+            names = self._names[:n]
+            mat = self.matrix_tensor(device)
+            norms = torch.from_numpy(self._row_norms()[:n]).to(mat.device)
+
+        q = torch.as_tensor(query, dtype=torch.float32).reshape(-1).to(mat.device)
+        q = q / q.norm().clamp(min=1e-8)
+        scores = torch.mv(mat, q) / norms.clamp(min=1e-8)
+        top = torch.topk(scores, min(k, n))
+        return [(names[i], s) for i, s in zip(top.indices.tolist(), top.values.tolist())]
@@ -0,0 +1,73 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+
+class PoolBusyError(RuntimeError):
+    pass
+
+
+class InferencePool:
+    """
+    Bounded thread pool for blocking model calls made from async handlers.
+
+    `workers` calls run at once and up to `max_queue` more may wait; anything
+    beyond that is rejected with PoolBusyError instead of piling up. Torch
+    releases the GIL inside its kernels, so the event loop keeps serving I/O
+    while a forward pass runs.
+    """
+    def __init__(self, workers: int = 2, max_queue: int = 16, timeout: float = 30.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._lock = threading.Lock()
+        self._pending = 0
+        logger.info(f"Inference pool started: workers={workers}, max_queue={max_queue}, timeout={timeout}s")
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _admit(self):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                raise PoolBusyError("Inference queue is full")
+            self._pending += 1
+
+    def _release(self, _fut: Optional[Future] = None):
+        with self._lock:
+            self._pending -= 1
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        self._admit()
+        try:
+            fut = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        fut.add_done_callback(self._release)
+        return fut
+
+    async def wait(self, fut: "Future[T]", timeout: Optional[float] = None) -> T:
+        """
+        Await a concurrent future with the pool's timeout. A call that has not
+        started yet is cancelled on timeout; one already running finishes in
+        the background and keeps its slot until then.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+
+    async def run(self, fn: Callable[..., T], *args, timeout: Optional[float] = None, **kwargs) -> T:
+        return await self.wait(self.submit(fn, *args, **kwargs), timeout)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+        logger.info("Inference pool shut down")
@@ -1,12 +1,12 @@
 import torch
 import torch.nn.functional as F
 import numpy as np
-from fastapi import UploadFile
 import json
 from pathlib import Path
-from typing import Literal
+from typing import Callable, List, Literal, NamedTuple, Optional, Sequence
 
-from src.voice_ultils import _load_any_format
+from src.voice_ultils import DecodedAudio
+from src.ultils_logger import get_logger
 
 # import get_model from your script
 from src.aasist.main import get_model
@@ -15,32 +15,131 @@ BASE_DIR = Path(__file__).resolve().parent
 CONFIG_PATH = BASE_DIR / "aasist" / "config" / "AASIST.conf"
 WEIGHT_PATH = BASE_DIR.parent / "assets" / "assist_best_model_epoch8_20251012_052209.pt"
 
+# name -> (config, weights) of the spoof models that can be served
+SPOOF_MODELS = {
+    "AASIST": (CONFIG_PATH, WEIGHT_PATH),
+    "AASIST-L": (BASE_DIR / "aasist" / "config" / "AASIST-L.conf",
+                 BASE_DIR / "aasist" / "models" / "weights" / "AASIST-L.pth"),
+}
+
+logger = get_logger(__name__)
+
 # --- Load config ---
 with open(CONFIG_PATH, "r") as f:
     config = json.load(f)
 model_config = config["model_config"]
 print(model_config)
 
+NB_SAMP = model_config["nb_samp"]
+BONAFIDE_THRESHOLD = 0.5
+
 def get_assist_model(device):
+    return load_spoof_model("AASIST", device)
+
+def load_spoof_model(name: str, device):
+    if name not in SPOOF_MODELS:
+        raise ValueError(f"Unknown spoof model: {name}")
+    config_path, weight_path = SPOOF_MODELS[name]
+    with open(config_path, "r") as f:
+        cfg = json.load(f)["model_config"]
+    if cfg["nb_samp"] != NB_SAMP:
+        raise ValueError(f"{name} expects {cfg['nb_samp']}-sample windows, serving uses {NB_SAMP}")
+
     # --- Build model ---
-    assist_model = get_model(model_config, device) # type: ignore
+    spoof_model = get_model(cfg, device) # type: ignore
 
     # --- Load weights ---
-    state_dict = torch.load(WEIGHT_PATH, map_location=device)
-    assist_model.load_state_dict(state_dict, strict=True)
+    state_dict = torch.load(weight_path, map_location=device)
+    spoof_model.load_state_dict(state_dict, strict=True)
 
-    assist_model.eval()
-    return assist_model
+    spoof_model.eval()
+    return spoof_model
 
-def infer_assist(model, file: UploadFile, device) -> Literal["bonafide", "spoofed"]:
-    audio, sr = _load_any_format(file)
-    if len(audio.shape) > 1:
-        audio = np.mean(audio, axis=1)
-    audio = torch.FloatTensor(audio).to(device).unsqueeze(0)
+def infer_assist(model, audio: DecodedAudio, device) -> Literal["bonafide", "spoofed"]:
+    audio = audio.tensor(device)
     model.eval()
     with torch.no_grad():
         emb, logits = model(audio)
         probs = F.softmax(logits, dim=1)
         score = probs[:, 1].item()
-        pred = int(score >= 0.5)
-    return "bonafide" if pred == 1 else "spoofed"
\ No newline at end of file
+        pred = int(score >= BONAFIDE_THRESHOLD)
+    return "bonafide" if pred == 1 else "spoofed"
+
+### fixed-window mode ###
+def assist_decision(score: float) -> Literal["bonafide", "spoofed"]:
+    return "bonafide" if score >= BONAFIDE_THRESHOLD else "spoofed"
+
+def split_windows(samples: np.ndarray, nb_samp: int = NB_SAMP, hop: Optional[int] = None,
+                  max_windows: int = 4) -> np.ndarray:
+    """
+    Cut a clip into (#win, nb_samp) windows. Short clips are tiled up to
+    nb_samp as in AASIST training; long ones get windows every `hop` samples
+    (default nb_samp, no overlap), the last aligned to the clip end, and at
+    most `max_windows` of them spread evenly over the clip.
+    """
+    n = samples.shape[0]
+    if n == 0:
+        # silence, so one bad clip can't break the concatenated batch
+        return np.zeros((1, nb_samp), dtype=np.float32)
+    if n <= nb_samp:
+        reps = nb_samp // max(n, 1) + 1
+        return np.tile(samples, reps)[:nb_samp][None, :]
+
+    hop = hop or nb_samp
+    starts = list(range(0, n - nb_samp + 1, hop))
+    if starts[-1] != n - nb_samp:
+        starts.append(n - nb_samp)
+    if len(starts) > max_windows:
+        pick = np.linspace(0, len(starts) - 1, max_windows).round().astype(int)
+        starts = [starts[i] for i in pick]
+    return np.stack([samples[s:s + nb_samp] for s in starts])
+
+def assist_score_batch(model, audios: List[DecodedAudio], device, hop: Optional[int] = None,
+                       max_windows: int = 4) -> List[float]:
+    """
+    Bonafide probability per clip. The windows of every clip go through the
+    model as one fixed-shape batch and are averaged back per clip.
+    """
+    windows = [split_windows(a.samples, NB_SAMP, hop, max_windows) for a in audios]
+    counts = [w.shape[0] for w in windows]
+    batch = torch.from_numpy(np.concatenate(windows)).to(device)
+
+    with torch.no_grad():
+        _, logits = model(batch)
+        probs = F.softmax(logits, dim=1)[:, 1]
+
+    return [chunk.mean().item() for chunk in torch.split(probs, counts)]
+
+def infer_assist_windowed(model, audio: DecodedAudio, device, hop: Optional[int] = None,
+                          max_windows: int = 4) -> Literal["bonafide", "spoofed"]:
+    score = assist_score_batch(model, [audio], device, hop, max_windows)[0]
+    return assist_decision(score)
+
+### cascade ###
+class SpoofStage(NamedTuple):
+    model: Callable
+    max_windows: int
+    low: float = 0.0   # bonafide probability below this is a confident spoof
+    high: float = 1.0  # at or above this is a confident bonafide
+
+def cascade_score_batch(stages: Sequence[SpoofStage], audios: List[DecodedAudio], device,
+                        hop: Optional[int] = None) -> List[float]:
+    """
+    Bonafide probability per clip from a chain of models, cheapest first.
+    A clip whose score lands in a stage's uncertain band [low, high) goes on
+    to the next stage; otherwise that score is final. The last stage's band
+    is ignored.
+    """
+    scores = [0.0] * len(audios)
+    pending = list(range(len(audios)))
+    for depth, stage in enumerate(stages):
+        out = assist_score_batch(stage.model, [audios[i] for i in pending], device, hop, stage.max_windows)
+        for i, score in zip(pending, out):
+            scores[i] = score
+        if depth == len(stages) - 1:
+            break
+        pending = [i for i, score in zip(pending, out) if stage.low <= score < stage.high]
+        logger.debug(f"Spoof cascade stage {depth}: {len(out)} scored, {len(pending)} escalated")
+        if not pending:
+            break
+    return scores
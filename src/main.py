@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 
 import torch
@@ -6,33 +8,177 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from src.ultils_logger import get_logger
 from src.database import Database
-from src.voice_model import ECAPA_TDNN
-from src.load_assist import get_assist_model
-from src.voice_ultils import load_parameters
+from src.sqlite_database import SQLiteDatabase, migrate_json
+from src.sharded_database import ShardedDatabase, migrate_json as migrate_sharded
+from src.voice_model import ECAPA_TDNN, ECAPA_TDNN_Fused
+from src.load_assist import get_assist_model, load_spoof_model, assist_score_batch, cascade_score_batch, SpoofStage, NB_SAMP
+from src.voice_ultils import load_parameters, embed_batch
+from src.voice_decoder import init_ffmpeg_pool
+from src.inference_pool import InferencePool
+from src.quantization import quantize_ecapa, quantize_assist, calibration_clips
+from src.onnx_backend import OnnxEcapa, OnnxAssist, ECAPA_FILE, ASSIST_FILE
+from src.batching import MicroBatcher
+from src.chats_n8n import N8nClient
+from src.voice_jobs import VoiceJobQueue
 from src import router_voice, router_chats
 
 logger = get_logger(__name__)
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_PATH = BASE_DIR / "data" / "database.json"
+DB_BACKEND = "json"  # "json" | "sqlite" | "sharded"; sqlite and sharded are migrated from DATA_PATH on first start
+SQLITE_PATH = BASE_DIR / "data" / "database.sqlite3"
+SHARDED_PATH = BASE_DIR / "data" / "users"  # one file per user, loaded on first access
+SHARDED_CACHE_USERS = 1024  # user records kept in memory by the sharded backend
+DB_FLUSH_INTERVAL = 0.05  # seconds the json backend gathers writes into one batched write + fsync
+DB_DURABLE = False  # reply only once a write is on disk (json: waits for its batch; sqlite: synchronous=FULL)
+DB_SHARED = False  # json backend: let `uvicorn --workers N` processes share DATA_PATH (POSIX file locks)
+ANN_INDEX = True  # IVF index for /voice/identify, kept next to DATA_PATH; exact search until it has enough users
+EMBEDDINGS_MMAP_PATH = None  # e.g. BASE_DIR / "data" / "embeddings.npy" to keep the embedding matrix off the heap; one process only
 WEIGHT_PATH = BASE_DIR / "assets" / "best_model_epoch9_20251001_064344.pt"
+ONNX_DIR = BASE_DIR / "assets" / "onnx"  # written by `python -m src.onnx_backend`
 
 THRESHOLD = 0.8
+BACKEND = "torch"  # "torch" | "onnx" (onnxruntime on CPU, graphs from ONNX_DIR)
+ONNX_THREADS = 0  # intra-op threads per onnxruntime session, 0 = onnxruntime default
+ECAPA_FUSED = True  # serve the folded, eval-only ECAPA_TDNN_Fused
+PRECISION = "fp32"  # "fp32" | "int8-dynamic" | "int8-static" (CPU only), see `python -m src.quantization`
+FFMPEG_WORKERS = 2  # pre-spawned ffmpeg decoders for formats PyAV/soundfile can't read
+INFERENCE_WORKERS = 2  # concurrent decode/model calls
+INFERENCE_MAX_QUEUE = 16  # calls allowed to wait for a worker before returning 503
+INFERENCE_TIMEOUT = 30.0  # seconds per call before returning 504
+EMBED_BATCHING = True  # group concurrent ECAPA requests into padded batches
+EMBED_MAX_BATCH = 8
+EMBED_MAX_WAIT_MS = 10.0
+SPOOF_WINDOWED = True  # score fixed nb_samp windows in batches instead of the whole clip
+SPOOF_WINDOW_HOP = NB_SAMP // 2
+SPOOF_MAX_WINDOWS = 4  # per clip
+SPOOF_MAX_BATCH = 8  # clips per batched forward pass
+SPOOF_MAX_WAIT_MS = 10.0
+SPOOF_CASCADE = False  # score with a light model first, only its uncertain clips go on to AASIST
+SPOOF_CASCADE_MODEL = "AASIST-L"  # key of load_assist.SPOOF_MODELS
+SPOOF_CASCADE_WINDOWS = 1  # windows per clip for the light model
+SPOOF_CASCADE_BAND = (0.05, 0.95)  # light-model bonafide probabilities in [low, high) are escalated
+# N8N_WEBHOOK_URL = "https://somebigguy.app.n8n.cloud/webhook-test/0e2eee96-5d66-4697-9839-c5c1e1613105"  # example URL
+N8N_WEBHOOK_URL = "https://somebigguy.app.n8n.cloud/webhook/0e2eee96-5d66-4697-9839-c5c1e1613105"  # example URL
+N8N_STREAM_WEBHOOK_URL = N8N_WEBHOOK_URL  # for /chats/send-stream; a workflow with response mode "Streaming"
+N8N_MAX_CONNECTIONS = 32  # concurrent requests to n8n; more wait for a free connection
+N8N_POOL_TIMEOUT = 10.0  # seconds to wait for a free connection before returning 503
+N8N_TIMEOUT = 30.0  # seconds for a text reply before returning 504
+N8N_VOICE_TIMEOUT = 60.0  # seconds for a transcription + reply
+N8N_MAX_VOICE_BYTES = 25 * 2**20  # voice messages over this return 413
+VOICE_JOBS = not DB_SHARED  # /chats/send-voice-job; jobs live in one process, so off (503) with `--workers N`
+VOICE_JOB_WORKERS = 4  # concurrent n8n calls for /chats/send-voice-job
+VOICE_JOB_MAX_QUEUE = 64  # jobs allowed to wait before returning 503
+VOICE_JOB_TTL = 3600.0  # seconds a finished job stays pollable
+VOICE_JOB_LOG = BASE_DIR / "data" / "voice_jobs.log"  # job states, so queued jobs survive a restart
+VOICE_JOB_SPOOL = BASE_DIR / "data" / "voice_jobs"  # uploads waiting for a worker
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
 # Load model
-logger.info(f"Loading model on {device}")
-model = ECAPA_TDNN(C=1024).to(device)
-load_parameters(model, WEIGHT_PATH, device)
-model.eval()
-assist_model = get_assist_model(device)
+if BACKEND == "onnx":
+    if PRECISION != "fp32" or not SPOOF_WINDOWED:
+        raise ValueError("The onnx backend needs PRECISION = 'fp32' and SPOOF_WINDOWED = True")
+    device = "cpu"
+    logger.info(f"Loading ONNX models from {ONNX_DIR}")
+    model = OnnxEcapa(ONNX_DIR / ECAPA_FILE, ONNX_THREADS)
+    assist_model = OnnxAssist(ONNX_DIR / ASSIST_FILE, ONNX_THREADS)
+elif BACKEND == "torch":
+    logger.info(f"Loading model on {device}")
+    model = ECAPA_TDNN(C=1024).to(device)
+    load_parameters(model, WEIGHT_PATH, device)
+    model.eval()
+    if ECAPA_FUSED:
+        model = ECAPA_TDNN_Fused(model)
+    assist_model = get_assist_model(device)
+else:
+    raise ValueError(f"Unknown backend: {BACKEND}")
+cascade_model = None
+if SPOOF_CASCADE:
+    if not SPOOF_WINDOWED:
+        raise ValueError("SPOOF_CASCADE needs SPOOF_WINDOWED = True")
+    cascade_model = load_spoof_model(SPOOF_CASCADE_MODEL, device)
+if PRECISION != "fp32":
+    if device != "cpu":
+        raise ValueError(f"{PRECISION} inference is CPU-only, running on {device}")
+    clips = calibration_clips() if PRECISION == "int8-static" else []
+    model = quantize_ecapa(model, PRECISION, clips)
+    assist_model = quantize_assist(assist_model, PRECISION, clips)
+    if cascade_model is not None:
+        cascade_model = quantize_assist(cascade_model, PRECISION, clips)
+    logger.info(f"Models quantized to {PRECISION}")
 logger.info("Model loaded and set to eval mode")
 
+init_ffmpeg_pool(FFMPEG_WORKERS)
+inference_pool = InferencePool(INFERENCE_WORKERS, INFERENCE_MAX_QUEUE, INFERENCE_TIMEOUT)
+embed_batcher = MicroBatcher(
+    partial(embed_batch, model, device=device),
+    max_batch=EMBED_MAX_BATCH,
+    max_wait_ms=EMBED_MAX_WAIT_MS,
+    max_queue=INFERENCE_MAX_QUEUE,
+    name="ecapa-batcher",
+) if EMBED_BATCHING else None
+if SPOOF_CASCADE:
+    low, high = SPOOF_CASCADE_BAND
+    if not 0.0 <= low <= high <= 1.0:
+        raise ValueError(f"Invalid SPOOF_CASCADE_BAND: {SPOOF_CASCADE_BAND}")
+    spoof_stages = [
+        SpoofStage(cascade_model, SPOOF_CASCADE_WINDOWS, low, high),
+        SpoofStage(assist_model, SPOOF_MAX_WINDOWS),
+    ]
+    score_spoof = partial(cascade_score_batch, spoof_stages, device=device, hop=SPOOF_WINDOW_HOP)
+else:
+    score_spoof = partial(assist_score_batch, assist_model, device=device, hop=SPOOF_WINDOW_HOP,
+                          max_windows=SPOOF_MAX_WINDOWS)
+spoof_batcher = MicroBatcher(
+    score_spoof,
+    max_batch=SPOOF_MAX_BATCH,
+    max_wait_ms=SPOOF_MAX_WAIT_MS,
+    max_queue=INFERENCE_MAX_QUEUE,
+    name="aasist-batcher",
+) if SPOOF_WINDOWED else None
+
 # Initialize database
-db = Database(str(DATA_PATH))
+if DB_BACKEND == "sqlite":
+    if not SQLITE_PATH.exists() and DATA_PATH.exists():
+        migrate_json(str(DATA_PATH), str(SQLITE_PATH))
+    db = SQLiteDatabase(str(SQLITE_PATH), EMBEDDINGS_MMAP_PATH, ANN_INDEX, durable=DB_DURABLE)
+elif DB_BACKEND == "sharded":
+    if not (SHARDED_PATH / "users.log").exists() and DATA_PATH.exists():
+        migrate_sharded(str(DATA_PATH), str(SHARDED_PATH))
+    db = ShardedDatabase(str(SHARDED_PATH), ANN_INDEX, SHARDED_CACHE_USERS)
+elif DB_BACKEND == "json":
+    db = Database(str(DATA_PATH), EMBEDDINGS_MMAP_PATH, ANN_INDEX, fsync_interval=DB_FLUSH_INTERVAL,
+                  durable=DB_DURABLE, shared=DB_SHARED)
+else:
+    raise ValueError(f"Unknown database backend: {DB_BACKEND}")
+
+n8n_client = N8nClient(N8N_WEBHOOK_URL, max_connections=N8N_MAX_CONNECTIONS, timeout=N8N_TIMEOUT,
+                       voice_timeout=N8N_VOICE_TIMEOUT, pool_timeout=N8N_POOL_TIMEOUT,
+                       max_upload_bytes=N8N_MAX_VOICE_BYTES, stream_url=N8N_STREAM_WEBHOOK_URL)
+# a second process on VOICE_JOB_LOG fails to start here rather than rerun the first one's jobs
+voice_jobs = VoiceJobQueue(str(VOICE_JOB_LOG), str(VOICE_JOB_SPOOL), workers=VOICE_JOB_WORKERS,
+                           max_queue=VOICE_JOB_MAX_QUEUE, ttl=VOICE_JOB_TTL) if VOICE_JOBS else None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if voice_jobs is not None:
+        voice_jobs.start()
+    yield
+    if voice_jobs is not None:
+        await voice_jobs.close()
+    for batcher in (embed_batcher, spoof_batcher):
+        if batcher is not None:
+            batcher.close()
+    inference_pool.shutdown()
+    await n8n_client.aclose()
+    db.save_index()
+    db.close()
+
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # CORS for frontend
 app.add_middleware(
@@ -52,11 +198,10 @@ async def root():
     return {"status": "running"}
 
 # Register routers
-router_voice.init_voice_router(db, model, assist_model, device, THRESHOLD)
+router_voice.init_voice_router(db, model, assist_model, device, THRESHOLD, inference_pool, embed_batcher,
+                               spoof_batcher)
 
-# N8N_WEBHOOK_URL = "https://somebigguy.app.n8n.cloud/webhook-test/0e2eee96-5d66-4697-9839-c5c1e1613105"  # example URL
-N8N_WEBHOOK_URL = "https://somebigguy.app.n8n.cloud/webhook/0e2eee96-5d66-4697-9839-c5c1e1613105"  # example URL
-router_chats.init_chat_router(db, N8N_WEBHOOK_URL)
+router_chats.init_chat_router(db, n8n_client, voice_jobs)
 
 app.include_router(
     router_voice.router,
@@ -0,0 +1,191 @@
+import json
+import os
+import threading
+from typing import Iterator, List, Optional, Tuple
+
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class MutationLog:
+    """
+    Append-only JSON-lines log of database mutations, written behind.
+
+    `append` queues the record in memory and returns its sequence number.
+    A background thread writes what has queued as one write and one fsync,
+    `fsync_interval` seconds after the first record of a batch, or sooner
+    once `max_batch_bytes` are waiting. Appends never wait for the disk, so
+    a crash can lose the last interval. A caller that must not lose a
+    record passes its sequence number to `wait`, which returns once the
+    batch holding it is fsynced; concurrent waiters share that fsync.
+    With `fsync_interval=0` every append is written and synced before it
+    returns.
+    """
+    def __init__(self, path: str, fsync_interval: float = 0.05, max_batch_bytes: int = 2**20):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.max_batch_bytes = max_batch_bytes
+        self._lock = threading.Lock()     # queue and sequence numbers
+        self._io_lock = threading.Lock()  # the file; held across write + fsync
+        self._durable_cond = threading.Condition()
+        self._file = open(path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+        if self._size and self._torn(path):
+            # end the line a crash cut short, or the next record would be glued onto it
+            self._file.write("\n")
+            self._file.flush()
+            self._size += 1
+        self._pending: List[str] = []
+        self._pending_bytes = 0
+        self._seq = 0
+        self._durable = 0
+        self._dirty = threading.Event()
+        self._full = threading.Event()
+        self._closed = False
+        self._syncer: Optional[threading.Thread] = None
+        if fsync_interval > 0:
+            self._syncer = threading.Thread(target=self._sync_loop, name="db-log-fsync", daemon=True)
+            self._syncer.start()
+
+    @property
+    def size(self) -> int:
+        """Bytes in the log, counting records not yet written."""
+        return self._size + self._pending_bytes
+
+    def append(self, record: dict) -> int:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        if self.fsync_interval <= 0:
+            with self._io_lock:
+                with self._lock:
+                    self._seq += 1
+                    self._pending.append(line)
+                    self._pending_bytes += len(line)
+                return self._write_pending()
+        with self._lock:
+            self._seq += 1
+            self._pending.append(line)
+            self._pending_bytes += len(line)
+            if self._pending_bytes >= self.max_batch_bytes:
+                self._full.set()
+            self._dirty.set()
+            return self._seq
+
+    def _write_pending(self, fsync: bool = True) -> int:
+        """Write (and fsync) everything queued; the caller holds self._io_lock."""
+        with self._lock:
+            lines, self._pending = self._pending, []
+            written, self._pending_bytes = self._pending_bytes, 0
+            seq = self._seq
+            if fsync:
+                self._dirty.clear()
+                self._full.clear()
+        if not self._file.closed:
+            if lines:
+                self._file.write("".join(lines))
+                self._size += written
+            self._file.flush()
+            if fsync:
+                os.fsync(self._file.fileno())
+        if fsync:
+            with self._durable_cond:
+                self._durable = max(self._durable, seq)
+                self._durable_cond.notify_all()
+        return seq
+
+    def flush(self):
+        """Write queued records to the file now, so other processes can read them; fsync stays batched."""
+        with self._io_lock:
+            self._write_pending(fsync=False)
+            self._size = self._file.tell()  # other processes append too
+
+    def sync(self) -> int:
+        """Write and fsync everything appended so far; returns the last durable sequence number."""
+        with self._io_lock:
+            return self._write_pending()
+
+    def wait(self, seq: int):
+        """Block until record `seq` (as returned by append) is fsynced."""
+        with self._durable_cond:
+            if self._durable < seq:
+                self._full.set()  # someone is waiting: don't sit out the interval
+                self._durable_cond.wait_for(lambda: self._durable >= seq or self._closed)
+
+    def _sync_loop(self):
+        # checked before each wait: sync() clears the event close() sets
+        while not self._closed:
+            self._dirty.wait()
+            if self._closed:
+                return
+            # appends until the interval ends (or the batch fills) share one write + fsync
+            self._full.wait(self.fsync_interval)
+            self.sync()
+
+    def rotate(self, old_path: str):
+        """Sync and move the current log to `old_path`, then continue in a fresh file."""
+        with self._io_lock:
+            self._write_pending()
+            self._file.close()
+            os.replace(self.path, old_path)
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._size = 0
+
+    def reopen(self):
+        """Continue in whatever file is at `path` now, after another process rotated the log."""
+        with self._io_lock:
+            self._write_pending()
+            self._file.close()
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._size = self._file.tell()
+
+    def inode(self) -> int:
+        return os.fstat(self._file.fileno()).st_ino
+
+    def close(self):
+        self.sync()
+        self._closed = True
+        self._dirty.set()
+        self._full.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        with self._io_lock:
+            self._write_pending()
+            self._file.close()
+        with self._durable_cond:
+            self._durable_cond.notify_all()
+
+    @staticmethod
+    def _torn(path: str) -> bool:
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) != b"\n"
+
+    @staticmethod
+    def replay(path: str) -> Iterator[dict]:
+        """Records of the log at `path` in order; a torn final line is skipped."""
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable record at {path}:{lineno}")
+
+    @staticmethod
+    def read_from(path: str, offset: int) -> Tuple[List[dict], int]:
+        """Records that complete lines after byte `offset`, and the offset past the last one."""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        records = []
+        for line in data[:end].splitlines():
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable record in {path} after offset {offset}")
+        return records, offset + end
@@ -0,0 +1,62 @@
+"""
+Local stand-in for the n8n chat webhook, for running the chat routes
+without n8n. Point N8N_WEBHOOK_URL at it and start it with:
+
+    N8N_STUB_DELAY=2 uvicorn src.n8n_stub:app --port 5678
+
+It answers on /webhook. JSON bodies ({username, message, session_id}) get
+{"reply"}; multipart bodies with a `file` get {"transcript", "reply"}.
+N8N_STUB_DELAY seconds of sleep per call stand in for the LLM.
+
+/webhook/stream answers JSON bodies the way a streaming n8n workflow
+does, one JSON record per line (begin, an item per word, end), with
+N8N_STUB_TOKEN_DELAY seconds between words.
+"""
+import asyncio
+import json
+import os
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+DELAY = float(os.environ.get("N8N_STUB_DELAY", "0"))
+TOKEN_DELAY = float(os.environ.get("N8N_STUB_TOKEN_DELAY", "0.05"))
+
+app = FastAPI()
+
+
+@app.post("/webhook")
+async def webhook(request: Request):
+    await asyncio.sleep(DELAY)
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        audio = await form["file"].read()  # type: ignore
+        logger.info(f"Stub n8n got {len(audio)} bytes of voice from {form.get('username')}")
+        transcript = f"({len(audio)} bytes of audio)"
+        return {"transcript": transcript, "reply": f"echo: {transcript}"}
+
+    body = await request.json()
+    logger.info(f"Stub n8n got message from {body.get('username')}")
+    return {"reply": f"echo: {body.get('message', '')}"}
+
+
+@app.post("/webhook/stream")
+async def webhook_stream(request: Request):
+    body = await request.json()
+    logger.info(f"Stub n8n streaming reply to {body.get('username')}")
+
+    async def records():
+        yield json.dumps({"type": "begin"}) + "\n"
+        await asyncio.sleep(DELAY)
+        words = f"echo: {body.get('message', '')}".split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(TOKEN_DELAY)
+            content = word if i == 0 else " " + word
+            yield json.dumps({"type": "item", "content": content}) + "\n"
+        yield json.dumps({"type": "end"}) + "\n"
+
+    return StreamingResponse(records(), media_type="application/json")
@@ -0,0 +1,201 @@
+"""
+ONNX export and onnxruntime inference for ECAPA_TDNN and the AASIST Model.
+
+Export (writes ecapa_tdnn.onnx and aasist.onnx):
+
+    python -m src.onnx_backend --out-dir assets/onnx
+
+- ECAPA_TDNN takes (audio, lengths), both with dynamic batch and time
+  axes, and includes the fbank front end. torch.stft has no ONNX export,
+  so the STFT is written as a conv with windowed DFT kernels.
+- AASIST takes fixed nb_samp windows with a dynamic batch axis, matching
+  the windowed spoof scoring in load_assist. Its graph pooling keeps
+  int(#node * ratio) nodes, which is fixed at export time, so the time
+  axis can't be dynamic.
+
+OnnxEcapa and OnnxAssist are called the same way as the torch modules, so
+get_embedding, embed_batch and assist_score_batch work unchanged.
+"""
+import argparse
+import copy
+import math
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from src.ultils_logger import get_logger
+
+try:
+    import onnxruntime as ort
+except ImportError:  # only needed for BACKEND = "onnx"
+    ort = None
+
+logger = get_logger(__name__)
+
+OPSET = 17
+ECAPA_FILE = "ecapa_tdnn.onnx"
+ASSIST_FILE = "aasist.onnx"
+
+
+### export ###
+class ConvMelSpectrogram(nn.Module):
+    """
+    Same output as the torchaudio MelSpectrogram in ECAPA_TDNN.torchfbank
+    (centered, reflect-padded power spectrogram -> mel filterbank), with the
+    STFT computed by a strided conv with windowed cos/sin kernels.
+    """
+    def __init__(self, mel):
+        super().__init__()
+        spec = mel.spectrogram
+        if not spec.center or spec.pad_mode != "reflect" or spec.normalized or spec.power != 2.0:
+            raise ValueError("Unsupported spectrogram configuration for ONNX export")
+
+        n_fft = spec.n_fft
+        self.hop = spec.hop_length
+        self.pad = n_fft // 2
+
+        window = torch.zeros(n_fft)
+        left = (n_fft - spec.win_length) // 2
+        window[left:left + spec.win_length] = spec.window.float()
+        n = torch.arange(n_fft, dtype=torch.float64)
+        k = torch.arange(n_fft // 2 + 1, dtype=torch.float64).unsqueeze(1)
+        angle = 2 * math.pi * k * n / n_fft
+        kernels = torch.cat((torch.cos(angle), -torch.sin(angle)), dim=0).float() * window
+        self.register_buffer("kernels", kernels.unsqueeze(1))
+        self.register_buffer("fb", mel.mel_scale.fb.clone())
+        self.n_bins = n_fft // 2 + 1
+
+    def forward(self, x):
+        x = F.pad(x.unsqueeze(1), (self.pad, self.pad), mode="reflect")
+        spec = F.conv1d(x, self.kernels, stride=self.hop)
+        power = spec[:, :self.n_bins] ** 2 + spec[:, self.n_bins:] ** 2
+        return torch.matmul(power.transpose(1, 2), self.fb).transpose(1, 2)
+
+
+class _EcapaGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = copy.deepcopy(model)
+        self.model.torchfbank = nn.Sequential(
+            self.model.torchfbank[0],
+            ConvMelSpectrogram(self.model.torchfbank[1]),
+        )
+
+    def forward(self, audio, lengths):
+        return self.model(audio, False, lengths=lengths)
+
+
+def export_ecapa(model, path, sample_len: int = 32000):
+    graph = _EcapaGraph(model.cpu()).eval()
+    audio = torch.randn(2, sample_len)
+    lengths = torch.tensor([sample_len, sample_len * 3 // 4])
+    torch.onnx.export(
+        graph, (audio, lengths), str(path),
+        input_names=["audio", "lengths"], output_names=["embedding"],
+        dynamic_axes={"audio": {0: "batch", 1: "samples"}, "lengths": {0: "batch"}, "embedding": {0: "batch"}},
+        opset_version=OPSET, dynamo=False,
+    )
+    logger.info(f"ECAPA_TDNN exported to {path}")
+
+
+class _AssistGraph(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, audio):
+        return self.model(audio)
+
+
+def export_assist(model, path, nb_samp: int):
+    # the exporter restores the wrapper's train/eval mode afterwards, and that
+    # propagates to the wrapped model, so the wrapper itself has to be in eval
+    graph = _AssistGraph(model.cpu()).eval()
+    audio = torch.randn(2, nb_samp)
+    torch.onnx.export(
+        graph, (audio,), str(path),
+        input_names=["audio"], output_names=["hidden", "logits"],
+        dynamic_axes={"audio": {0: "batch"}, "hidden": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=OPSET, dynamo=False,
+    )
+    logger.info(f"AASIST exported to {path}")
+
+
+### runtime ###
+def _session(path, threads: int = 0):
+    if ort is None:
+        raise RuntimeError("onnxruntime is not installed")
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.intra_op_num_threads = threads
+    opts.inter_op_num_threads = 1
+    return ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+class OnnxEcapa:
+    """Drop-in for ECAPA_TDNN at inference: model(audio, aug, lengths=None) -> (#bs, 192)."""
+    def __init__(self, path, threads: int = 0):
+        self.session = _session(path, threads)
+        logger.info(f"Loaded ONNX ECAPA_TDNN from {path}")
+
+    def eval(self):
+        return self
+
+    def __call__(self, x, aug=False, lengths=None):
+        if aug:
+            raise ValueError("OnnxEcapa is inference-only")
+        audio = x.detach().cpu().float().numpy()
+        if lengths is None:
+            lengths = np.full(audio.shape[0], audio.shape[1], dtype=np.int64)
+        else:
+            lengths = lengths.detach().cpu().numpy().astype(np.int64)
+        emb, = self.session.run(None, {"audio": audio, "lengths": lengths})
+        return torch.from_numpy(emb).to(x.device)
+
+
+class OnnxAssist:
+    """Drop-in for the AASIST Model on nb_samp windows: model(audio) -> (hidden, logits)."""
+    def __init__(self, path, threads: int = 0):
+        self.session = _session(path, threads)
+        self.nb_samp = self.session.get_inputs()[0].shape[1]
+        logger.info(f"Loaded ONNX AASIST from {path} (nb_samp={self.nb_samp})")
+
+    def eval(self):
+        return self
+
+    def __call__(self, x, Freq_aug=False):
+        if x.shape[1] != self.nb_samp:
+            raise ValueError(f"ONNX AASIST expects {self.nb_samp}-sample windows, got {x.shape[1]}")
+        hidden, logits = self.session.run(None, {"audio": x.detach().cpu().float().numpy()})
+        return torch.from_numpy(hidden).to(x.device), torch.from_numpy(logits).to(x.device)
+
+
+def main():
+    from src.voice_model import ECAPA_TDNN, ECAPA_TDNN_Fused
+    from src.voice_ultils import load_parameters
+    from src.load_assist import get_assist_model, NB_SAMP
+
+    base_dir = Path(__file__).resolve().parent.parent
+    parser = argparse.ArgumentParser(description="Export ECAPA_TDNN and AASIST to ONNX")
+    parser.add_argument("--ecapa-weights", default=str(base_dir / "assets" / "best_model_epoch9_20251001_064344.pt"))
+    parser.add_argument("--out-dir", default=str(base_dir / "assets" / "onnx"))
+    parser.add_argument("--no-fuse", action="store_true", help="export ECAPA_TDNN without folding BN")
+    args = parser.parse_args()
+
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    ecapa = ECAPA_TDNN(C=1024)
+    load_parameters(ecapa, args.ecapa_weights, "cpu")
+    ecapa.eval()
+    if not args.no_fuse:
+        ecapa = ECAPA_TDNN_Fused(ecapa)
+    export_ecapa(ecapa, out_dir / ECAPA_FILE)
+    export_assist(get_assist_model("cpu"), out_dir / ASSIST_FILE, NB_SAMP)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+INT8 CPU inference for ECAPA_TDNN and the AASIST Model.
+
+Precision modes:
+- "fp32": models as trained.
+- "int8-dynamic": Linear layers use int8 weights; activations are quantized
+  on the fly.
+- "int8-static": as above, plus every Conv1d/Conv2d runs as an int8 conv.
+  Activation ranges come from calibration on the bundled clips in assets/.
+
+Report against fp32 (embedding cosine drift, spoof-decision agreement,
+latency, model size):
+
+    python -m src.quantization --precision int8-static
+"""
+import argparse
+import copy
+import io
+import time
+from pathlib import Path
+from typing import Iterable, List, Literal
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao import quantization as tq
+
+from src.ultils_logger import get_logger
+from src.voice_ultils import DecodedAudio, decode_audio
+
+logger = get_logger(__name__)
+
+Precision = Literal["fp32", "int8-dynamic", "int8-static"]
+PRECISIONS = ("fp32", "int8-dynamic", "int8-static")
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+ASSETS_DIR = BASE_DIR / "assets"
+
+
+def calibration_clips(folder: Path = ASSETS_DIR) -> List[DecodedAudio]:
+    """The bundled sample clips, decoded like uploads (mono float32, 16 kHz)."""
+    return [decode_audio(path.read_bytes()) for path in sorted(folder.glob("*.wav"))]
+
+
+def _wrap_convs(module: nn.Module, qconfig):
+    # each conv gets its own quant -> int8 conv -> dequant, the rest stays float
+    for name, child in module.named_children():
+        if type(child) in (nn.Conv1d, nn.Conv2d):
+            wrapper = tq.QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_convs(child, qconfig)
+
+
+def quantize_model(model: nn.Module, precision: Precision, calibrate=None) -> nn.Module:
+    """
+    Return an int8 copy of `model` (the fp32 model is left untouched).
+    `calibrate(model)` runs representative forward passes; it is required for
+    "int8-static".
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision: {precision}")
+    if precision == "fp32":
+        return model
+
+    model = copy.deepcopy(model).cpu().eval()
+    if precision == "int8-static":
+        if calibrate is None:
+            raise ValueError("int8-static needs a calibration function")
+        engine = torch.backends.quantized.engine
+        _wrap_convs(model, tq.get_default_qconfig(engine))
+        tq.prepare(model, inplace=True)
+        with torch.no_grad():
+            calibrate(model)
+        tq.convert(model, inplace=True)
+
+    return tq.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_ecapa(model: nn.Module, precision: Precision, clips: Iterable[DecodedAudio] = ()) -> nn.Module:
+    clips = list(clips)
+
+    def calibrate(m):
+        for clip in clips:
+            m(clip.tensor("cpu"), False)
+
+    return quantize_model(model, precision, calibrate)
+
+
+def quantize_assist(model: nn.Module, precision: Precision, clips: Iterable[DecodedAudio] = ()) -> nn.Module:
+    from src.load_assist import split_windows
+
+    clips = list(clips)
+
+    def calibrate(m):
+        for clip in clips:
+            m(torch.from_numpy(split_windows(clip.samples)))
+
+    return quantize_model(model, precision, calibrate)
+
+
+def model_size_mb(model: nn.Module) -> float:
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2**20
+
+
+### report ###
+def _timed(fn, clips):
+    out = []
+    start = time.perf_counter()
+    with torch.no_grad():
+        for clip in clips:
+            out.append(fn(clip))
+    return out, (time.perf_counter() - start) / max(len(clips), 1) * 1000
+
+
+def report(ecapa: nn.Module, assist: nn.Module, precision: Precision, clips: List[DecodedAudio]) -> dict:
+    from src.load_assist import assist_score_batch, assist_decision
+
+    q_ecapa = quantize_ecapa(ecapa, precision, clips)
+    q_assist = quantize_assist(assist, precision, clips)
+
+    def embed(m):
+        return lambda clip: F.normalize(m(clip.tensor("cpu"), False), p=2, dim=1)
+
+    def spoof(m):
+        return lambda clip: assist_score_batch(m, [clip], "cpu")[0]
+
+    ref_emb, ref_emb_ms = _timed(embed(ecapa), clips)
+    q_emb, q_emb_ms = _timed(embed(q_ecapa), clips)
+    ref_spoof, ref_spoof_ms = _timed(spoof(assist), clips)
+    q_spoof, q_spoof_ms = _timed(spoof(q_assist), clips)
+
+    cos = np.array([F.cosine_similarity(a, b).item() for a, b in zip(ref_emb, q_emb)])
+    agree = np.array([assist_decision(a) == assist_decision(b) for a, b in zip(ref_spoof, q_spoof)])
+    prob_drift = np.abs(np.array(ref_spoof) - np.array(q_spoof))
+
+    return {
+        "precision": precision,
+        "clips": len(clips),
+        "ecapa_cosine_min": float(cos.min()),
+        "ecapa_cosine_mean": float(cos.mean()),
+        "spoof_agreement": float(agree.mean()),
+        "spoof_prob_drift_max": float(prob_drift.max()),
+        "ecapa_ms_fp32": ref_emb_ms,
+        "ecapa_ms_quant": q_emb_ms,
+        "assist_ms_fp32": ref_spoof_ms,
+        "assist_ms_quant": q_spoof_ms,
+        "ecapa_mb_fp32": model_size_mb(ecapa),
+        "ecapa_mb_quant": model_size_mb(q_ecapa),
+        "assist_mb_fp32": model_size_mb(assist),
+        "assist_mb_quant": model_size_mb(q_assist),
+    }
+
+
+def main():
+    from src.voice_model import ECAPA_TDNN, ECAPA_TDNN_Fused
+    from src.voice_ultils import load_parameters
+    from src.load_assist import get_assist_model
+
+    parser = argparse.ArgumentParser(description="Compare int8 inference against fp32 on the bundled clips")
+    parser.add_argument("--precision", choices=PRECISIONS[1:], default="int8-static")
+    parser.add_argument("--ecapa-weights", default=str(ASSETS_DIR / "best_model_epoch9_20251001_064344.pt"))
+    parser.add_argument("--fused", action="store_true", help="quantize ECAPA_TDNN_Fused instead of ECAPA_TDNN")
+    args = parser.parse_args()
+
+    ecapa = ECAPA_TDNN(C=1024)
+    load_parameters(ecapa, args.ecapa_weights, "cpu")
+    ecapa.eval()
+    if args.fused:
+        ecapa = ECAPA_TDNN_Fused(ecapa)
+    assist = get_assist_model("cpu")
+
+    result = report(ecapa, assist, args.precision, calibration_clips())
+    width = max(len(k) for k in result)
+    for key, value in result.items():
+        print(f"{key:<{width}}  {value:.4f}" if isinstance(value, float) else f"{key:<{width}}  {value}")
+
+
+if __name__ == "__main__":
+    main()
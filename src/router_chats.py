@@ -1,23 +1,37 @@
-import requests
 import datetime
+import json
+from typing import AsyncIterator, Optional
 
-from src.database import Database
+import httpx
+
+from src.chats_n8n import N8nClient, N8nStreamError, ReplyStream, UploadTooLarge
+from src.database import ChatMessage, Database
+from src.voice_jobs import JobQueueFull, SpooledUpload, VoiceJobQueue
 from src.ultils_logger import get_logger
 
 from fastapi import APIRouter, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
 logger = get_logger(__name__)
 router = APIRouter()
 
 # Globals injected from main
 db: Database | None = None
-N8N_WEBHOOK_URL: str = ""
+n8n: N8nClient | None = None
+voice_jobs: VoiceJobQueue | None = None
+
+MAX_PAGE_SIZE = 200  # messages per page of /session/{username}/{session_id}/messages
 
-def init_chat_router(database: Database, n8n_url: str):
-    global db, N8N_WEBHOOK_URL
+def init_chat_router(database: Database, n8n_client: N8nClient, job_queue: VoiceJobQueue | None = None):
+    global db, n8n, voice_jobs
     db = database
-    N8N_WEBHOOK_URL = n8n_url
-    logger.info(f"Chat router initialized with n8n URL: {N8N_WEBHOOK_URL}")
+    n8n = n8n_client
+    voice_jobs = job_queue
+    if voice_jobs is not None:
+        voice_jobs.handler = _run_voice_job
+        voice_jobs.describe_error = _describe_job_error
+    logger.info(f"Chat router initialized with n8n URL: {n8n.url}")
 
 
 ### Helpers ###
@@ -25,6 +39,50 @@ def _now() -> str:
     return datetime.datetime.utcnow().isoformat()
 
 
+def _n8n_error(e: httpx.HTTPError, what: str) -> HTTPException:
+    if isinstance(e, httpx.PoolTimeout):
+        logger.warning(f"No free n8n connection for {what}")
+        return HTTPException(status_code=503, detail="n8n is busy, try again later")
+    if isinstance(e, httpx.TimeoutException):
+        logger.error(f"n8n timed out for {what}: {e!r}")
+        return HTTPException(status_code=504, detail="n8n timed out")
+    logger.error(f"Failed to contact n8n for {what}: {e!r}")
+    return HTTPException(status_code=502, detail="Failed to contact n8n")
+
+
+async def _store(username: str, session_id: str, msg: ChatMessage):
+    # off the event loop: with a durable database the write waits for its fsync
+    await run_in_threadpool(db.add_message, username, session_id, msg)  # type: ignore
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _relay_reply(stream: ReplyStream, username: str, session_id: str) -> AsyncIterator[str]:
+    """SSE `token` events as n8n's reply streams in, then `done` once it is saved."""
+    parts = []
+    try:
+        async for chunk in stream:
+            parts.append(chunk)
+            yield _sse("token", {"text": chunk})
+    except (httpx.HTTPError, N8nStreamError) as e:
+        logger.error(f"n8n reply stream failed [{session_id}] {username}: {e!r}")
+        yield _sse("error", {"detail": "n8n reply stream failed"})
+        return
+    finally:
+        await stream.aclose()
+
+    bot_reply = "".join(parts) or "(No response from bot)"
+    await _store(username, session_id, {
+        "time": _now(),
+        "role": "bot",
+        "message": bot_reply
+    })
+    logger.info(f"Chat [{session_id}] {username} (streamed) → {bot_reply}")
+    yield _sse("done", {"reply": bot_reply})
+
+
 ### Routes ###
 
 @router.post("/session/{username}")
@@ -34,7 +92,7 @@ async def create_chat_session(username: str, session_name:str):
         raise HTTPException(status_code=500, detail="Chat router not initialized")
 
     try:
-        session_id = db.create_session(username, session_name)
+        session_id = await run_in_threadpool(db.create_session, username, session_name)
         logger.info(f"New chat session created for {username}: {session_id}; Named {session_name}")
         return {"session_id": session_id}
     
@@ -48,7 +106,7 @@ async def get_all_chat_sessionids(username: str):
     if db is None:
         raise HTTPException(status_code=500, detail="Chat router not initialized")
     try:
-        return db.list_sessions(username)
+        return await run_in_threadpool(db.list_sessions, username)
     except ValueError:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -60,22 +118,53 @@ async def get_chat_session(username: str, session_id: str):
         raise HTTPException(status_code=500, detail="Chat router not initialized")
 
     try:
-        return db.get_session(username, session_id)
+        return await run_in_threadpool(db.get_session, username, session_id)
     
     except ValueError:
         raise HTTPException(status_code=404, detail="Session not found")
 
 
+@router.get("/session/{username}/{session_id}/messages")
+async def get_chat_messages(username: str, session_id: str, limit: int = 50,
+                            before: Optional[int] = None, after: Optional[int] = None):
+    """
+    One page of a session's messages, oldest first, each with its `index`.
+    No cursor gives the latest `limit`; `before=i` the ones just before
+    message i (scroll back) and `after=i` the ones just after it (catch up).
+    """
+    if db is None:
+        raise HTTPException(status_code=500, detail="Chat router not initialized")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Pass either before or after, not both")
+
+    try:
+        page = await run_in_threadpool(db.get_messages_page, username, session_id, limit, before=before, after=after)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    start, total = page["start"], page["total"]
+    messages = [{"index": start + i, **msg} for i, msg in enumerate(page["messages"])]
+    return {
+        "session_id": session_id,
+        "total": total,
+        "messages": messages,
+        "has_older": start > 0,
+        "has_newer": start + len(messages) < total,
+    }
+
+
 @router.post("/send/{username}/{session_id}")
 async def send_message(username: str, session_id: str, user_message: str):
     """
     Send a user message to n8n -> get LLM response -> store both messages
     """
-    if db is None or not N8N_WEBHOOK_URL:
+    if db is None or n8n is None:
         raise HTTPException(status_code=500, detail="Chat router not initialized")
 
     # Add user message to DB
-    db.add_message(username, session_id, {
+    await _store(username, session_id, {
         "time": _now(),
         "role": "human",
         "message": user_message
@@ -83,27 +172,14 @@ async def send_message(username: str, session_id: str, user_message: str):
 
     # Send to n8n webhook
     try:
-        resp = requests.post(
-            N8N_WEBHOOK_URL,
-            json={"username": username, "message": user_message, "session_id": session_id},
-            timeout=30
-        )
-        resp.raise_for_status()
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to contact n8n: {e}")
-        raise HTTPException(status_code=502, detail="Failed to contact n8n")
-
-    # Parse n8n response
-    try:
-        n8n_data = resp.json()
-    except ValueError:
-        n8n_data = {}
+        n8n_data = await n8n.send_message(username, session_id, user_message)
+    except httpx.HTTPError as e:
+        raise _n8n_error(e, "message")
 
     bot_reply = n8n_data.get("reply", "(No response from bot)")
 
     # Save bot reply
-    db.add_message(username, session_id, {
+    await _store(username, session_id, {
         "time": _now(),
         "role": "bot",
         "message": bot_reply
@@ -112,50 +188,71 @@ async def send_message(username: str, session_id: str, user_message: str):
     logger.info(f"Chat [{session_id}] {username}: {user_message} → {bot_reply}")
     return {"reply": bot_reply}
 
-@router.post("/send-voice/{username}/{session_id}")
-async def send_voice(username:str, session_id:str, user_voice:UploadFile):
-    if db is None or not N8N_WEBHOOK_URL:
+@router.post("/send-stream/{username}/{session_id}")
+async def send_message_stream(username: str, session_id: str, user_message: str):
+    """
+    Like /send, but the reply comes back as server-sent events while n8n
+    generates it: `token` events with {"text"}, then `done` with the full
+    {"reply"} once it is stored, or `error`. If the client goes away
+    first, the partial reply is not stored.
+    """
+    if db is None or n8n is None:
         raise HTTPException(status_code=500, detail="Chat router not initialized")
 
     try:
-        # Read the file bytes to forward to n8n
-        file_bytes = await user_voice.read()
-    except Exception as e:
-        logger.error(f"Failed to read voice file: {e}")
-        raise HTTPException(status_code=400, detail="Invalid file upload")
+        await _store(username, session_id, {
+            "time": _now(),
+            "role": "human",
+            "message": user_message
+        })
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
 
-    # Send voice file to n8n as multipart/form-data
     try:
-        files = {"file": (user_voice.filename, file_bytes, user_voice.content_type)}
-        data = {"username": username, "session_id": session_id}
+        stream = await n8n.stream_message(username, session_id, user_message)
+    except httpx.HTTPError as e:
+        raise _n8n_error(e, "message")
+
+    return StreamingResponse(
+        _relay_reply(stream, username, session_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        resp = requests.post(N8N_WEBHOOK_URL, data=data, files=files, timeout=60) # type: ignore
-        resp.raise_for_status()
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to contact n8n for voice message: {e}")
-        raise HTTPException(status_code=502, detail="Failed to contact n8n")
+@router.post("/send-voice/{username}/{session_id}")
+async def send_voice(username:str, session_id:str, user_voice:UploadFile):
+    if db is None or n8n is None:
+        raise HTTPException(status_code=500, detail="Chat router not initialized")
 
-    # Parse n8n response
+    # Relayed in chunks; never held in memory whole
     try:
-        n8n_data = resp.json()
-    except ValueError:
-        n8n_data = {}
+        n8n_data = await n8n.send_voice(username, session_id, user_voice, user_voice.filename,
+                                        user_voice.content_type, user_voice.size)
+    except UploadTooLarge as e:
+        logger.warning(f"Rejected voice message from {username}: {e}")
+        raise HTTPException(status_code=413, detail="Voice message too large")
+    except httpx.HTTPError as e:
+        raise _n8n_error(e, "voice message")
+
+    return await _save_voice_exchange(username, session_id, n8n_data)
 
+
+async def _save_voice_exchange(username: str, session_id: str, n8n_data: dict) -> dict:
     # n8n should return both transcription and reply
     logger.info(n8n_data)
     transcription = n8n_data.get("transcript", "(no transcription)")
     bot_reply = n8n_data.get("reply", "(no reply)")
 
     # Save transcribed message as human
-    db.add_message(username, session_id, {
+    await _store(username, session_id, {
         "time": _now(),
         "role": "human",
         "message": "[TRANSCRIPTION] " + transcription
     })
 
     # Save bot reply
-    db.add_message(username, session_id, {
+    await _store(username, session_id, {
         "time": _now(),
         "role": "bot",
         "message": bot_reply
@@ -164,6 +261,85 @@ async def send_voice(username:str, session_id:str, user_voice:UploadFile):
     logger.info(f"[VoiceChat] [{session_id}] [{username}] Transcription: {transcription}; Reply: {bot_reply}")
     return {"transcript": transcription, "reply": bot_reply}
 
+
+### Voice jobs ###
+async def _run_voice_job(job: dict, upload: SpooledUpload) -> dict:
+    n8n_data = await n8n.send_voice(job["username"], job["session_id"], upload, job["filename"],  # type: ignore
+                                    job["content_type"], job["size"])
+    return await _save_voice_exchange(job["username"], job["session_id"], n8n_data)
+
+
+def _describe_job_error(e: BaseException) -> str:
+    if isinstance(e, httpx.HTTPError):
+        return _n8n_error(e, "voice job").detail
+    if isinstance(e, ValueError):
+        return str(e)
+    return "Voice job failed"
+
+
+def _job_view(job: dict) -> dict:
+    return {key: job[key] for key in ("id", "session_id", "status", "created", "updated",
+                                      "transcript", "reply", "error") if key in job}
+
+
+def _get_job(username: str, job_id: str) -> dict:
+    if voice_jobs is None:
+        raise HTTPException(status_code=503, detail="Voice jobs not enabled")
+    job = voice_jobs.get(job_id)
+    if job is None or job["username"] != username:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/send-voice-job/{username}/{session_id}", status_code=202)
+async def send_voice_job(username: str, session_id: str, user_voice: UploadFile):
+    """
+    Queue a voice message and return its job id at once. The transcript and
+    reply are stored in the session when the job is done; poll
+    /voice-jobs/{username}/{job_id} or follow its /events stream.
+    """
+    if db is None or n8n is None:
+        raise HTTPException(status_code=500, detail="Chat router not initialized")
+    if voice_jobs is None:
+        raise HTTPException(status_code=503, detail="Voice jobs not enabled")
+    try:
+        if session_id not in await run_in_threadpool(db.list_sessions, username):
+            raise ValueError("Session not found")
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if user_voice.size is not None and user_voice.size > n8n.max_upload_bytes:
+        raise HTTPException(status_code=413, detail="Voice message too large")
+
+    try:
+        job = await voice_jobs.submit(username, session_id, user_voice.file, user_voice.filename,
+                                      user_voice.content_type, n8n.max_upload_bytes)
+    except JobQueueFull:
+        logger.warning(f"Voice job queue full, rejected {username}")
+        raise HTTPException(status_code=503, detail="Server busy, try again later")
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="Voice message too large")
+
+    logger.info(f"[VoiceJob] {job['id']} queued for [{session_id}] [{username}]")
+    return _job_view(job)
+
+
+@router.get("/voice-jobs/{username}/{job_id}")
+async def get_voice_job(username: str, job_id: str):
+    return _job_view(_get_job(username, job_id))
+
+
+@router.get("/voice-jobs/{username}/{job_id}/events")
+async def watch_voice_job(username: str, job_id: str):
+    """Server-sent `status` events with the job each time it changes, ending when it is done or failed."""
+    _get_job(username, job_id)
+
+    async def events() -> AsyncIterator[str]:
+        async for job in voice_jobs.watch(job_id):  # type: ignore
+            yield _sse("status", _job_view(job))
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @router.delete("/session/{username}/{session_id}")
 async def delete_chat_session(username: str, session_id: str):
     """Delete a specific chat session for a user"""
@@ -171,7 +347,7 @@ async def delete_chat_session(username: str, session_id: str):
         raise HTTPException(status_code=500, detail="Chat router not initialized")
 
     try:
-        db.delete_session(username, session_id)
+        await run_in_threadpool(db.delete_session, username, session_id)
         return {
             "message": f"Session {session_id} deleted for user {username}"
         }
@@ -1,11 +1,17 @@
+import asyncio
+import time
+from contextlib import contextmanager
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
-from typing import Callable
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, Dict, Optional, Tuple, TypeVar
 
-from src.voice_ultils import get_embedding, cosine_score
+from src.voice_ultils import DecodedAudio, load_audio, get_embedding, cosine_score
 from src.database import Database
 from src.voice_model import ECAPA_TDNN
 from src.ultils_logger import get_logger
-from src.load_assist import infer_assist
+from src.load_assist import infer_assist, assist_decision
+from src.inference_pool import InferencePool, PoolBusyError
+from src.batching import MicroBatcher
 
 logger = get_logger(__name__)
 router = APIRouter()
@@ -15,31 +21,164 @@ model: ECAPA_TDNN
 assist_model: Callable
 device: str
 THRESHOLD: float
+inference: InferencePool
+embedder: Optional[MicroBatcher] = None
+spoof_batcher: Optional[MicroBatcher] = None
 
+T = TypeVar("T")
 
-def init_voice_router(database: Database, mdl: ECAPA_TDNN, assist_mdl: Callable, dev: str, threshold: float):
-    global db, model, assist_model, device, THRESHOLD
+
+def init_voice_router(database: Database, mdl: ECAPA_TDNN, assist_mdl: Callable, dev: str, threshold: float,
+                      pool: InferencePool, emb_batcher: Optional[MicroBatcher] = None,
+                      assist_batcher: Optional[MicroBatcher] = None):
+    global db, model, assist_model, device, THRESHOLD, inference, embedder, spoof_batcher
     db = database
     model = mdl
     assist_model = assist_mdl
     device = dev
     THRESHOLD = threshold
+    inference = pool
+    embedder = emb_batcher
+    spoof_batcher = assist_batcher
+
+
+### Helpers ###
+@contextmanager
+def _inference_errors(name: str):
+    try:
+        yield
+    except PoolBusyError:
+        logger.warning(f"Inference queue full, rejecting {name}")
+        raise HTTPException(status_code=503, detail="Server busy, please retry")
+    except TimeoutError:
+        logger.error(f"Inference timed out: {name}")
+        raise HTTPException(status_code=504, detail="Voice processing timed out")
+
+
+async def _infer(fn: Callable[..., T], *args) -> T:
+    """Run a blocking decode/model call on the inference pool, off the event loop."""
+    with _inference_errors(getattr(fn, "__name__", str(fn))):
+        return await inference.run(fn, *args)
+
 
+async def _embed(audio: DecodedAudio):
+    """ECAPA embedding, micro-batched with concurrent requests when a batcher is configured."""
+    if embedder is None:
+        return await _infer(get_embedding, model, audio, device)
+    with _inference_errors("embedding"):
+        return await inference.wait(embedder.submit(audio))
+
+
+async def _spoof(audio: DecodedAudio) -> str:
+    """AASIST verdict; fixed-window and batched across requests when a batcher is configured."""
+    if spoof_batcher is None:
+        return await _infer(infer_assist, assist_model, audio, device)
+    with _inference_errors("spoof detection"):
+        score = await inference.wait(spoof_batcher.submit(audio))
+    return assist_decision(score)
+
+
+class StageTimer:
+    """Wall-clock milliseconds per verification stage, queueing included."""
+    def __init__(self):
+        self.ms: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.ms[name] = round((time.perf_counter() - start) * 1000, 2)
+
+
+async def _decode(audio_file: UploadFile, timer: StageTimer) -> DecodedAudio:
+    try:
+        with timer.stage("decode"):
+            return await _infer(load_audio, audio_file)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Audio decoding failed: {e}")
+        raise HTTPException(status_code=400, detail="Failed to decode voice file")
+
+
+async def _spoof_and_embed(audio: DecodedAudio, timer: StageTimer, who: str):
+    """
+    Spoof detection and the ECAPA embedding run concurrently on the same
+    decoded audio. A spoofed verdict cancels the embedding; if it has not
+    reached a worker yet, it never runs.
+    Returns (embedding, assist status).
+    """
+    async def spoof():
+        try:
+            with timer.stage("spoof"):
+                return await _spoof(audio)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Assist model failed: {e}")
+            raise HTTPException(status_code=500, detail="Assist model internal error")
+
+    async def embed():
+        try:
+            with timer.stage("embedding"):
+                return await _embed(audio)
+        except HTTPException:
+            raise
+        except Exception as e:
+            logger.error(f"Embedding extraction failed for {who}: {e}")
+            raise HTTPException(status_code=500, detail="Voice processing failed")
+
+    embed_task = asyncio.create_task(embed())
+    try:
+        status = await spoof()
+        if status != "bonafide":
+            raise HTTPException(status_code=403, detail=f"Spoofed or synthetic voice detected ({status})")
+    except BaseException:
+        embed_task.cancel()
+        await asyncio.gather(embed_task, return_exceptions=True)
+        raise
+    return await embed_task, status
+
+
+async def _check_voice(username: str, audio: DecodedAudio, timer: StageTimer) -> Tuple[float, str]:
+    """Returns (score against the enrolled embedding, assist status)."""
+    emb_new, status = await _spoof_and_embed(audio, timer, username)
+    try:
+        with timer.stage("score"):
+            emb_ref = await run_in_threadpool(db.get_embedding, username, device)
+            score = cosine_score(emb_new, emb_ref)
+    except Exception as e:
+        logger.error(f"Voice verification error for {username}: {e}")
+        raise HTTPException(status_code=500, detail="Voice processing failed")
+    return score, status
+
+
+### Routes ###
 
 @router.post("/enroll/{username}")
 async def enroll(username: str, password: str = Form(...), file: UploadFile = File(...)):
     logger.info(f"Enroll request received for user: {username}")
     try:
-        emb = get_embedding(model, file, device)
+        audio = await _infer(load_audio, file)
+        emb = await _embed(audio)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Embedding extraction failed: {e}")
         raise HTTPException(status_code=500, detail="Failed to process voice file")
 
-    if db.get_user(username, strict=False):
+    if await run_in_threadpool(db.get_username, username, strict=False):
+        logger.warning(f"Enroll failed - username exists: {username}")
+        raise HTTPException(status_code=409, detail="Username already exists")
+
+    # off the event loop like every db call here: a durable write waits for its fsync
+    try:
+        await run_in_threadpool(db.add_user, username, password, emb)
+    except ValueError:
         logger.warning(f"Enroll failed - username exists: {username}")
         raise HTTPException(status_code=409, detail="Username already exists")
-    
-    db.add_user(username, password, emb)
     logger.info(f"User enrolled: {username}")
     return {"status": "success", "username": username}
 
@@ -51,29 +190,23 @@ async def verify_user(username: str, password: str = Form(None), file: UploadFil
     if not file or not password:
         raise HTTPException(status_code=400, detail="Password and voice file are required")
 
-    user = db.get_user(username, strict=False)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not enrolled")
-
+    # cheapest checks first: a bad username or password never reaches the models
+    timer = StageTimer()
     try:
-        status = infer_assist(assist_model, file, device)
-    except Exception as e:
-        logger.error(f"Assist model failed: {e}")
-        raise HTTPException(status_code=500, detail="Assist model internal error")
+        with timer.stage("lookup"):
+            user = await run_in_threadpool(db.get_username, username, strict=False)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not enrolled")
 
-    if status != "bonafide":
-        raise HTTPException(status_code=403, detail=f"Spoofed or synthetic voice detected ({status})")
+        with timer.stage("password"):
+            password_ok = await run_in_threadpool(db.verify_password, username, password)
+        if not password_ok:
+            raise HTTPException(status_code=401, detail="Invalid password")
 
-    if not db.verify_password(username, password):
-        raise HTTPException(status_code=401, detail="Invalid password")
-
-    try:
-        emb_new = get_embedding(model, file, device)
-        emb_ref = db.get_embedding(username, device)
-        score = cosine_score(emb_new, emb_ref)
-    except Exception as e:
-        logger.error(f"Voice verification error for {username}: {e}")
-        raise HTTPException(status_code=500, detail="Voice processing failed")
+        audio = await _decode(file, timer)
+        score, status = await _check_voice(username, audio, timer)
+    finally:
+        logger.info(f"[Verify] {username} stage timings (ms): {timer.ms}")
 
     if score <= THRESHOLD:
         raise HTTPException(status_code=403, detail=f"Voice verification failed (score={score:.4f})")
@@ -85,6 +218,7 @@ async def verify_user(username: str, password: str = Form(None), file: UploadFil
         "method": "password+voice",
         "score": score,
         "assist": status,
+        "timings_ms": timer.ms,
     }
 
 
@@ -92,11 +226,11 @@ async def verify_user(username: str, password: str = Form(None), file: UploadFil
 async def verify_password(username: str, password: str = Form(...)):
     logger.info(f"[Password Verify] Request for user: {username}")
 
-    user = db.get_user(username)
+    user = await run_in_threadpool(db.get_username, username)
     if not user:
         raise HTTPException(status_code=404, detail="User not enrolled")
 
-    if not db.verify_password(username, password):
+    if not await run_in_threadpool(db.verify_password, username, password):
         raise HTTPException(status_code=401, detail="Invalid password")
 
     return {"status": "success", "username": username, "method": "password"}
@@ -106,26 +240,17 @@ async def verify_password(username: str, password: str = Form(...)):
 async def verify_voice(username: str, file: UploadFile = File(...)):
     logger.info(f"[Voice Verify] Request for user: {username}")
 
-    user = db.get_user(username)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not enrolled")
-
+    timer = StageTimer()
     try:
-        status = infer_assist(assist_model, file, device)
-    except Exception as e:
-        logger.error(f"Assist model inference failed: {e}")
-        raise HTTPException(status_code=500, detail="Assist model internal error")
+        with timer.stage("lookup"):
+            user = await run_in_threadpool(db.get_username, username)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not enrolled")
 
-    if status != "bonafide":
-        raise HTTPException(status_code=403, detail=f"Spoofed or synthetic voice detected ({status})")
-
-    try:
-        emb_new = get_embedding(model, file, device)
-        emb_ref = db.get_embedding(username, device)
-        score = cosine_score(emb_new, emb_ref)
-    except Exception as e:
-        logger.error(f"Voice processing failed: {e}")
-        raise HTTPException(status_code=500, detail="Voice processing failed")
+        audio = await _decode(file, timer)
+        score, status = await _check_voice(username, audio, timer)
+    finally:
+        logger.info(f"[Voice Verify] {username} stage timings (ms): {timer.ms}")
 
     if score <= THRESHOLD:
         raise HTTPException(status_code=403, detail=f"Voice verification failed (score={score:.4f})")
@@ -136,6 +261,39 @@ async def verify_voice(username: str, file: UploadFile = File(...)):
         "method": "voice",
         "score": score,
         "assist": status,
+        "timings_ms": timer.ms,
+    }
+
+
+@router.post("/identify")
+async def identify(file: UploadFile = File(...), top_k: int = Form(5)):
+    """Passwordless 1:N lookup: enrolled users whose score is above THRESHOLD, best first."""
+    logger.info(f"[Identify] File received: {file.filename if file else 'None'}")
+
+    if top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k must be at least 1")
+
+    timer = StageTimer()
+    try:
+        audio = await _decode(file, timer)
+        emb, status = await _spoof_and_embed(audio, timer, "identify")
+        try:
+            with timer.stage("search"):
+                candidates = await run_in_threadpool(db.search_embedding, emb, top_k, device)
+        except Exception as e:
+            logger.error(f"Identification search failed: {e}")
+            raise HTTPException(status_code=500, detail="Voice processing failed")
+    finally:
+        logger.info(f"[Identify] stage timings (ms): {timer.ms}")
+
+    matches = [{"username": name, "score": score} for name, score in candidates if score > THRESHOLD]
+    logger.info(f"[Identify] {len(matches)} match(es) above {THRESHOLD}")
+    return {
+        "status": "success",
+        "count": len(matches),
+        "matches": matches,
+        "assist": status,
+        "timings_ms": timer.ms,
     }
 
 
@@ -147,13 +305,16 @@ async def spoof_check(file: UploadFile = File(...)):
         raise HTTPException(status_code=400, detail="No file uploaded")
 
     try:
-        result = infer_assist(assist_model, file, device)
+        audio = await _infer(load_audio, file)
+        result = await _spoof(audio)
         return {
             "status": "success",
             "filename": file.filename,
             "result": result,
             "description": "bonafide = real, spoofed = synthetic or attack",
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"SpoofCheck error: {e}")
         raise HTTPException(status_code=500, detail="Failed to analyze voice file")
@@ -161,5 +322,5 @@ async def spoof_check(file: UploadFile = File(...)):
 
 @router.get("/users")
 async def list_users():
-    users = list(db.data.keys())
+    users = await run_in_threadpool(db.list_users)
     return {"status": "success", "count": len(users), "users": users}
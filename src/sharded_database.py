@@ -0,0 +1,400 @@
+"""
+Sharded storage backend with the same public API as src.database.Database.
+
+Layout under `root`:
+
+    users.log           one {"user": name} record per enrolled user, in enrollment order
+    embeddings.npy      memory-mapped (capacity, 192) float32 matrix, row i for line i
+    users/ab/<sha1>.json  one file per user: password, embedding and session names
+    users/ab/<sha1>/<session>.jsonl  the session's messages, one per line
+    users/ab/<sha1>/<session>.idx    uint64 byte offset of each message in the .jsonl
+
+Startup reads only users.log and maps embeddings.npy; user files are read
+on first access and kept in a bounded LRU. Messages are never cached: a
+page is read by seeking through the .idx offsets. If embeddings.npy is
+missing or short it is rebuilt from the user files.
+
+One-shot migration from the JSON database (read only; the new root is
+built next to `--root` and renamed into place when complete):
+
+    python -m src.sharded_database --json data/database.json --root data/users
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import struct
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from src.database import ChatMessage, Database, MessagePage, SessionData, UserData, UserLocks, VoiceIndex, page_bounds
+from src.embedding_store import EmbeddingStore
+from src.mutation_log import MutationLog
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class ShardedDatabase(VoiceIndex):
+    """
+    Drop-in for Database with one JSON file per user, hash-bucketed into 256
+    directories. User writes rewrite only that user's file (temp file +
+    atomic rename); a message is an append to its session's .jsonl and
+    .idx. At most `cache_users` user records are held in memory.
+
+    An enrollment writes the user file, then the embedding row, then the
+    users.log record, so a crash part way leaves an unlisted file that the
+    next enrollment of that name overwrites.
+
+    A user's files are read and written under that user's lock, so one
+    user's fsyncs don't hold up another's. The global lock covers only the
+    LRU, and enrollments take `_enroll_lock` so rows and users.log records
+    keep the same order.
+    """
+    def __init__(self, root: str = "users", ann_index: bool = False, cache_users: int = 1024,
+                 fsync_interval: float = 0.05):
+        self.root = Path(root)
+        self.users_dir = self.root / "users"
+        self.users_dir.mkdir(parents=True, exist_ok=True)
+        self.cache_users = max(cache_users, 1)
+        self._lock = threading.Lock()  # the LRU only
+        self._user_locks = UserLocks()
+        self._enroll_lock = threading.Lock()
+        self._cache: "OrderedDict[str, UserData]" = OrderedDict()
+
+        log_path = str(self.root / "users.log")
+        names = [record["user"] for record in MutationLog.replay(log_path)]
+        self._names_log = MutationLog(log_path, fsync_interval)
+        self._init_voice_index((), str(self.root / "index.ivf.npz"), ann_index=ann_index,
+                               store=self._open_embeddings(names))
+        logger.info(f"Sharded database initialized at {self.root} with {len(names)} users")
+
+    ### files ###
+    def _user_path(self, username: str) -> Path:
+        digest = hashlib.sha1(username.encode("utf-8")).hexdigest()
+        return self.users_dir / digest[:2] / f"{digest}.json"
+
+    def _session_paths(self, username: str, session_id: str) -> Tuple[Path, Path]:
+        user_dir = self._user_path(username).with_suffix("")
+        return user_dir / f"{session_id}.jsonl", user_dir / f"{session_id}.idx"
+
+    def _read_user(self, username: str) -> UserData:
+        with open(self._user_path(username), "r", encoding="utf-8") as f:
+            user = json.load(f)
+        if any("messages" in session for session in user["sessions"].values()):
+            # written before messages moved to session files
+            user = self._split_sessions(user)
+            self._write_user(user)
+        return user
+
+    def _write_user(self, user: UserData):
+        path = self._user_path(user["username"])
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(user, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _split_sessions(self, user: UserData) -> UserData:
+        """Write a full user's messages to session files and return the record without them."""
+        sessions = {}
+        for session_id, session in user["sessions"].items():
+            self._write_messages(user["username"], session_id, session.get("messages", []))
+            sessions[session_id] = {"name": session["name"]}
+        return {**user, "sessions": sessions}  # type: ignore
+
+    ### messages ###
+    def _write_messages(self, username: str, session_id: str, messages: List[ChatMessage]):
+        log_path, idx_path = self._session_paths(username, session_id)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        lines = [(json.dumps(msg) + "\n").encode("utf-8") for msg in messages]
+        offsets = np.cumsum([0] + [len(line) for line in lines], dtype="<u8")[:-1]
+        with open(log_path, "wb") as log, open(idx_path, "wb") as idx:
+            log.write(b"".join(lines))
+            idx.write(offsets.tobytes())
+            for f in (log, idx):
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _append_message(self, username: str, session_id: str, msg: ChatMessage):
+        log_path, idx_path = self._session_paths(username, session_id)
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        # the offset is written last and the .idx alone defines the messages, so
+        # a line whose offset never made it to disk is skipped on read
+        count = self._message_count(idx_path)
+        with open(log_path, "ab") as log:
+            offset = log.tell()
+            log.write((json.dumps(msg) + "\n").encode("utf-8"))
+            log.flush()
+            os.fsync(log.fileno())
+        with open(idx_path, "ab") as idx:
+            idx.truncate(count * 8)  # drop a torn offset
+            idx.write(struct.pack("<Q", offset))
+            idx.flush()
+            os.fsync(idx.fileno())
+
+    @staticmethod
+    def _message_count(idx_path: Path) -> int:
+        try:
+            return os.path.getsize(idx_path) // 8
+        except FileNotFoundError:
+            return 0
+
+    def _read_messages(self, username: str, session_id: str, start: int = 0,
+                       stop: Optional[int] = None) -> List[ChatMessage]:
+        """Messages [start, stop) of a session, reading only their offsets and bytes."""
+        log_path, idx_path = self._session_paths(username, session_id)
+        total = self._message_count(idx_path)
+        stop = total if stop is None else min(stop, total)
+        if start >= stop:
+            return []
+        # one offset past the page, if there is one, bounds the read
+        offsets = np.fromfile(idx_path, dtype="<u8", count=min(stop + 1, total) - start, offset=start * 8)
+        base = int(offsets[0])
+        with open(log_path, "rb") as log:
+            log.seek(base)
+            data = log.read(int(offsets[-1]) - base) if stop < total else log.read()
+        bounds = [int(o) - base for o in offsets[:stop - start]] + [len(data)]
+        return [json.loads(data[a:b].split(b"\n", 1)[0]) for a, b in zip(bounds, bounds[1:])]
+
+    def _open_embeddings(self, names: List[str]) -> EmbeddingStore:
+        path = self.root / "embeddings.npy"
+        if path.exists():
+            try:
+                return EmbeddingStore.open(path, names)
+            except ValueError as e:
+                logger.error(f"Rebuilding {path}: {e}")
+        # the user files are the source of truth; the matrix is a cache of them
+        store = EmbeddingStore(capacity=max(len(names), 64), mmap_path=path)
+        for name in names:
+            store.set(name, self._read_user(name)["voice_emb"])
+        store.flush()
+        if names:
+            logger.warning(f"Rebuilt {path} from {len(names)} user files")
+        return store
+
+    def close(self):
+        self.embeddings.close()
+        self._names_log.close()
+        logger.info(f"Sharded database closed at {self.root}")
+
+    ### cache ###
+    def _cached(self, username: str) -> Optional[UserData]:
+        with self._lock:
+            user = self._cache.get(username)
+            if user is not None:
+                self._cache.move_to_end(username)
+            return user
+
+    def _user(self, username: str) -> Optional[UserData]:
+        user = self._cached(username)
+        if user is not None:
+            return user
+        if username not in self.embeddings:
+            return None
+        # under the user's lock, so a writer never edits a record that a
+        # concurrent miss is about to replace with a copy read from disk
+        with self._user_locks(username):
+            user = self._cached(username)
+            if user is not None:
+                return user
+            user = self._read_user(username)
+            with self._lock:
+                self._cache[username] = user
+                if len(self._cache) > self.cache_users:
+                    self._cache.popitem(last=False)
+            return user
+
+    def _require_user(self, username: str) -> UserData:
+        user = self._user(username)
+        if user is None:
+            logger.error(f"User not found: {username}")
+            raise ValueError("User not found")
+        return user
+
+    def _session_names(self, username: str) -> Dict[str, dict]:
+        return self._require_user(username)["sessions"]  # type: ignore
+
+    def _require_session(self, username: str, session_id: str) -> dict:
+        session = self._session_names(username).get(session_id)
+        if session is None:
+            logger.error(f"Session not found for user={username}, session_id={session_id}")
+            raise ValueError("Session not found")
+        return session
+
+    ### helpers ###
+    def get_username(self, username: str, strict: bool = True) -> Optional[str]:
+        if username in self.embeddings:
+            return username
+        logger.error(f"User not found: {username}")
+        if strict:
+            raise ValueError("User not found")
+        return None
+
+    def get_user(self, username: str, strict: bool = True) -> UserData:
+        """The full user, reading every session's messages; prefer the narrower getters."""
+        user = self._user(username)
+        if user is None:
+            logger.error(f"User not found: {username}")
+            if strict:
+                raise ValueError("User not found")
+            return None  # type: ignore
+        sessions = {sid: self._session(username, sid, s["name"]) for sid, s in user["sessions"].items()}
+        return {**user, "sessions": sessions}
+
+    def list_users(self) -> List[str]:
+        return self.embeddings.usernames
+
+    ### users ###
+    def add_user(self, username: str, password: str, voice_emb: torch.Tensor):
+        emb_list = voice_emb.squeeze().cpu().numpy().tolist()
+        self._insert({
+            "username": username,
+            "password": password,
+            "voice_emb": emb_list,
+            "sessions": {}
+        })
+        if self.ann is not None:
+            self.ann.add(username, emb_list)
+        logger.info(f"User added: {username}")
+
+    def _insert(self, user: UserData):
+        username = user["username"]
+        with self._user_locks(username):
+            if username in self.embeddings:
+                raise ValueError("Username already exists")
+            self._write_user(self._split_sessions(user))
+            with self._enroll_lock:
+                self.embeddings.set(username, user["voice_emb"])
+                self.embeddings.flush()
+                seq = self._names_log.append({"user": username})
+            with self._lock:
+                self._cache.pop(username, None)
+        self._names_log.wait(seq)
+
+    def verify_password(self, username: str, password: str) -> bool:
+        user = self._user(username)
+        if user is None:
+            logger.error(f"User not found: {username}")
+            raise ValueError("User not found")
+        return user["password"] == password
+
+    ### embedding ###
+    def get_embedding(self, username: str, device="cpu"):
+        """(192,) view into the memory-mapped embedding store."""
+        uname = self.get_username(username)
+        return self.embeddings.tensor(uname, device) # type: ignore
+
+    def update_embedding(self, username: str, new_emb: torch.Tensor):
+        emb_list = new_emb.squeeze().cpu().numpy().tolist()
+        with self._user_locks(username):
+            user = self._require_user(username)
+            user["voice_emb"] = emb_list
+            self._write_user(user)
+            self._index_embedding(username, emb_list)
+
+    ### sessions ###
+    def create_session(self, username: str, session_name: str) -> str:
+        session_id = str(uuid.uuid4())
+        with self._user_locks(username):
+            # one lookup: the LRU may evict this record meanwhile, a second could read a stale copy
+            user = self._require_user(username)
+            user["sessions"][session_id] = {"name": session_name}  # type: ignore
+            self._write_user(user)
+        return session_id
+
+    def add_message(self, username: str, session_id: str, msg: ChatMessage):
+        with self._user_locks(username):
+            self._require_session(username, session_id)
+            self._append_message(username, session_id, msg)
+
+    def _session(self, username: str, session_id: str, name: str) -> SessionData:
+        return {"name": name, "messages": self._read_messages(username, session_id)}
+
+    def get_session_messages(self, username: str, session_id: str) -> List[ChatMessage]:
+        self._require_session(username, session_id)
+        return self._read_messages(username, session_id)
+
+    def get_messages_page(self, username: str, session_id: str, limit: int,
+                          before: Optional[int] = None, after: Optional[int] = None) -> MessagePage:
+        """One page of a session's messages, read through the offset index; see page_bounds."""
+        with self._user_locks(username):
+            self._require_session(username, session_id)
+            total = self._message_count(self._session_paths(username, session_id)[1])
+            start, stop = page_bounds(total, limit, before, after)
+            return {"start": start, "total": total, "messages": self._read_messages(username, session_id, start, stop)}
+
+    def list_sessions(self, username: str) -> List[str]:
+        return list(self._session_names(username).keys())
+
+    def get_session(self, username: str, session_id: str) -> SessionData:
+        """
+        Return a specific chat session by ID.
+        Raises ValueError if not found.
+        """
+        session = self._require_session(username, session_id)
+        return self._session(username, session_id, session["name"])
+
+    def delete_session(self, username: str, session_id: str):
+        """
+        Delete a specific chat session by ID.
+        Raises ValueError if not found.
+        """
+        with self._user_locks(username):
+            user = self._require_user(username)
+            if session_id not in user["sessions"]:
+                logger.error(f"Tried to delete non-existent session: user={username}, session_id={session_id}")
+                raise ValueError("Session not found")
+            del user["sessions"][session_id]
+            self._write_user(user)
+            for path in self._session_paths(username, session_id):
+                path.unlink(missing_ok=True)
+        logger.info(f"Deleted session {session_id} for user {username}")
+
+
+### migration ###
+def migrate_json(json_path: str, root: str) -> int:
+    """
+    Copy every user, session and message of a JSON Database into a new
+    sharded root. The JSON side is only read. The root is built at
+    `root + ".tmp"` and renamed into place once complete.
+    """
+    if os.path.exists(os.path.join(root, "users.log")):
+        raise ValueError(f"{root} already has users, refusing to migrate into it")
+    data = Database.read_data(json_path)
+    tmp = root + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    target = ShardedDatabase(tmp)
+    try:
+        for user in data.values():
+            target._insert(user)
+    except BaseException:
+        target.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    target.close()
+    os.replace(tmp, root)
+    logger.info(f"Migrated {len(data)} users from {json_path} to {root}")
+    return len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the JSON database to the sharded layout")
+    parser.add_argument("--json", default="data/database.json")
+    parser.add_argument("--root", default="data/users")
+    args = parser.parse_args()
+    migrate_json(args.json, args.root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+"""
+SQLite storage backend with the same public API as src.database.Database.
+
+Users, sessions and messages live in their own tables, in WAL mode, so
+readers never block the writer and several processes can share one file.
+Embeddings are float32 BLOBs. Triggers record every enrollment and
+embedding change in `embedding_changes`, from which each process's
+in-memory identify index catches up before a search.
+
+One-shot migration from the JSON database:
+
+    python -m src.sqlite_database --json data/database.json --sqlite data/database.sqlite3
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from src.database import ChatMessage, Database, MessagePage, SessionData, UserData, VoiceIndex, page_bounds
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username  TEXT PRIMARY KEY,
+    password  TEXT NOT NULL,
+    voice_emb BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    id       TEXT PRIMARY KEY,
+    username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+    name     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions(username);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    idx        INTEGER NOT NULL,
+    time       TEXT NOT NULL,
+    role       TEXT NOT NULL,
+    message    TEXT NOT NULL,
+    PRIMARY KEY (session_id, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS embedding_changes (
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS users_added AFTER INSERT ON users
+BEGIN
+    INSERT INTO embedding_changes (username) VALUES (NEW.username);
+END;
+CREATE TRIGGER IF NOT EXISTS users_emb_changed AFTER UPDATE OF voice_emb ON users
+BEGIN
+    INSERT INTO embedding_changes (username) VALUES (NEW.username);
+END;
+"""
+
+
+def _to_blob(emb) -> bytes:
+    if isinstance(emb, torch.Tensor):
+        emb = emb.detach().squeeze().cpu().numpy()
+    return np.asarray(emb, dtype=np.float32).reshape(-1).tobytes()
+
+
+def _from_blob(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class SQLiteDatabase(VoiceIndex):
+    """
+    Drop-in for Database on SQLite. Each thread gets its own connection;
+    writes run in BEGIN IMMEDIATE transactions. Sessions keep creation order
+    and messages are keyed by (session_id, idx), so one session or one
+    message range is an index lookup.
+    """
+    def __init__(self, path: str = "database.sqlite3", emb_mmap_path: Optional[str] = None,
+                 ann_index: bool = False, timeout: float = 30.0, durable: bool = False):
+        self.path = path
+        self.timeout = timeout
+        self.durable = durable
+        self._local = threading.local()
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._conn().executescript(SCHEMA)
+        # read first: changes committed while the users load are applied again, harmlessly
+        self._seen_change, = self._conn().execute("SELECT COALESCE(MAX(seq), 0) FROM embedding_changes").fetchone()
+        users = self._conn().execute("SELECT username, voice_emb FROM users ORDER BY rowid").fetchall()
+        self._init_voice_index(((name, _from_blob(blob)) for name, blob in users),
+                               os.path.splitext(self.path)[0] + ".ivf.npz", len(users),
+                               emb_mmap_path, ann_index)
+        logger.info(f"SQLite database initialized at {self.path} with {len(users)} users")
+
+    ### connections ###
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # NORMAL syncs the WAL at checkpoints only; FULL on every commit
+            conn.execute(f"PRAGMA synchronous={'FULL' if self.durable else 'NORMAL'}")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    def _write(self):
+        return _Transaction(self._conn())
+
+    def _refresh(self):
+        """Index embeddings enrolled or changed since the last look, by this or another process."""
+        with self._refresh_lock:
+            rows = self._conn().execute(
+                "SELECT c.seq, c.username, u.voice_emb FROM embedding_changes c "
+                "LEFT JOIN users u ON u.username = c.username WHERE c.seq > ? ORDER BY c.seq",
+                (self._seen_change,)).fetchall()
+            for seq, username, blob in rows:
+                if blob is not None:
+                    self._index_embedding(username, _from_blob(blob))
+                self._seen_change = seq
+
+    def close(self):
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
+        self._local = threading.local()
+        self.embeddings.close()
+        logger.info(f"SQLite database closed at {self.path}")
+
+    ### helpers ###
+    def get_username(self, username: str, strict: bool = True) -> Optional[str]:
+        row = self._conn().execute("SELECT 1 FROM users WHERE username = ?", (username,)).fetchone()
+        if row is not None:
+            return username
+        logger.error(f"User not found: {username}")
+        if strict:
+            raise ValueError("User not found")
+        return None
+
+    def get_user(self, username: str, strict: bool = True) -> UserData:
+        row = self._conn().execute(
+            "SELECT password, voice_emb FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            logger.error(f"User not found: {username}")
+            if strict:
+                raise ValueError("User not found")
+            return None  # type: ignore
+        sessions = {sid: self._session(sid, name) for sid, name in self._conn().execute(
+            "SELECT id, name FROM sessions WHERE username = ? ORDER BY rowid", (username,))}
+        return {
+            "username": username,
+            "password": row[0],
+            "voice_emb": _from_blob(row[1]).tolist(),
+            "sessions": sessions,
+        }
+
+    def list_users(self) -> List[str]:
+        return [name for name, in self._conn().execute("SELECT username FROM users ORDER BY rowid")]
+
+    ### users ###
+    def add_user(self, username: str, password: str, voice_emb: torch.Tensor):
+        blob = _to_blob(voice_emb)
+        try:
+            with self._write() as conn:
+                conn.execute("INSERT INTO users (username, password, voice_emb) VALUES (?, ?, ?)",
+                             (username, password, blob))
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already exists")
+        self._index_embedding(username, _from_blob(blob))
+        logger.info(f"User added: {username}")
+
+    def verify_password(self, username: str, password: str) -> bool:
+        row = self._conn().execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            logger.error(f"User not found: {username}")
+            raise ValueError("User not found")
+        return row[0] == password
+
+    ### embedding ###
+    def get_embedding(self, username: str, device="cpu"):
+        """(192,) embedding read from the database, so writes from other workers are seen."""
+        row = self._conn().execute("SELECT voice_emb FROM users WHERE username = ?", (username,)).fetchone()
+        if row is None:
+            logger.error(f"User not found: {username}")
+            raise ValueError("User not found")
+        return torch.from_numpy(_from_blob(row[0]).copy()).to(device)
+
+    def update_embedding(self, username: str, new_emb: torch.Tensor):
+        blob = _to_blob(new_emb)
+        with self._write() as conn:
+            if conn.execute("UPDATE users SET voice_emb = ? WHERE username = ?", (blob, username)).rowcount == 0:
+                logger.error(f"User not found: {username}")
+                raise ValueError("User not found")
+        self._index_embedding(username, _from_blob(blob))
+
+    ### sessions ###
+    def create_session(self, username: str, session_name: str) -> str:
+        session_id = str(uuid.uuid4())
+        try:
+            with self._write() as conn:
+                conn.execute("INSERT INTO sessions (id, username, name) VALUES (?, ?, ?)",
+                             (session_id, username, session_name))
+        except sqlite3.IntegrityError:
+            logger.error(f"User not found: {username}")
+            raise ValueError("User not found")
+        return session_id
+
+    def _require_session(self, conn: sqlite3.Connection, username: str, session_id: str):
+        row = conn.execute("SELECT 1 FROM sessions WHERE id = ? AND username = ?", (session_id, username)).fetchone()
+        if row is None:
+            if self.get_username(username, strict=False) is None:
+                raise ValueError("User not found")
+            raise ValueError("Session not found")
+
+    def add_message(self, username: str, session_id: str, msg: ChatMessage):
+        with self._write() as conn:
+            self._require_session(conn, username, session_id)
+            conn.execute(
+                "INSERT INTO messages (session_id, idx, time, role, message) "
+                "SELECT ?, COALESCE(MAX(idx) + 1, 0), ?, ?, ? FROM messages WHERE session_id = ?",
+                (session_id, msg["time"], msg["role"], msg["message"], session_id))
+
+    def _messages(self, session_id: str, start: int = 0, stop: int = -1) -> List[ChatMessage]:
+        rows = self._conn().execute(
+            "SELECT time, role, message FROM messages WHERE session_id = ? AND idx >= ? ORDER BY idx LIMIT ?",
+            (session_id, start, stop - start if stop >= 0 else -1))
+        return [{"time": t, "role": r, "message": m} for t, r, m in rows]  # type: ignore
+
+    def _session(self, session_id: str, name: str) -> SessionData:
+        return {"name": name, "messages": self._messages(session_id)}
+
+    def get_session_messages(self, username: str, session_id: str) -> List[ChatMessage]:
+        self._require_session(self._conn(), username, session_id)
+        return self._messages(session_id)
+
+    def get_messages_page(self, username: str, session_id: str, limit: int,
+                          before: Optional[int] = None, after: Optional[int] = None) -> MessagePage:
+        """One page of a session's messages, read by primary-key range; see page_bounds."""
+        conn = self._conn()
+        self._require_session(conn, username, session_id)
+        # message indices are contiguous from 0, so the count is MAX(idx) + 1
+        total, = conn.execute("SELECT COALESCE(MAX(idx) + 1, 0) FROM messages WHERE session_id = ?",
+                              (session_id,)).fetchone()
+        start, stop = page_bounds(total, limit, before, after)
+        return {"start": start, "total": total, "messages": self._messages(session_id, start, stop)}
+
+    def list_sessions(self, username: str) -> List[str]:
+        self.get_username(username)
+        return [sid for sid, in self._conn().execute(
+            "SELECT id FROM sessions WHERE username = ? ORDER BY rowid", (username,))]
+
+    def get_session(self, username: str, session_id: str) -> SessionData:
+        """
+        Return a specific chat session by ID.
+        Raises ValueError if not found.
+        """
+        row = self._conn().execute(
+            "SELECT name FROM sessions WHERE id = ? AND username = ?", (session_id, username)).fetchone()
+        if row is None:
+            logger.error(f"Session not found for user={username}, session_id={session_id}")
+            raise ValueError("Session not found")
+        return self._session(session_id, row[0])
+
+    def delete_session(self, username: str, session_id: str):
+        """
+        Delete a specific chat session by ID.
+        Raises ValueError if not found.
+        """
+        self.get_username(username)
+        with self._write() as conn:
+            if conn.execute("DELETE FROM sessions WHERE id = ? AND username = ?",
+                            (session_id, username)).rowcount == 0:
+                logger.error(f"Tried to delete non-existent session: user={username}, session_id={session_id}")
+                raise ValueError("Session not found")
+        logger.info(f"Deleted session {session_id} for user {username}")
+
+
+class _Transaction:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        return False
+
+
+### migration ###
+def migrate_json(json_path: str, sqlite_path: str) -> int:
+    """
+    Copy every user, session and message of a JSON Database into a new
+    SQLite file. The JSON side is only read. The copy is built next to
+    `sqlite_path` and renamed into place once complete, so a failed
+    migration leaves no file behind to be mistaken for a finished one.
+    """
+    if os.path.exists(sqlite_path):
+        raise ValueError(f"{sqlite_path} already exists, refusing to migrate into it")
+    data: Dict[str, UserData] = Database.read_data(json_path)
+    tmp = sqlite_path + ".tmp"
+    for leftover in (tmp, tmp + "-wal", tmp + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+    target = SQLiteDatabase(tmp)
+    try:
+        with target._write() as conn:
+            for username, user in data.items():
+                conn.execute("INSERT INTO users (username, password, voice_emb) VALUES (?, ?, ?)",
+                             (username, user["password"], _to_blob(user["voice_emb"])))
+                for session_id, session in user["sessions"].items():
+                    conn.execute("INSERT INTO sessions (id, username, name) VALUES (?, ?, ?)",
+                                 (session_id, username, session["name"]))
+                    conn.executemany(
+                        "INSERT INTO messages (session_id, idx, time, role, message) VALUES (?, ?, ?, ?, ?)",
+                        [(session_id, i, m["time"], m["role"], m["message"])
+                         for i, m in enumerate(session["messages"])])
+        # fold the WAL into the file, so the rename moves everything
+        target._conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        target.close()
+    os.replace(tmp, sqlite_path)
+    for leftover in (tmp + "-wal", tmp + "-shm"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    logger.info(f"Migrated {len(data)} users from {json_path} to {sqlite_path}")
+    return len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the JSON database to SQLite")
+    parser.add_argument("--json", default="data/database.json")
+    parser.add_argument("--sqlite", default="data/database.sqlite3")
+    args = parser.parse_args()
+    migrate_json(args.json, args.sqlite)
+
+
+if __name__ == "__main__":
+    main()
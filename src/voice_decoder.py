@@ -0,0 +1,177 @@
+"""
+Audio decoding backends.
+
+Uploads are tried in order against:
+- soundfile: WAV / FLAC / OGG-Vorbis, in-process.
+- PyAV (optional, `pip install av`): WebM/Opus, OGG/Opus, MP4/AAC, MP3 ...
+  decoded and resampled in-process through libav, no subprocess.
+- FFmpegPool: pre-spawned ffmpeg workers for anything left over.
+"""
+import atexit
+import io
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import ffmpeg
+import numpy as np
+import soundfile as sf
+
+from src.ultils_logger import get_logger
+
+try:
+    import av
+except ImportError:  # in-process libav decoding is optional
+    av = None
+
+logger = get_logger(__name__)
+
+FFMPEG_POOL_SIZE = 2
+FFMPEG_TIMEOUT = 30.0
+
+
+def decode_soundfile(data: bytes) -> Tuple[np.ndarray, int]:
+    audio, sr = sf.read(io.BytesIO(data), dtype="float32")
+    return audio, sr
+
+
+def decode_pyav(data: bytes, sr: int) -> Tuple[np.ndarray, int]:
+    """Decode the first audio stream to mono float32 at `sr` inside the process."""
+    if av is None:
+        raise RuntimeError("PyAV is not installed")
+
+    chunks = []
+    with av.open(io.BytesIO(data), mode="r") as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format="flt", layout="mono", rate=sr)
+        for frame in container.decode(stream):
+            for out in resampler.resample(frame):
+                chunks.append(out.to_ndarray().reshape(-1))
+        for out in resampler.resample(None):
+            chunks.append(out.to_ndarray().reshape(-1))
+
+    if not chunks:
+        raise ValueError("No audio frames decoded")
+    return np.concatenate(chunks).astype(np.float32, copy=False), sr
+
+
+class FFmpegPool:
+    """
+    Keeps `size` ffmpeg processes started and waiting on stdin.
+
+    An ffmpeg process decodes exactly one stream, so a worker is consumed by
+    each request and a replacement is spawned in the background. The process
+    start-up cost is paid off the request path instead of inside it.
+    """
+    def __init__(self, size: int = FFMPEG_POOL_SIZE, sr: int = 16000, timeout: float = FFMPEG_TIMEOUT):
+        self.size = size
+        self.sr = sr
+        self.timeout = timeout
+        self._idle: "queue.Queue[subprocess.Popen]" = queue.Queue()
+        self._spawner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ffmpeg-spawn")
+        self._closed = False
+        for _ in range(size):
+            self._spawner.submit(self._refill)
+        logger.info(f"FFmpeg decoder pool started with {size} workers at {sr} Hz")
+
+    def _spawn(self) -> subprocess.Popen:
+        return (
+            ffmpeg
+            .input("pipe:0")
+            .output("pipe:1", format="s16le", acodec="pcm_s16le", ac=1, ar=self.sr)
+            .global_args("-loglevel", "error")
+            .run_async(pipe_stdin=True, pipe_stdout=True, pipe_stderr=True, quiet=True)
+        )
+
+    def _refill(self):
+        if self._closed:
+            return
+        try:
+            self._idle.put(self._spawn())
+        except Exception as e:
+            logger.error(f"Failed to spawn ffmpeg worker: {e}")
+
+    def _acquire(self) -> subprocess.Popen:
+        try:
+            proc = self._idle.get_nowait()
+        except queue.Empty:
+            # the refills already queued will restore `size`; another would grow it for good
+            logger.warning("FFmpeg pool exhausted, spawning worker on the request path")
+            return self._spawn()
+        if not self._closed:
+            self._spawner.submit(self._refill)
+        return proc
+
+    def decode(self, data: bytes) -> Tuple[np.ndarray, int]:
+        proc = self._acquire()
+        try:
+            out, err = proc.communicate(input=data, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise RuntimeError("ffmpeg decoding timed out")
+
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {err.decode(errors='ignore').strip()}")
+        audio = np.frombuffer(out, dtype=np.int16).astype(np.float32) / 32768.0
+        return audio, self.sr
+
+    def close(self):
+        self._closed = True
+        self._spawner.shutdown(wait=True)
+        while True:
+            try:
+                proc = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            proc.kill()
+            proc.wait()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_ffmpeg_pool(sr: int = 16000) -> FFmpegPool:
+    with _pools_lock:
+        if sr not in _pools:
+            _pools[sr] = FFmpegPool(FFMPEG_POOL_SIZE, sr)
+        return _pools[sr]
+
+
+def init_ffmpeg_pool(size: int, sr: int = 16000) -> Optional[FFmpegPool]:
+    """Start the worker pool at startup rather than on the first upload that needs it."""
+    global FFMPEG_POOL_SIZE
+    FFMPEG_POOL_SIZE = size
+    if size <= 0:
+        return None
+    return get_ffmpeg_pool(sr)
+
+
+@atexit.register
+def close_ffmpeg_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def decode_bytes(data: bytes, sr: int = 16000) -> Tuple[np.ndarray, int]:
+    """
+    Decode an encoded upload. Returns (audio, sample_rate); soundfile keeps the
+    file's native rate, the other backends resample to `sr`.
+    """
+    try:
+        return decode_soundfile(data)
+    except Exception:
+        pass
+
+    if av is not None:
+        try:
+            return decode_pyav(data, sr)
+        except Exception as e:
+            logger.debug(f"PyAV could not decode upload, falling back to ffmpeg: {e}")
+
+    return get_ffmpeg_pool(sr).decode(data)
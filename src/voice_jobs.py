@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, BinaryIO, Callable, Dict, List, Optional
+
+from src.chats_n8n import CHUNK_SIZE, UploadTooLarge
+from src.mutation_log import MutationLog
+from src.ultils_logger import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TERMINAL = ("done", "failed")
+
+
+class JobQueueFull(RuntimeError):
+    pass
+
+
+class SpooledUpload:
+    """A spooled job upload, read the way N8nClient.send_voice reads an UploadFile."""
+    def __init__(self, path: Path):
+        self._file = open(path, "rb")
+
+    async def read(self, size: int = -1) -> bytes:
+        return await asyncio.to_thread(self._file.read, size)
+
+    def close(self):
+        self._file.close()
+
+
+def _spool(src: BinaryIO, path: Path, max_bytes: int) -> int:
+    size = 0
+    with open(path, "wb") as f:
+        while chunk := src.read(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Upload is over {max_bytes} bytes")
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    return size
+
+
+class VoiceJobQueue:
+    """
+    Voice chat jobs run by `workers` asyncio tasks, so at most that many
+    handler calls (n8n requests) are in flight. Up to `max_queue` jobs may
+    wait; submit raises JobQueueFull beyond that.
+
+    Uploads are spooled to `spool_dir` and every state change is appended
+    to the JSON-lines log at `log_path`, so jobs that were queued or running
+    at shutdown are queued again on the next start; a job interrupted
+    mid-call is sent to n8n a second time. Finished jobs are kept for `ttl`
+    seconds. The log is rewritten with only live jobs on startup and once
+    it passes `compact_bytes`.
+
+    `handler(job, upload)` returns the fields to merge into the finished
+    job; an exception marks it failed, with `describe_error(exc)` as the
+    stored error.
+
+    Job state lives in this process only, so one process owns the log: a
+    second queue on the same `log_path` (another `uvicorn --workers`
+    process) raises RuntimeError instead of replaying and running the
+    same jobs again.
+    """
+    def __init__(self, log_path: str, spool_dir: str, workers: int = 4, max_queue: int = 64,
+                 ttl: float = 3600.0, compact_bytes: int = 2**20):
+        self.log_path = log_path
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.compact_bytes = compact_bytes
+        self.handler: Optional[Callable[[dict, SpooledUpload], Awaitable[dict]]] = None
+        self.describe_error: Callable[[BaseException], str] = repr
+        self._jobs: "OrderedDict[str, dict]" = OrderedDict()
+        self._pending: List[str] = []
+        self._lock_fd: Optional[int] = None
+        self._claim()
+        self._load()
+        self._log = MutationLog(self.log_path)
+        self._queue: Optional[asyncio.Queue] = None
+        self._changed: Optional[asyncio.Condition] = None
+        self._tasks: List[asyncio.Task] = []
+
+    ### state ###
+    def _claim(self):
+        if fcntl is None:
+            return
+        Path(self.log_path).parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(f"{self.log_path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(f"{self.log_path} is in use by another process; "
+                               f"voice jobs run in a single process")
+        self._lock_fd = fd
+
+    def _load(self):
+        for record in MutationLog.replay(self.log_path):
+            self._jobs[record["id"]] = record
+        self._expire()
+        for job in self._jobs.values():
+            if job["status"] not in TERMINAL:
+                job["status"] = "queued"
+                self._pending.append(job["id"])
+        self._rewrite()
+        if self._pending:
+            logger.info(f"Requeued {len(self._pending)} unfinished voice jobs")
+
+    def _rewrite(self):
+        tmp = f"{self.log_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for job in self._jobs.values():
+                f.write(json.dumps(job, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.log_path)
+
+    def _compact(self):
+        self._log.close()
+        self._rewrite()
+        self._log = MutationLog(self.log_path)
+        logger.debug(f"Voice job log compacted to {len(self._jobs)} jobs")
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j["id"] for j in self._jobs.values() if j["status"] in TERMINAL and j["updated"] < cutoff]:
+            del self._jobs[job_id]
+
+    def _spool_path(self, job_id: str) -> Path:
+        return self.spool_dir / f"{job_id}.upload"
+
+    async def _update(self, job: dict, **fields):
+        job.update(fields, updated=time.time())
+        self._log.append(job)
+        if self._log.size >= self.compact_bytes:
+            self._expire()
+            self._compact()
+        async with self._changed:  # type: ignore
+            self._changed.notify_all()  # type: ignore
+
+    def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    ### lifecycle ###
+    def start(self):
+        """Start the workers; call from the running event loop (the app lifespan)."""
+        if self.handler is None:
+            raise RuntimeError("VoiceJobQueue.handler is not set")
+        self._queue = asyncio.Queue()
+        self._changed = asyncio.Condition()
+        for job_id in self._pending:
+            self._queue.put_nowait(job_id)
+        self._pending.clear()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"voice-job-{i}") for i in range(self.workers)]
+        logger.info(f"Voice job queue started: workers={self.workers}, max_queue={self.max_queue}")
+
+    async def close(self):
+        """Stop the workers. Jobs still queued or running are picked up on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._log.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        logger.info("Voice job queue closed")
+
+    ### jobs ###
+    async def submit(self, username: str, session_id: str, upload: BinaryIO, filename: Optional[str],
+                     content_type: Optional[str], max_bytes: int) -> dict:
+        """Spool `upload` and queue a job for it; returns the new job."""
+        if self._queue is None:
+            raise RuntimeError("Voice job queue is not running")
+        if self._queue.qsize() >= self.max_queue:
+            raise JobQueueFull("Voice job queue is full")
+
+        job_id = uuid.uuid4().hex
+        path = self._spool_path(job_id)
+        try:
+            size = await asyncio.to_thread(_spool, upload, path, max_bytes)
+        except BaseException:
+            path.unlink(missing_ok=True)
+            raise
+
+        now = time.time()
+        job = {"id": job_id, "username": username, "session_id": session_id, "status": "queued",
+               "filename": filename, "content_type": content_type, "size": size,
+               "created": now, "updated": now}
+        self._expire()
+        self._jobs[job_id] = job
+        # the caller is handed the id, so the job has to survive a crash from here on
+        await asyncio.to_thread(self._log.wait, self._log.append(job))
+        self._queue.put_nowait(job_id)
+        return dict(job)
+
+    async def watch(self, job_id: str) -> AsyncIterator[dict]:
+        """The job as it is now, then again after each change, until it finishes."""
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            if job["status"] != last:
+                last = job["status"]
+                yield job
+            if job["status"] in TERMINAL:
+                return
+            async with self._changed:  # type: ignore
+                await self._changed.wait()  # type: ignore
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()  # type: ignore
+            job = self._jobs.get(job_id)
+            if job is None:
+                continue
+            await self._update(job, status="running")
+            upload = None
+            try:
+                upload = SpooledUpload(self._spool_path(job_id))
+                result = await self.handler(dict(job), upload)  # type: ignore
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Voice job {job_id} failed: {e!r}")
+                await self._update(job, status="failed", error=self.describe_error(e))
+            else:
+                await self._update(job, status="done", **result)
+            finally:
+                if upload is not None:
+                    upload.close()
+            if job["status"] in TERMINAL:
+                self._spool_path(job_id).unlink(missing_ok=True)
@@ -1,8 +1,13 @@
-import math, torch, torchaudio
+import copy, math, torch, torchaudio
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _masked_mean(x, mask):
+    # x: (#bs, #ch, #frame), mask: (#bs, 1, #frame) with 1 for real frames
+    return torch.sum(x * mask, dim=2, keepdim=True) / mask.sum(dim=2, keepdim=True)
+
+
 class SEModule(nn.Module):
     def __init__(self, channels, bottleneck=128):
         super(SEModule, self).__init__()
@@ -15,8 +20,11 @@ class SEModule(nn.Module):
             nn.Sigmoid(),
             )
 
-    def forward(self, input):
-        x = self.se(input)
+    def forward(self, input, mask=None):
+        if mask is None:
+            x = self.se(input)
+        else:
+            x = self.se[1:](_masked_mean(input, mask))
         return input * x
 
 class Bottle2neck(nn.Module):
@@ -41,7 +49,7 @@ class Bottle2neck(nn.Module):
         self.width  = width
         self.se     = SEModule(planes)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         residual = x
         out = self.conv1(x)
         out = self.relu(out)
@@ -53,6 +61,8 @@ class Bottle2neck(nn.Module):
             sp = spx[i]
           else:
             sp = sp + spx[i]
+          if mask is not None:
+            sp = sp * mask # padded frames read as the conv's zero padding
           sp = self.convs[i](sp)
           sp = self.relu(sp)
           sp = self.bns[i](sp)
@@ -66,7 +76,7 @@ class Bottle2neck(nn.Module):
         out = self.relu(out)
         out = self.bn3(out)
         
-        out = self.se(out)
+        out = self.se(out, mask)
         out += residual
         return out 
 
@@ -155,11 +165,27 @@ class ECAPA_TDNN(nn.Module):
         self.bn6 = nn.BatchNorm1d(192)
 
 
-    def forward(self, x, aug):
+    @staticmethod
+    def frame_mask(lengths, n_frames):
+        """
+        lengths: (#bs,) waveform lengths in samples of a zero-padded batch
+        out_shape: (#bs, 1, #frame) float mask, 1 for frames of the real signal
+        """
+        hop = 160
+        frames = torch.div(lengths, hop, rounding_mode="floor") + 1
+        arange = torch.arange(n_frames, device=lengths.device).unsqueeze(0)
+        return (arange < frames.unsqueeze(1)).unsqueeze(1).float()
+
+    def forward(self, x, aug, lengths=None):
+        mask = None
         with torch.no_grad():
             x = self.torchfbank(x)+1e-6
             x = x.log()   
-            x = x - torch.mean(x, dim=-1, keepdim=True)
+            if lengths is None:
+                x = x - torch.mean(x, dim=-1, keepdim=True)
+            else:
+                mask = self.frame_mask(lengths, x.size(-1))
+                x = (x - _masked_mean(x, mask)) * mask
             if aug == True:
                 x = self.specaug(x)
 
@@ -167,18 +193,29 @@ class ECAPA_TDNN(nn.Module):
         x = self.relu(x)
         x = self.bn1(x)
 
-        x1 = self.layer1(x)
-        x2 = self.layer2(x+x1)
-        x3 = self.layer3(x+x1+x2)
+        x1 = self.layer1(x, mask)
+        x2 = self.layer2(x+x1, mask)
+        x3 = self.layer3(x+x1+x2, mask)
 
         x = self.layer4(torch.cat((x1,x2,x3),dim=1))
         x = self.relu(x)
 
         t = x.size()[-1]
 
-        global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
-        
-        w = self.attention(global_x)
+        if mask is None:
+            global_x = torch.cat((x,torch.mean(x,dim=2,keepdim=True).repeat(1,1,t), torch.sqrt(torch.var(x,dim=2,keepdim=True).clamp(min=1e-4)).repeat(1,1,t)), dim=1)
+
+            w = self.attention(global_x)
+        else:
+            # statistics and attention softmax over real frames only
+            n = mask.sum(dim=2, keepdim=True)
+            mean = _masked_mean(x, mask)
+            var = torch.sum(((x - mean) ** 2) * mask, dim=2, keepdim=True) / (n - 1).clamp(min=1)
+            global_x = torch.cat((x, mean.expand(-1, -1, t), torch.sqrt(var.clamp(min=1e-4)).expand(-1, -1, t)), dim=1)
+
+            w = self.attention[:-1](global_x)
+            w = w.masked_fill(mask == 0, float("-inf"))
+            w = self.attention[-1](w)
 
         mu = torch.sum(x * w, dim=2)
         sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
@@ -191,3 +228,173 @@ class ECAPA_TDNN(nn.Module):
         return x
     
 
+### inference-only variant ###
+def _fold_relu_bn(conv, bn):
+    """
+    Fold Conv -> ReLU -> BN into Conv' -> ReLU -> (* sign + shift).
+
+    BN after ReLU is a per-channel a * relu(z) + b, and
+    a * relu(z) = sign(a) * relu(|a| * z), so |a| goes into the conv weights
+    and only a sign flip and shift remain. `sign` is None when every a >= 0.
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+
+    fused = nn.Conv1d(conv.in_channels, conv.out_channels, kernel_size=conv.kernel_size,
+                      dilation=conv.dilation, padding=conv.padding)
+    fused.weight.copy_(conv.weight * scale.abs().view(-1, 1, 1))
+    fused.bias.copy_(conv.bias * scale.abs())
+
+    sign = None if bool((scale >= 0).all()) else torch.sign(scale).view(1, -1, 1)
+    return fused, sign, shift.view(1, -1, 1)
+
+def _relu_affine(y, sign, shift, out=None):
+    # relu(y) * sign + shift, written into `out` when given
+    y = F.relu_(y)
+    if sign is None:
+        return torch.add(y, shift, out=out) if out is not None else y.add_(shift)
+    return torch.addcmul(shift, y, sign, out=out) if out is not None else torch.addcmul(shift, y, sign)
+
+class FusedBottle2neck(nn.Module):
+
+    @torch.no_grad()
+    def __init__(self, block: Bottle2neck):
+        super(FusedBottle2neck, self).__init__()
+        self.width = block.width
+        self.nums  = block.nums
+        self.conv1, sign1, shift1 = _fold_relu_bn(block.conv1, block.bn1)
+        convs = []
+        for i in range(self.nums):
+            conv, sign, shift = _fold_relu_bn(block.convs[i], block.bns[i])
+            convs.append(conv)
+            self.register_buffer(f"branch_sign{i}", sign)
+            self.register_buffer(f"branch_shift{i}", shift)
+        self.convs = nn.ModuleList(convs)
+        self.conv3, sign3, shift3 = _fold_relu_bn(block.conv3, block.bn3)
+        self.register_buffer("sign1", sign1)
+        self.register_buffer("shift1", shift1)
+        self.register_buffer("sign3", sign3)
+        self.register_buffer("shift3", shift3)
+        self.se = copy.deepcopy(block.se)
+
+    def forward(self, x, mask=None):
+        residual = x
+        out = _relu_affine(self.conv1(x), self.sign1, self.shift1)
+
+        # each branch reads its input chunk before overwriting it with its
+        # output, so `out` doubles as the concatenated result. Writes through
+        # views are lost when tracing for ONNX, so the export concatenates.
+        tracing = torch.jit.is_tracing()
+        spx = torch.split(out, self.width, 1)
+        branches = []
+        for i in range(self.nums):
+          if i==0:
+            sp = spx[i]
+          else:
+            sp = sp + spx[i]
+          if mask is not None:
+            sp = sp * mask
+          sp = _relu_affine(self.convs[i](sp), getattr(self, f"branch_sign{i}"), getattr(self, f"branch_shift{i}"),
+                            out=None if tracing else spx[i])
+          branches.append(sp)
+        if tracing:
+          out = torch.cat(branches + [spx[self.nums]], dim=1)
+
+        out = _relu_affine(self.conv3(out), self.sign3, self.shift3)
+
+        out = self.se(out, mask)
+        out += residual
+        return out
+
+class ECAPA_TDNN_Fused(nn.Module):
+    """
+    Eval-only ECAPA_TDNN built from a trained model; same outputs within
+    float tolerance, fewer ops and much less memory on long clips.
+    - Conv -> ReLU -> BN pairs are folded into the convs (see _fold_relu_bn),
+      bn5 -> fc6 -> bn6 into one Linear.
+    - Res2Net branches write into the conv1 output instead of torch.cat.
+    - The first attention conv is split into frame, mean and std parts, so
+      the (4608, T) global_x with repeated statistics is never built.
+    """
+
+    @torch.no_grad()
+    def __init__(self, model: ECAPA_TDNN):
+        super(ECAPA_TDNN_Fused, self).__init__()
+        model = model.eval()
+        self.torchfbank = copy.deepcopy(model.torchfbank)
+
+        self.conv1, sign1, shift1 = _fold_relu_bn(model.conv1, model.bn1)
+        self.register_buffer("sign1", sign1)
+        self.register_buffer("shift1", shift1)
+        self.layer1 = FusedBottle2neck(model.layer1)
+        self.layer2 = FusedBottle2neck(model.layer2)
+        self.layer3 = FusedBottle2neck(model.layer3)
+        self.layer4 = copy.deepcopy(model.layer4)
+
+        att_conv, att_sign, att_shift = _fold_relu_bn(model.attention[0], model.attention[2])
+        c = model.layer4.out_channels
+        w = att_conv.weight.squeeze(-1)
+        self.register_buffer("att_w_x", w[:, :c].unsqueeze(-1).clone())
+        self.register_buffer("att_w_stats", w[:, c:].clone())
+        self.register_buffer("att_b", att_conv.bias.clone())
+        self.register_buffer("att_sign", att_sign)
+        self.register_buffer("att_shift", att_shift)
+        self.att_out = copy.deepcopy(model.attention[4])
+
+        # bn6(fc6(bn5(z))) == fc(z)
+        s5 = model.bn5.weight / torch.sqrt(model.bn5.running_var + model.bn5.eps)
+        b5 = model.bn5.bias - model.bn5.running_mean * s5
+        s6 = model.bn6.weight / torch.sqrt(model.bn6.running_var + model.bn6.eps)
+        b6 = model.bn6.bias - model.bn6.running_mean * s6
+        self.fc = nn.Linear(model.fc6.in_features, model.fc6.out_features)
+        self.fc.weight.copy_(s6.unsqueeze(1) * model.fc6.weight * s5.unsqueeze(0))
+        self.fc.bias.copy_(s6 * (model.fc6.weight @ b5 + model.fc6.bias) + b6)
+        self.requires_grad_(False)
+        self.eval()
+
+    def forward(self, x, aug=False, lengths=None):
+        if aug:
+            raise ValueError("ECAPA_TDNN_Fused is inference-only")
+
+        mask = None
+        with torch.no_grad():
+            x = self.torchfbank(x)+1e-6
+            x = x.log()
+            if lengths is None:
+                x = x - torch.mean(x, dim=-1, keepdim=True)
+            else:
+                mask = ECAPA_TDNN.frame_mask(lengths, x.size(-1))
+                x = (x - _masked_mean(x, mask)) * mask
+
+        x = _relu_affine(self.conv1(x), self.sign1, self.shift1)
+
+        x1 = self.layer1(x, mask)
+        x2 = self.layer2(x+x1, mask)
+        x3 = self.layer3(x+x1+x2, mask)
+
+        x = self.layer4(torch.cat((x1,x2,x3),dim=1))
+        x = F.relu_(x)
+
+        if mask is None:
+            mean = torch.mean(x, dim=2)
+            std = torch.sqrt(torch.var(x, dim=2).clamp(min=1e-4))
+        else:
+            n = mask.sum(dim=2)
+            mean = _masked_mean(x, mask).squeeze(2)
+            var = torch.sum(((x - mean.unsqueeze(2)) ** 2) * mask, dim=2) / (n - 1).clamp(min=1)
+            std = torch.sqrt(var.clamp(min=1e-4))
+
+        # W @ [x; mean; std] + b == W_x @ x + (W_stats @ [mean; std] + b), broadcast over frames
+        stats = F.linear(torch.cat((mean, std), dim=1), self.att_w_stats, self.att_b)
+        h = F.conv1d(x, self.att_w_x) + stats.unsqueeze(2)
+        h = torch.tanh(_relu_affine(h, self.att_sign, self.att_shift))
+        w = self.att_out(h)
+        if mask is not None:
+            w = w.masked_fill(mask == 0, float("-inf"))
+        w = torch.softmax(w, dim=2)
+
+        mu = torch.sum(x * w, dim=2)
+        sg = torch.sqrt( ( torch.sum((x**2) * w, dim=2) - mu**2 ).clamp(min=1e-4) )
+
+        x = torch.cat((mu,sg),1)
+        return self.fc(x)
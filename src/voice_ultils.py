@@ -1,11 +1,14 @@
-import io
-import ffmpeg
-import soundfile as sf
+from typing import List
+
 import numpy as np
 import torch, torchaudio
 import torch.nn.functional as F
 from fastapi import UploadFile
 
+from src.voice_decoder import decode_bytes
+
+SAMPLE_RATE = 16000
+
 def load_parameters(self, path, device = None):
     self_state = self.state_dict()
     loaded_state = torch.load(path, map_location=device)
@@ -21,34 +24,85 @@ def load_parameters(self, path, device = None):
             continue
         self_state[name].copy_(param)
 
-def _load_any_format(file, sr: int = 16000):
+class DecodedAudio:
+    """
+    Mono float32 waveform at SAMPLE_RATE, decoded once per request and
+    shared by the spoof-detection and embedding stages.
+    """
+    def __init__(self, samples: np.ndarray, sr: int = SAMPLE_RATE):
+        self.samples = samples
+        self.sr = sr
+        self._tensors = {}
+
+    def __len__(self):
+        return self.samples.shape[0]
+
+    @property
+    def duration(self) -> float:
+        return len(self) / self.sr
+
+    def tensor(self, device) -> torch.Tensor:
+        """(1, #samples) tensor on `device`, cached per device."""
+        key = str(device)
+        if key not in self._tensors:
+            self._tensors[key] = torch.from_numpy(self.samples).to(device).unsqueeze(0)
+        return self._tensors[key]
+
+def load_audio(file: UploadFile, sr: int = SAMPLE_RATE) -> DecodedAudio:
     file.file.seek(0)
-    data = file.file.read()
-
-    try:
-        file.file.seek(0)
-        audio, sr = sf.read(file.file, dtype='float32')
-        return audio, sr
-    except Exception:
-        import ffmpeg
-        out, _ = (
-            ffmpeg
-            .input('pipe:0')
-            .output('pipe:1', format='wav', acodec='pcm_s16le', ac=1, ar=sr)
-            .run(input=data, capture_stdout=True, capture_stderr=True, quiet=True)
-        )
-        audio, sr = sf.read(io.BytesIO(out), dtype='float32')
-        return audio, sr
-
-def get_embedding(model, file:UploadFile, device):
-    audio, sr= _load_any_format(file)
+    return decode_audio(file.file.read(), sr)
+
+def decode_audio(data: bytes, sr: int = SAMPLE_RATE) -> DecodedAudio:
+    audio, file_sr = decode_bytes(data, sr)
     if len(audio.shape) > 1:
         audio = np.mean(audio, axis=1)
-    audio = torch.FloatTensor(audio).to(device).unsqueeze(0)
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    if audio.size == 0:
+        raise ValueError("Audio has no samples")
+    if file_sr != sr:
+        audio = torchaudio.functional.resample(torch.from_numpy(audio), file_sr, sr).numpy()
+    return DecodedAudio(audio, sr)
+
+def get_embedding(model, audio: DecodedAudio, device):
+    audio = audio.tensor(device)
 
     with torch.no_grad():
         emb = model(audio, False) 
     return F.normalize(emb, p=2, dim=1)  
 
+def _length_buckets(audios: List[DecodedAudio], ratio: float) -> List[List[int]]:
+    """Group indices so the longest clip in a bucket is at most `ratio` x the shortest."""
+    order = sorted(range(len(audios)), key=lambda i: len(audios[i]))
+    buckets: List[List[int]] = []
+    for i in order:
+        if buckets and len(audios[i]) <= ratio * len(audios[buckets[-1][0]]):
+            buckets[-1].append(i)
+        else:
+            buckets.append([i])
+    return buckets
+
+def embed_batch(model, audios: List[DecodedAudio], device, bucket_ratio: float = 1.25) -> List[torch.Tensor]:
+    """
+    Embed many clips with one padded forward pass per length bucket.
+    Returns one (1, 192) normalized embedding per clip, in input order.
+    """
+    out: List[torch.Tensor] = [None] * len(audios) # type: ignore
+    for bucket in _length_buckets(audios, bucket_ratio):
+        if len(bucket) == 1:
+            out[bucket[0]] = get_embedding(model, audios[bucket[0]], device)
+            continue
+
+        lengths = torch.tensor([len(audios[i]) for i in bucket], device=device)
+        batch = torch.zeros(len(bucket), int(lengths.max()), device=device)
+        for row, i in enumerate(bucket):
+            batch[row, :len(audios[i])] = audios[i].tensor(device)[0]
+
+        with torch.no_grad():
+            emb = model(batch, False, lengths=lengths)
+        emb = F.normalize(emb, p=2, dim=1)
+        for row, i in enumerate(bucket):
+            out[i] = emb[row:row + 1]
+    return out
+
 def cosine_score(emb1, emb2):
     return torch.mean(F.cosine_similarity(emb1, emb2)).item()
@@ -0,0 +1,46 @@
+import threading
+import time
+
+import numpy as np
+
+from src.ann_index import IVFIndex, _normalize
+
+
+def _vectors(n, seed=0):
+    return _normalize(np.random.default_rng(seed).standard_normal((n, 192)))
+
+
+def test_search_finds_itself():
+    vecs = _vectors(2000)
+    index = IVFIndex.build([f"u{i}" for i in range(2000)], vecs, min_train=100)
+    assert index.trained
+    assert index.search(vecs[123], 1)[0][0] == "u123"
+
+
+def test_concurrent_saves_leave_a_readable_index(tmp_path):
+    vecs = _vectors(500)
+    index = IVFIndex.build([f"u{i}" for i in range(500)], vecs, min_train=100)
+    path = tmp_path / "db.ivf.npz"
+    threads = [threading.Thread(target=index.save, args=(path,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    loaded = IVFIndex.load(path)
+    assert len(loaded) == 500
+    assert loaded.search(vecs[7], 1)[0][0] == "u7"
+    assert [p.name for p in tmp_path.iterdir()] == ["db.ivf.npz"]
+
+
+def test_background_retrain_keeps_concurrent_changes():
+    vecs = _vectors(3000)
+    index = IVFIndex(min_train=100, retrain_growth=2.0)
+    for i in range(3000):
+        index.add(f"u{i}", vecs[i])
+        if i % 10 == 9:
+            index.remove(f"u{i - 5}")
+    while index._retraining:
+        time.sleep(0.01)
+    removed = {f"u{i - 5}" for i in range(3000) if i % 10 == 9}
+    assert set(index.items()[0]) == {f"u{i}" for i in range(3000)} - removed
+    assert index.search(vecs[2999], 1)[0][0] == "u2999"
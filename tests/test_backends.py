@@ -0,0 +1,121 @@
+"""The same API checks against every storage backend."""
+import pytest
+import torch
+
+from src.database import Database
+from src.sharded_database import ShardedDatabase
+from src.sqlite_database import SQLiteDatabase
+
+BACKENDS = {
+    "json": lambda root: Database(str(root / "database.json")),
+    "sqlite": lambda root: SQLiteDatabase(str(root / "database.sqlite3")),
+    "sharded": lambda root: ShardedDatabase(str(root / "users"), cache_users=2),
+}
+
+
+def _msg(text: str, role: str = "human"):
+    return {"time": "t", "role": role, "message": text}
+
+
+@pytest.fixture(params=list(BACKENDS))
+def open_db(request, tmp_path):
+    """Opens the backend under test at one path; every instance is closed at teardown."""
+    opened = []
+
+    def open_db():
+        db = BACKENDS[request.param](tmp_path)
+        opened.append(db)
+        return db
+
+    yield open_db
+    for db in opened:
+        try:
+            db.close()
+        except Exception:
+            pass
+
+
+def test_users(open_db):
+    db = open_db()
+    emb = torch.randn(192)
+    db.add_user("alice", "pw", emb)
+    db.add_user("bob", "pw2", torch.randn(192))
+    with pytest.raises(ValueError):
+        db.add_user("alice", "other", torch.randn(192))
+
+    assert db.list_users() == ["alice", "bob"]
+    assert db.get_username("alice") == "alice"
+    assert db.get_username("nobody", strict=False) is None
+    with pytest.raises(ValueError):
+        db.get_username("nobody")
+    assert db.verify_password("alice", "pw")
+    assert not db.verify_password("alice", "nope")
+    assert db.get_user("alice")["password"] == "pw"
+    assert db.get_user("nobody", strict=False) is None
+    assert torch.allclose(db.get_embedding("alice"), emb)
+
+
+def test_embeddings_and_search(open_db):
+    db = open_db()
+    embs = {name: torch.randn(192) for name in ("a", "b", "c")}
+    for name, emb in embs.items():
+        db.add_user(name, "pw", emb)
+    assert db.search_embedding(embs["b"], 1)[0][0] == "b"
+
+    db.update_embedding("b", embs["c"])
+    assert torch.allclose(db.get_embedding("b"), embs["c"])
+    assert {name for name, _ in db.search_embedding(embs["c"], 2)} == {"b", "c"}
+    with pytest.raises(ValueError):
+        db.update_embedding("nobody", embs["a"])
+
+
+def test_sessions_and_messages(open_db):
+    db = open_db()
+    db.add_user("alice", "pw", torch.randn(192))
+    first = db.create_session("alice", "first")
+    second = db.create_session("alice", "second")
+    assert db.list_sessions("alice") == [first, second]
+    with pytest.raises(ValueError):
+        db.create_session("nobody", "x")
+
+    for i in range(10):
+        db.add_message("alice", first, _msg(str(i)))
+    db.add_message("alice", second, _msg("hi", "bot"))
+    with pytest.raises(ValueError):
+        db.add_message("alice", "no-such-session", _msg("x"))
+
+    assert [m["message"] for m in db.get_session_messages("alice", first)] == [str(i) for i in range(10)]
+    session = db.get_session("alice", second)
+    assert session["name"] == "second"
+    assert session["messages"] == [_msg("hi", "bot")]
+
+    page = db.get_messages_page("alice", first, 3)
+    assert (page["start"], page["total"]) == (7, 10)
+    assert [m["message"] for m in page["messages"]] == ["7", "8", "9"]
+    page = db.get_messages_page("alice", first, 3, before=2)
+    assert [m["message"] for m in page["messages"]] == ["0", "1"]
+    page = db.get_messages_page("alice", first, 4, after=5)
+    assert [m["message"] for m in page["messages"]] == ["6", "7", "8", "9"]
+    with pytest.raises(ValueError):
+        db.get_messages_page("alice", first, 3, before=5, after=1)
+
+    db.delete_session("alice", first)
+    assert db.list_sessions("alice") == [second]
+    with pytest.raises(ValueError):
+        db.get_session("alice", first)
+    with pytest.raises(ValueError):
+        db.delete_session("alice", first)
+
+
+def test_data_survives_reopen(open_db):
+    db = open_db()
+    emb = torch.randn(192)
+    db.add_user("alice", "pw", emb)
+    session_id = db.create_session("alice", "chat")
+    db.add_message("alice", session_id, _msg("kept"))
+    db.close()
+
+    db = open_db()
+    assert db.list_users() == ["alice"]
+    assert torch.allclose(db.get_embedding("alice"), emb)
+    assert db.get_session("alice", session_id) == {"name": "chat", "messages": [_msg("kept")]}
@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+import torch
+from fastapi import FastAPI
+
+from src import n8n_stub, router_chats
+from src.chats_n8n import N8nClient
+from src.database import Database
+
+STUB_URL = "http://n8n.test/webhook"
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "database.json"))
+    db.add_user("alice", "pw", torch.randn(192))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def session_id(db):
+    return db.create_session("alice", "chat")
+
+
+@pytest.fixture(autouse=True)
+def fast_stub(monkeypatch):
+    monkeypatch.setattr(n8n_stub, "DELAY", 0.0)
+    monkeypatch.setattr(n8n_stub, "TOKEN_DELAY", 0.0)
+
+
+@pytest.fixture
+def call_chats(db, monkeypatch):
+    """Runs `call(client)` against the chat routes, with n8n behind `transport`."""
+    for name in ("db", "n8n", "voice_jobs"):
+        monkeypatch.setattr(router_chats, name, None)
+
+    def call_chats(call, transport=None, **kwargs):
+        async def run():
+            n8n = N8nClient(STUB_URL, stream_url=STUB_URL + "/stream",
+                            transport=transport or httpx.ASGITransport(app=n8n_stub.app), **kwargs)
+            router_chats.init_chat_router(db, n8n)
+            app = FastAPI()
+            app.include_router(router_chats.router, prefix="/chats")
+            try:
+                async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://app") as client:
+                    return await call(client)
+            finally:
+                await n8n.aclose()
+
+        return asyncio.run(run())
+
+    return call_chats
+
+
+def _texts(db, session_id):
+    return [(m["role"], m["message"]) for m in db.get_session_messages("alice", session_id)]
+
+
+def test_send_message(call_chats, db, session_id):
+    resp = call_chats(lambda c: c.post(f"/chats/send/alice/{session_id}", params={"user_message": "hi there"}))
+    assert resp.status_code == 200
+    assert resp.json() == {"reply": "echo: hi there"}
+    assert _texts(db, session_id) == [("human", "hi there"), ("bot", "echo: hi there")]
+
+
+def test_send_voice(call_chats, db, session_id):
+    files = {"user_voice": ("clip.wav", b"\0" * 1000, "audio/wav")}
+    resp = call_chats(lambda c: c.post(f"/chats/send-voice/alice/{session_id}", files=files))
+    assert resp.status_code == 200
+    assert resp.json()["transcript"] == "(1000 bytes of audio)"
+    assert _texts(db, session_id)[-1] == ("bot", "echo: (1000 bytes of audio)")
+
+
+def test_send_voice_too_large(call_chats, db, session_id):
+    files = {"user_voice": ("clip.wav", b"\0" * 1000, "audio/wav")}
+    resp = call_chats(lambda c: c.post(f"/chats/send-voice/alice/{session_id}", files=files),
+                      max_upload_bytes=100)
+    assert resp.status_code == 413
+    assert _texts(db, session_id) == []
+
+
+def test_n8n_timeout(call_chats, db, session_id):
+    def timeout(request):
+        raise httpx.ReadTimeout("stub timed out", request=request)
+
+    resp = call_chats(lambda c: c.post(f"/chats/send/alice/{session_id}", params={"user_message": "hi"}),
+                      transport=httpx.MockTransport(timeout))
+    assert resp.status_code == 504
+    assert _texts(db, session_id) == [("human", "hi")]
+
+
+def test_send_stream_relays_sse(call_chats, db, session_id):
+    async def stream(client):
+        async with client.stream("POST", f"/chats/send-stream/alice/{session_id}",
+                                 params={"user_message": "one two three"}) as resp:
+            assert resp.status_code == 200
+            assert resp.headers["content-type"].startswith("text/event-stream")
+            events = []
+            async for line in resp.aiter_lines():
+                if line.startswith("event: "):
+                    events.append([line[len("event: "):]])
+                elif line.startswith("data: "):
+                    events[-1].append(json.loads(line[len("data: "):]))
+            return events
+
+    events = call_chats(stream)
+    assert [e[0] for e in events] == ["token"] * 4 + ["done"]
+    assert "".join(e[1]["text"] for e in events[:-1]) == "echo: one two three"
+    assert events[-1][1] == {"reply": "echo: one two three"}
+    assert _texts(db, session_id) == [("human", "one two three"), ("bot", "echo: one two three")]
@@ -0,0 +1,120 @@
+import os
+import threading
+
+import pytest
+import torch
+
+from src.database import Database
+
+
+def _msg(text: str):
+    return {"time": "", "role": "human", "message": text}
+
+
+def _texts(db: Database, username: str, session_id: str):
+    return [m["message"] for m in db.get_session_messages(username, session_id)]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "database.json")
+
+
+@pytest.fixture
+def alice(path):
+    """A database with user alice and one session; returns its session id."""
+    db = Database(path)
+    db.add_user("alice", "pw", torch.randn(192))
+    session_id = db.create_session("alice", "chat")
+    db.close()
+    return session_id
+
+
+def test_log_replayed_without_compaction(path, alice):
+    db = Database(path)
+    db.add_message("alice", alice, _msg("a"))
+    db.add_message("alice", alice, _msg("b"))
+    db._log.sync()  # the process dies here: no close(), no compaction
+
+    reopened = Database(path)
+    assert _texts(reopened, "alice", alice) == ["a", "b"]
+    reopened.close()
+
+
+def test_torn_final_log_line(path, alice):
+    db = Database(path)
+    db.add_message("alice", alice, _msg("a"))
+    db._log.sync()
+    with open(path + ".log", "a", encoding="utf-8") as f:
+        f.write('{"op": "add_message", "user": "alice", "sess')
+
+    reopened = Database(path)
+    assert _texts(reopened, "alice", alice) == ["a"]
+    reopened.add_message("alice", alice, _msg("b"))
+    reopened._log.sync()
+
+    again = Database(path)
+    assert _texts(again, "alice", alice) == ["a", "b"]
+    again.close()
+
+
+def test_interrupted_compaction_replays_old_log(path, alice):
+    db = Database(path)
+    db.add_message("alice", alice, _msg("a"))
+    # crash right after compaction rotated the log, before the snapshot
+    db._log.rotate(path + ".log.old")
+    db.add_message("alice", alice, _msg("b"))
+    db._log.sync()
+
+    reopened = Database(path)
+    assert _texts(reopened, "alice", alice) == ["a", "b"]
+    reopened.compact()
+    assert not os.path.exists(path + ".log.old")
+    reopened.add_message("alice", alice, _msg("c"))
+    reopened.compact()
+    reopened.close()
+
+    again = Database(path)
+    assert _texts(again, "alice", alice) == ["a", "b", "c"]
+    again.close()
+
+
+def test_replayed_message_is_not_duplicated(path, alice):
+    db = Database(path)
+    record = {"op": "add_message", "user": "alice", "session": alice, "index": 0, "msg": _msg("a")}
+    Database._apply(db.data, record)
+    Database._apply(db.data, record)
+    assert _texts(db, "alice", alice) == ["a"]
+    db.close()
+
+
+def test_add_message_during_compact(path, alice):
+    db = Database(path, compact_bytes=4096)
+    sessions = [db.create_session("alice", f"s{t}") for t in range(4)]
+    stop = threading.Event()
+
+    def compact():
+        while not stop.is_set():
+            db.compact()
+
+    def write(session_id):
+        for i in range(300):
+            db.add_message("alice", session_id, _msg(str(i)))
+
+    compactor = threading.Thread(target=compact)
+    compactor.start()
+    writers = [threading.Thread(target=write, args=(s,)) for s in sessions]
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    compactor.join()
+    db._log.sync()  # no final compaction: the log and snapshot must agree as they are
+
+    reopened = Database(path)
+    for session_id in sessions:
+        assert _texts(reopened, "alice", session_id) == [str(i) for i in range(300)]
+    assert _texts(reopened, "alice", alice) == []
+    reopened.close()
+    db.close()
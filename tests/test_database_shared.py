@@ -0,0 +1,85 @@
+import multiprocessing
+import threading
+
+import pytest
+import torch
+
+pytest.importorskip("fcntl")
+
+from src.database import Database  # noqa: E402
+
+WORKERS = 3
+THREADS = 3
+MESSAGES = 100
+
+
+def _worker(path: str, worker: int, compact_bytes: int):
+    db = Database(path, shared=True, compact_bytes=compact_bytes, fsync_interval=0.01)
+    session_id = db.list_sessions("alice")[0]
+
+    def write(thread: int):
+        for i in range(MESSAGES):
+            db.add_message("alice", session_id, {"time": "", "role": "human", "message": f"{worker}-{thread}-{i}"})
+            if i % 25 == 0:
+                db.get_messages_page("alice", session_id, 10)
+
+    threads = [threading.Thread(target=write, args=(t,)) for t in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    db.add_user(f"user{worker}", "pw", torch.randn(192))
+    db.close()
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "database.json")
+    db = Database(path, shared=True)
+    db.add_user("alice", "pw", torch.randn(192))
+    db.create_session("alice", "chat")
+    db.close()
+    return path
+
+
+@pytest.mark.parametrize("compact_bytes", [8 * 2**20, 16 * 1024], ids=["no-compaction", "compacting"])
+def test_processes_share_one_database(path, compact_bytes):
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_worker, args=(path, w, compact_bytes)) for w in range(WORKERS)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(120)
+    assert [p.exitcode for p in procs] == [0] * WORKERS
+
+    db = Database(path, shared=True)
+    session_id = db.list_sessions("alice")[0]
+    texts = [m["message"] for m in db.get_session_messages("alice", session_id)]
+    assert sorted(texts) == sorted(f"{w}-{t}-{i}" for w in range(WORKERS) for t in range(THREADS)
+                                   for i in range(MESSAGES))
+    assert sorted(db.list_users()) == ["alice"] + [f"user{w}" for w in range(WORKERS)]
+    db.close()
+
+
+def test_reads_see_other_instance_writes(path):
+    a = Database(path, shared=True)
+    b = Database(path, shared=True)
+    session_id = a.list_sessions("alice")[0]
+
+    a.add_user("carol", "pw", torch.randn(192))
+    a.add_message("alice", session_id, {"time": "", "role": "bot", "message": "1"})
+    assert [m["message"] for m in b.get_session_messages("alice", session_id)] == ["1"]
+    assert b.search_embedding(a.get_embedding("carol"), 1)[0][0] == "carol"
+
+    # b picks up a's compaction by reloading the new snapshot
+    a.compact()
+    a.add_message("alice", session_id, {"time": "", "role": "bot", "message": "2"})
+    assert len(b.get_session_messages("alice", session_id)) == 2
+    b.add_message("alice", session_id, {"time": "", "role": "bot", "message": "3"})
+    assert [m["message"] for m in a.get_session_messages("alice", session_id)] == ["1", "2", "3"]
+
+    new_emb = torch.randn(192)
+    b.update_embedding("carol", new_emb)
+    assert torch.allclose(a.get_embedding("carol"), new_emb)
+    a.close()
+    b.close()
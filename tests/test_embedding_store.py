@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from src.embedding_store import EmbeddingStore
+
+
+def test_search_and_set(tmp_path):
+    store = EmbeddingStore(capacity=2)
+    rng = np.random.default_rng(0)
+    rows = {f"u{i}": rng.standard_normal(192) for i in range(5)}
+    for name, row in rows.items():
+        store.set(name, row)
+    assert store.usernames == list(rows)
+    assert store.search(rows["u3"], 1)[0][0] == "u3"
+    store.set("u3", rows["u1"])
+    assert len(store) == 5
+    assert np.allclose(store.row("u3"), rows["u1"])
+
+
+def test_mmap_reopen(tmp_path):
+    path = tmp_path / "emb.npy"
+    store = EmbeddingStore(capacity=2, mmap_path=path)
+    row = np.arange(192, dtype=np.float32)
+    for name in ("a", "b", "c"):
+        store.set(name, row + ord(name))
+    store.close()
+
+    reopened = EmbeddingStore.open(path, ["a", "b", "c"])
+    assert np.allclose(reopened.row("c"), row + ord("c"))
+    reopened.close()
+
+
+def test_mmap_file_has_one_owner(tmp_path):
+    pytest.importorskip("fcntl")
+    path = tmp_path / "emb.npy"
+    store = EmbeddingStore(mmap_path=path)
+    store.set("a", np.ones(192))
+    with pytest.raises(RuntimeError):
+        EmbeddingStore(mmap_path=path)
+    with pytest.raises(RuntimeError):
+        EmbeddingStore.open(path, ["a"])
+    assert np.allclose(store.row("a"), 1.0)  # not truncated by the failed opens
+    store.close()
+    EmbeddingStore.open(path, ["a"]).close()
@@ -0,0 +1,45 @@
+import io
+
+import numpy as np
+import pytest
+import soundfile as sf
+import torch
+
+from src.load_assist import NB_SAMP, assist_score_batch, split_windows
+from src.voice_ultils import DecodedAudio, decode_audio
+
+
+class _FakeAssist(torch.nn.Module):
+    """(embedding, logits) like AASIST, bonafide logit = mean of the window."""
+    def forward(self, x):
+        assert x.shape[1] == NB_SAMP
+        mean = x.mean(dim=1, keepdim=True)
+        return x, torch.cat([-mean, mean], dim=1)
+
+
+def test_split_windows_shapes():
+    assert split_windows(np.ones(100, dtype=np.float32)).shape == (1, NB_SAMP)
+    assert split_windows(np.ones(NB_SAMP * 3, dtype=np.float32), max_windows=2).shape == (2, NB_SAMP)
+
+
+def test_split_windows_empty_clip():
+    windows = split_windows(np.zeros(0, dtype=np.float32))
+    assert windows.shape == (1, NB_SAMP)
+    assert not windows.any()
+
+
+def test_empty_clip_does_not_break_its_batch():
+    audios = [DecodedAudio(np.full(NB_SAMP * 2, 0.5, dtype=np.float32)),
+              DecodedAudio(np.zeros(0, dtype=np.float32)),
+              DecodedAudio(np.full(1000, -0.5, dtype=np.float32))]
+    scores = assist_score_batch(_FakeAssist(), audios, "cpu")
+    assert len(scores) == 3
+    assert scores[0] > 0.5 > scores[2]
+    assert scores[1] == 0.5
+
+
+def test_decode_rejects_empty_audio():
+    buf = io.BytesIO()
+    sf.write(buf, np.zeros(0, dtype=np.float32), 16000, format="WAV")
+    with pytest.raises(ValueError):
+        decode_audio(buf.getvalue())
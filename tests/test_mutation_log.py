@@ -0,0 +1,61 @@
+import json
+
+from src.mutation_log import MutationLog
+
+
+def _write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def test_replay_skips_torn_final_line(tmp_path):
+    path = tmp_path / "db.log"
+    _write(path, '{"n": 1}\n{"n": 2}\n{"n": 3, "par')
+    assert [r["n"] for r in MutationLog.replay(str(path))] == [1, 2]
+
+
+def test_append_after_torn_line_is_replayed(tmp_path):
+    path = tmp_path / "db.log"
+    _write(path, '{"n": 1}\n{"n": 2, "par')
+    log = MutationLog(str(path), fsync_interval=0)
+    log.append({"n": 3})
+    log.close()
+    assert [r["n"] for r in MutationLog.replay(str(path))] == [1, 3]
+
+
+def test_replay_missing_file(tmp_path):
+    assert list(MutationLog.replay(str(tmp_path / "none.log"))) == []
+
+
+def test_write_behind_wait_and_close(tmp_path):
+    path = tmp_path / "db.log"
+    log = MutationLog(str(path), fsync_interval=0.01)
+    seqs = [log.append({"n": i}) for i in range(100)]
+    log.wait(seqs[-1])
+    assert len(list(MutationLog.replay(str(path)))) == 100
+    log.append({"n": 100})
+    log.close()
+    assert [r["n"] for r in MutationLog.replay(str(path))] == list(range(101))
+
+
+def test_read_from_stops_at_last_complete_line(tmp_path):
+    path = tmp_path / "db.log"
+    first = json.dumps({"n": 1}) + "\n"
+    _write(path, first + '{"n": 2}\n{"n": 3')
+    records, offset = MutationLog.read_from(str(path), len(first))
+    assert records == [{"n": 2}]
+    with open(path, "a", encoding="utf-8") as f:
+        f.write("}\n")
+    records, _ = MutationLog.read_from(str(path), offset)
+    assert records == [{"n": 3}]
+
+
+def test_rotate_starts_a_fresh_file(tmp_path):
+    path = tmp_path / "db.log"
+    log = MutationLog(str(path), fsync_interval=0)
+    log.append({"n": 1})
+    log.rotate(str(path) + ".old")
+    log.append({"n": 2})
+    log.close()
+    assert list(MutationLog.replay(str(path) + ".old")) == [{"n": 1}]
+    assert list(MutationLog.replay(str(path))) == [{"n": 2}]
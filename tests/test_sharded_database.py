@@ -0,0 +1,166 @@
+import os
+import struct
+
+import numpy as np
+import pytest
+import torch
+
+from src import sharded_database
+from src.database import Database
+from src.sharded_database import ShardedDatabase, migrate_json
+
+
+def _msg(text: str):
+    return {"time": "t", "role": "human", "message": text}
+
+
+def _texts(db, username, session_id):
+    return [m["message"] for m in db.get_session_messages(username, session_id)]
+
+
+@pytest.fixture
+def root(tmp_path):
+    return str(tmp_path / "users")
+
+
+def test_cache_eviction_keeps_writes(root):
+    db = ShardedDatabase(root, cache_users=1)
+    sessions = {}
+    for name in ("a", "b", "c"):
+        db.add_user(name, "pw", torch.randn(192))
+    for round_ in range(3):
+        for name in ("a", "b", "c"):
+            sessions.setdefault(name, []).append(db.create_session(name, f"s{round_}"))
+    for name in ("a", "b", "c"):
+        assert db.list_sessions(name) == sessions[name]
+    db.close()
+
+
+def test_torn_message_append_is_skipped(root):
+    db = ShardedDatabase(root)
+    db.add_user("alice", "pw", torch.randn(192))
+    session_id = db.create_session("alice", "chat")
+    db.add_message("alice", session_id, _msg("a"))
+    db.close()
+
+    # crash mid-append: the line reached the .jsonl, only part of its offset the .idx
+    log_path, idx_path = db._session_paths("alice", session_id)
+    with open(log_path, "ab") as f:
+        f.write(b'{"time": "t", "role": "human", "message": "lost"}\n')
+    with open(idx_path, "ab") as f:
+        f.write(struct.pack("<Q", 12345)[:3])
+
+    db = ShardedDatabase(root)
+    assert _texts(db, "alice", session_id) == ["a"]
+    db.add_message("alice", session_id, _msg("b"))
+    assert _texts(db, "alice", session_id) == ["a", "b"]
+    assert db.get_messages_page("alice", session_id, 1)["messages"] == [_msg("b")]
+    db.close()
+
+
+def test_unlisted_user_file_is_replaced(root):
+    db = ShardedDatabase(root)
+    db.add_user("alice", "pw", torch.randn(192))
+    # crash after the user file was written, before the users.log record
+    db._write_user({"username": "ghost", "password": "old", "voice_emb": [0.0] * 192, "sessions": {}})
+    db.close()
+
+    db = ShardedDatabase(root)
+    assert db.list_users() == ["alice"]
+    assert db.get_username("ghost", strict=False) is None
+    emb = torch.randn(192)
+    db.add_user("ghost", "new", emb)
+    db.close()
+
+    db = ShardedDatabase(root)
+    assert db.list_users() == ["alice", "ghost"]
+    assert db.verify_password("ghost", "new")
+    assert torch.allclose(db.get_embedding("ghost"), emb)
+    db.close()
+
+
+@pytest.mark.parametrize("damage", ["missing", "short"])
+def test_embeddings_rebuilt_from_user_files(root, damage):
+    db = ShardedDatabase(root)
+    embs = {f"u{i}": torch.randn(192) for i in range(5)}
+    for name, emb in embs.items():
+        db.add_user(name, "pw", emb)
+    db.close()
+
+    path = os.path.join(root, "embeddings.npy")
+    os.remove(path)
+    if damage == "short":
+        np.save(path, np.zeros((2, 192), dtype=np.float32))
+
+    db = ShardedDatabase(root)
+    assert db.list_users() == list(embs)
+    for name, emb in embs.items():
+        assert torch.allclose(db.get_embedding(name), emb)
+    assert db.search_embedding(embs["u3"], 1)[0][0] == "u3"
+    db.close()
+
+
+@pytest.fixture
+def json_db(tmp_path):
+    """A compacted JSON database with two users, plus one message still only in its log."""
+    path = str(tmp_path / "database.json")
+    db = Database(path)
+    db.add_user("alice", "pw", torch.randn(192))
+    db.add_user("bob", "pw2", torch.randn(192))
+    session_id = db.create_session("alice", "chat")
+    for i in range(3):
+        db.add_message("alice", session_id, _msg(str(i)))
+    db.close()
+    db = Database(path)
+    db.add_message("alice", session_id, _msg("logged"))
+    db._log.sync()
+    db._log.close()
+    return path, session_id
+
+
+def test_migrate_json_round_trip(json_db, root):
+    path, session_id = json_db
+    with open(path, "rb") as f:
+        snapshot = f.read()
+    with open(path + ".log", "rb") as f:
+        log = f.read()
+
+    assert migrate_json(path, root) == 2
+    assert not os.path.exists(root + ".tmp")
+
+    source = Database.read_data(path)
+    db = ShardedDatabase(root)
+    assert db.list_users() == ["alice", "bob"]
+    assert db.get_user("alice") == source["alice"]
+    assert _texts(db, "alice", session_id) == ["0", "1", "2", "logged"]
+    assert torch.allclose(db.get_embedding("bob"), torch.tensor(source["bob"]["voice_emb"]))
+    db.close()
+
+    # the source was only read
+    with open(path, "rb") as f:
+        assert f.read() == snapshot
+    with open(path + ".log", "rb") as f:
+        assert f.read() == log
+    with pytest.raises(ValueError):
+        migrate_json(path, root)
+
+
+def test_failed_migration_leaves_no_root(json_db, root, monkeypatch):
+    path, _ = json_db
+    real_insert = ShardedDatabase._insert
+    calls = []
+
+    def failing_insert(self, user):
+        calls.append(user["username"])
+        if len(calls) == 2:
+            raise OSError("disk full")
+        real_insert(self, user)
+
+    monkeypatch.setattr(sharded_database.ShardedDatabase, "_insert", failing_insert)
+    with pytest.raises(OSError):
+        migrate_json(path, root)
+    assert not os.path.exists(root)
+    assert not os.path.exists(root + ".tmp")
+
+    monkeypatch.setattr(sharded_database.ShardedDatabase, "_insert", real_insert)
+    assert migrate_json(path, root) == 2
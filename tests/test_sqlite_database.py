@@ -0,0 +1,116 @@
+import os
+import threading
+
+import pytest
+import torch
+
+from src import sqlite_database
+from src.database import Database
+from src.sqlite_database import SQLiteDatabase, migrate_json
+
+
+def _msg(text: str):
+    return {"time": "t", "role": "human", "message": text}
+
+
+@pytest.fixture
+def json_db(tmp_path):
+    """A compacted JSON database with two users, plus one change still only in its log."""
+    path = str(tmp_path / "database.json")
+    db = Database(path)
+    db.add_user("alice", "pw", torch.randn(192))
+    db.add_user("bob", "pw2", torch.randn(192))
+    session_id = db.create_session("alice", "chat")
+    for i in range(5):
+        db.add_message("alice", session_id, _msg(str(i)))
+    db.close()
+    db = Database(path)
+    db.add_message("alice", session_id, _msg("logged"))
+    db._log.sync()
+    db._log.close()
+    return path, session_id
+
+
+def test_instances_share_writes(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    a, b = SQLiteDatabase(path), SQLiteDatabase(path)
+    a.add_user("alice", "pw", torch.randn(192))
+    session_id = b.create_session("alice", "chat")
+
+    def write(db, tag):
+        for i in range(50):
+            db.add_message("alice", session_id, _msg(f"{tag}{i}"))
+
+    threads = [threading.Thread(target=write, args=(db, tag)) for db, tag in ((a, "a"), (b, "b"), (a, "c"))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    messages = [m["message"] for m in b.get_session_messages("alice", session_id)]
+    assert sorted(messages) == sorted(f"{tag}{i}" for tag in "abc" for i in range(50))
+    assert b.get_messages_page("alice", session_id, 10)["total"] == 150
+    a.close()
+    b.close()
+
+
+def test_identify_sees_other_instances(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+    a, b = SQLiteDatabase(path, ann_index=True), SQLiteDatabase(path, ann_index=True)
+    emb = torch.randn(192)
+    a.add_user("carol", "pw", emb)
+    assert b.search_embedding(emb, 1)[0][0] == "carol"
+
+    moved = torch.randn(192)
+    a.update_embedding("carol", moved)
+    assert b.search_embedding(moved, 1)[0] == pytest.approx(("carol", 1.0))
+    a.close()
+    b.close()
+
+
+def test_migrate_json_round_trip(json_db, tmp_path):
+    path, session_id = json_db
+    with open(path, "rb") as f:
+        snapshot = f.read()
+    with open(path + ".log", "rb") as f:
+        log = f.read()
+
+    target = str(tmp_path / "db.sqlite3")
+    assert migrate_json(path, target) == 2
+
+    source = Database.read_data(path)
+    db = SQLiteDatabase(target)
+    assert db.list_users() == ["alice", "bob"]
+    assert db.get_user("alice") == source["alice"]
+    assert [m["message"] for m in db.get_session_messages("alice", session_id)] == \
+        ["0", "1", "2", "3", "4", "logged"]
+    assert torch.allclose(db.get_embedding("bob"), torch.tensor(source["bob"]["voice_emb"]))
+    db.close()
+
+    # the source was only read
+    with open(path, "rb") as f:
+        assert f.read() == snapshot
+    with open(path + ".log", "rb") as f:
+        assert f.read() == log
+    with pytest.raises(ValueError):
+        migrate_json(path, target)
+
+
+def test_failed_migration_leaves_no_database(json_db, tmp_path, monkeypatch):
+    path, _ = json_db
+    target = str(tmp_path / "db.sqlite3")
+    calls = []
+
+    def failing_blob(emb):
+        calls.append(emb)
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return real_blob(emb)
+
+    real_blob = sqlite_database._to_blob
+    monkeypatch.setattr(sqlite_database, "_to_blob", failing_blob)
+    with pytest.raises(OSError):
+        migrate_json(path, target)
+    assert not os.path.exists(target)
+
+    monkeypatch.setattr(sqlite_database, "_to_blob", real_blob)
+    assert migrate_json(path, target) == 2
@@ -0,0 +1,70 @@
+import asyncio
+import io
+
+import pytest
+
+from src.voice_jobs import VoiceJobQueue
+
+pytest.importorskip("fcntl")
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "voice_jobs.log"), str(tmp_path / "spool")
+
+
+async def _echo(job, upload):
+    audio = await upload.read()
+    return {"transcript": f"{len(audio)} bytes", "reply": "ok"}
+
+
+def test_job_runs_to_done(paths):
+    async def run():
+        queue = VoiceJobQueue(*paths)
+        queue.handler = _echo
+        queue.start()
+        job = await queue.submit("alice", "s1", io.BytesIO(b"\0" * 100), "clip.wav", "audio/wav", 1000)
+        statuses = [j["status"] async for j in queue.watch(job["id"])]
+        await queue.close()
+        return queue.get(job["id"]), statuses
+
+    job, statuses = asyncio.run(run())
+    assert statuses[-1] == "done"
+    assert job["transcript"] == "100 bytes"
+
+
+def test_one_process_owns_the_log(paths):
+    async def run():
+        first = VoiceJobQueue(*paths)
+        with pytest.raises(RuntimeError):
+            VoiceJobQueue(*paths)
+        await first.close()
+        second = VoiceJobQueue(*paths)
+        await second.close()
+
+    asyncio.run(run())
+
+
+def test_unfinished_job_is_requeued(paths):
+    async def submit():
+        queue = VoiceJobQueue(*paths)
+        queue.handler = _echo
+        queue.start()
+        # stop the workers first, so the job is still queued at shutdown
+        for task in queue._tasks:
+            task.cancel()
+        job = await queue.submit("alice", "s1", io.BytesIO(b"\0" * 10), None, None, 1000)
+        await queue.close()
+        return job["id"]
+
+    async def restart(job_id):
+        queue = VoiceJobQueue(*paths)
+        queue.handler = _echo
+        assert queue.get(job_id)["status"] == "queued"
+        queue.start()
+        statuses = [j["status"] async for j in queue.watch(job_id)]
+        await queue.close()
+        return statuses
+
+    job_id = asyncio.run(submit())
+    assert asyncio.run(restart(job_id))[-1] == "done"